@@ -1,16 +1,29 @@
 import os
+import copy
 import json
 import re
+import textwrap
+import sqlite3
 import datetime 
 import random
+import hashlib
 import requests
 import pandas as pd # type: ignore
+import numpy as np # type: ignore
 import mysql.connector # type: ignore
 import math 
-from collections import Counter 
-
-from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify
-from functools import wraps
+import io
+import contextlib
+import click
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, has_request_context, Response
+from functools import wraps, lru_cache
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv # type: ignore
@@ -23,7 +36,8 @@ app.secret_key = os.getenv('SECRET_KEY', 'your_super_secret_key_here_ganti_ini_d
 
 UPLOAD_FOLDER = 'datasets'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Unggahan dataset diproses secara streaming per chunk, jadi batas ukuran tidak lagi dibatasi oleh memori worker.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 512)) * 1024 * 1024
 ALLOWED_EXTENSIONS = {'csv'}
 
 DATASETS = {
@@ -39,24 +53,329 @@ MYSQL_CONFIG = {
     'database': 'generatorku_db'
 }
 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_POOL_MAX_IDLE_SECONDS = float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', 300))
+
+class DatabaseConnectionPool:
+    # Pool koneksi MySQL terbatas: koneksi dipinjam per request dan dikembalikan saat teardown,
+    # sehingga handshake TCP+auth tidak terjadi di setiap request.
+    def __init__(self, config, size, timeout, max_idle_seconds):
+        self.config = config
+        self.size = size
+        self.timeout = timeout
+        self.max_idle_seconds = max_idle_seconds
+        self._idle = deque()
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = Counter()
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def _is_healthy(self, conn, idle_since):
+        # Koneksi yang terlalu lama menganggur bisa sudah diputus server (wait_timeout), jadi langsung diganti.
+        if time.monotonic() - idle_since > self.max_idle_seconds:
+            return False
+        try:
+            return conn.is_connected()
+        except mysql.connector.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+        self._stats['discarded'] += 1
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['checkout_failures'] += 1
+                    self._stats['checkout_timeouts'] += 1
+                    raise mysql.connector.errors.PoolError(
+                        f"Pool koneksi database penuh ({self.size} koneksi terpakai) setelah menunggu {self.timeout} detik."
+                    )
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            waited = time.monotonic() - started
+            self._total_wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+            self._stats['checkouts'] += 1
+
+        conn = None
+        if entry is not None:
+            conn, idle_since = entry
+            if not self._is_healthy(conn, idle_since):
+                print("DEBUG: Koneksi database dari pool tidak sehat, membuat koneksi baru.")
+                self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                conn = None
+        if conn is None:
+            try:
+                conn = mysql.connector.connect(**self.config)
+                self._stats['connections_created'] += 1
+            except mysql.connector.Error:
+                with self._cond:
+                    self._in_use -= 1
+                    self._stats['checkout_failures'] += 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn):
+        reusable = True
+        try:
+            # Buang transaksi yang belum di-commit agar tidak bocor ke request berikutnya.
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error:
+            reusable = False
+        if not reusable:
+            self._discard(conn)
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': checkouts,
+                'checkout_failures': self._stats['checkout_failures'],
+                'checkout_timeouts': self._stats['checkout_timeouts'],
+                'health_check_failures': self._stats['health_check_failures'],
+                'connections_created': self._stats['connections_created'],
+                'connections_discarded': self._stats['discarded'],
+                'avg_wait_ms': round(self._total_wait_seconds * 1000 / checkouts, 3) if checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait_seconds * 1000, 3),
+            }
+
+db_pool = DatabaseConnectionPool(MYSQL_CONFIG, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE_SECONDS)
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
         try:
-            db = g._database = mysql.connector.connect(**MYSQL_CONFIG)
-            print("DEBUG: Koneksi database MySQL berhasil dibuat.")
+            db = g._database = db_pool.acquire()
         except mysql.connector.Error as err:
-            print(f"Error: Gagal terhubung ke database MySQL: {err}")
-            flash(f"Gagal terhubung ke database: {err}", 'error')
+            print(f"Error: Gagal mendapatkan koneksi database MySQL dari pool: {err}")
+            if has_request_context():
+                flash(f"Gagal terhubung ke database: {err}", 'error')
             raise
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None and db.is_connected():
-        db.close()
-        print("DEBUG: Koneksi database MySQL ditutup.")
+    db = g.pop('_database', None)
+    if db is not None:
+        db_pool.release(db)
+
+MIGRATIONS_FOLDER = os.path.join(app.root_path, 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d+)_([\w-]+)\.sql$')
+MIGRATION_LOCK_TIMEOUT_SECONDS = int(os.getenv('MIGRATION_LOCK_TIMEOUT_SECONDS', '60'))
+
+def load_migrations(folder=MIGRATIONS_FOLDER):
+    # File migrasi bernama NNNN_nama.sql, diurutkan menurut nomor versinya
+    migrations = {}
+    for filename in os.listdir(folder):
+        match = MIGRATION_FILE_RE.match(filename)
+        if not match:
+            continue
+        version = match.group(1)
+        if version in migrations:
+            raise ValueError(f"Versi migrasi ganda: {version} ({migrations[version]['filename']} dan {filename})")
+        with open(os.path.join(folder, filename), encoding='utf-8') as f:
+            sql = f.read()
+        migrations[version] = {
+            'version': version,
+            'name': match.group(2),
+            'filename': filename,
+            'sql': sql,
+            'checksum': hashlib.sha1(sql.encode('utf-8')).hexdigest(),
+        }
+    return [migrations[version] for version in sorted(migrations, key=int)]
+
+def split_sql_statements(sql):
+    # Memecah file migrasi di ';' yang berada di luar string/identifier ('...', "...", `...`) dan di luar
+    # komentar '-- ...'. Komentar /* */, DELIMITER, dan body prosedur/trigger tidak didukung; migrasi
+    # yang membutuhkannya harus dipecah menjadi statement biasa.
+    statements = []
+    current = []
+    quote = None
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if quote:
+            current.append(char)
+            if char == '\\' and quote != '`' and i + 1 < len(sql):
+                current.append(sql[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in ("'", '"', '`'):
+            quote = char
+            current.append(char)
+        elif sql.startswith('--', i):
+            newline = sql.find('\n', i)
+            i = len(sql) if newline == -1 else newline
+            continue
+        elif char == ';':
+            statements.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statements.append(''.join(current).strip())
+    return [statement for statement in statements if statement]
+
+# Bentuk DDL migrasi yang efeknya bisa diperiksa di information_schema sebelum dijalankan
+MIGRATION_CREATE_INDEX_RE = re.compile(r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+`?(\w+)`?\s+ON\s+`?(\w+)`?', re.IGNORECASE)
+MIGRATION_ALTER_TABLE_RE = re.compile(r'^ALTER\s+TABLE\s+`?(\w+)`?\s+(.*)$', re.IGNORECASE | re.DOTALL)
+MIGRATION_ADD_COLUMN_RE = re.compile(r'^ADD\s+COLUMN\s+`?(\w+)`?', re.IGNORECASE)
+MIGRATION_ADD_KEY_RE = re.compile(r'^ADD\s+(?:UNIQUE\s+)?(?:KEY|INDEX)\s+`?(\w+)`?', re.IGNORECASE)
+MIGRATION_ADD_CONSTRAINT_RE = re.compile(r'^ADD\s+CONSTRAINT\s+`?(\w+)`?', re.IGNORECASE)
+
+def migration_object_exists(cursor, kind, table, name):
+    if kind == 'column':
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (table, name))
+    elif kind == 'index':
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s", (table, name))
+    else:
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.table_constraints "
+            "WHERE table_schema = DATABASE() AND table_name = %s AND constraint_name = %s", (table, name))
+    return cursor.fetchone()[0] > 0
+
+def migration_statement_objects(statement):
+    # Objek (jenis, tabel, nama) yang dibuat statement; None jika bentuknya tidak dikenali
+    match = MIGRATION_CREATE_INDEX_RE.match(statement)
+    if match:
+        return [('index', match.group(2), match.group(1))]
+    match = MIGRATION_ALTER_TABLE_RE.match(statement)
+    if not match:
+        return None
+    table = match.group(1)
+    objects = []
+    # Koma di dalam definisi kolom/index (mis. DECIMAL(5,2) atau (a, b)) tidak memisahkan klausa ALTER
+    depth = 0
+    clause = []
+    clauses = []
+    for char in match.group(2):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            clauses.append(''.join(clause).strip())
+            clause = []
+        else:
+            clause.append(char)
+    clauses.append(''.join(clause).strip())
+    for clause in clauses:
+        for kind, pattern in (('column', MIGRATION_ADD_COLUMN_RE), ('index', MIGRATION_ADD_KEY_RE), ('constraint', MIGRATION_ADD_CONSTRAINT_RE)):
+            clause_match = pattern.match(clause)
+            if clause_match:
+                objects.append((kind, table, clause_match.group(1)))
+                break
+        else:
+            return None
+    return objects
+
+def applied_migrations(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version VARCHAR(20) PRIMARY KEY, name VARCHAR(255) NOT NULL, checksum CHAR(40) NOT NULL, "
+        "applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+    )
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+def migration_progress(cursor):
+    # Jumlah statement yang sudah selesai dari migrasi yang gagal di tengah jalan, per versi
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migration_progress ("
+        "version VARCHAR(20) PRIMARY KEY, checksum CHAR(40) NOT NULL, statements_done INT NOT NULL, "
+        "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)"
+    )
+    cursor.execute("SELECT version, checksum, statements_done FROM schema_migration_progress")
+    return {version: (checksum, statements_done) for version, checksum, statements_done in cursor.fetchall()}
+
+def run_migration_statement(cursor, migration, index, statement):
+    # CREATE INDEX / ALTER TABLE ... ADD dilewati hanya jika semua objek yang dibuatnya sudah ada di
+    # information_schema (database yang dibuat dari skema gabungan lama). Selain itu statement dijalankan
+    # dan error apa pun, termasuk nama duplikat, menggagalkan migrasi.
+    objects = migration_statement_objects(statement)
+    if objects and all(migration_object_exists(cursor, *obj) for obj in objects):
+        names = ', '.join(name for _, _, name in objects)
+        print(f"Peringatan: Statement {index + 1} migrasi {migration['filename']} dilewati karena sudah diterapkan: {names} sudah ada.")
+        return
+    cursor.execute(statement)
+
+def run_migrations(conn, folder=MIGRATIONS_FOLDER):
+    # Menjalankan migrasi yang belum tercatat di schema_migrations, berurutan. GET_LOCK mencegah dua proses
+    # aplikasi yang start bersamaan menjalankan migrasi yang sama. DDL MySQL auto-commit, jadi setiap statement
+    # yang selesai dicatat di schema_migration_progress; migrasi yang gagal di tengah jalan dilanjutkan dari
+    # statement berikutnya saat dijalankan ulang. Statement yang objeknya sudah ada (dari database yang dibuat
+    # sebelum migrasi dipecah) dilewati dengan peringatan, lihat run_migration_statement.
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK('schema_migrations', %s)", (MIGRATION_LOCK_TIMEOUT_SECONDS,))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Gagal mendapatkan lock migrasi (schema_migrations).")
+        try:
+            applied = applied_migrations(cursor)
+            progress = migration_progress(cursor)
+            newly_applied = []
+            for migration in load_migrations(folder):
+                version = migration['version']
+                if version in applied:
+                    if applied[version] != migration['checksum']:
+                        print(f"Peringatan: Migrasi {migration['filename']} sudah dijalankan tetapi isinya berubah sejak itu.")
+                    continue
+                statements_done = 0
+                if version in progress:
+                    checksum, statements_done = progress[version]
+                    if checksum != migration['checksum']:
+                        print(f"Peringatan: Migrasi {migration['filename']} berubah sejak gagal di statement {statements_done + 1}; dijalankan ulang dari awal.")
+                        statements_done = 0
+                    else:
+                        print(f"DEBUG: Melanjutkan migrasi {migration['filename']} dari statement {statements_done + 1}.")
+                statements = split_sql_statements(migration['sql'])
+                for index in range(statements_done, len(statements)):
+                    run_migration_statement(cursor, migration, index, statements[index])
+                    cursor.execute(
+                        "INSERT INTO schema_migration_progress (version, checksum, statements_done) VALUES (%s, %s, %s) "
+                        "ON DUPLICATE KEY UPDATE checksum = VALUES(checksum), statements_done = VALUES(statements_done)",
+                        (version, migration['checksum'], index + 1)
+                    )
+                    conn.commit()
+                cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                               (version, migration['name'], migration['checksum']))
+                cursor.execute("DELETE FROM schema_migration_progress WHERE version = %s", (version,))
+                conn.commit()
+                newly_applied.append(migration['filename'])
+                print(f"DEBUG: Migrasi {migration['filename']} berhasil dijalankan.")
+            return newly_applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('schema_migrations')")
+            cursor.fetchone()
+    finally:
+        cursor.close()
 
 def init_db_mysql():
     conn = None
@@ -73,31 +392,20 @@ def init_db_mysql():
             print(f"DEBUG: Database '{MYSQL_CONFIG['database']}' dipastikan ada.")
         except mysql.connector.Error as err:
             print(f"Error saat membuat database: {err}")
+        cursor.close()
 
         conn.database = MYSQL_CONFIG['database']
         
-        schema_path = os.path.join(app.root_path, 'schema.sql')
-        if not os.path.exists(schema_path):
-            print(f"Error: schema.sql tidak ditemukan di {schema_path}. Pastikan file ini ada di root proyek.")
+        if not os.path.isdir(MIGRATIONS_FOLDER):
+            print(f"Error: Folder migrasi tidak ditemukan di {MIGRATIONS_FOLDER}. Pastikan folder ini ada di root proyek.")
             return
 
-        with open(schema_path, mode='r') as f:
-            sql_script = f.read()
-            commands = [cmd.strip() for cmd in sql_script.split(';') if cmd.strip()]
-            for command in commands:
-                if command:
-                    try:
-                        cursor.execute(command)
-                    except mysql.connector.Error as err:
-                        if "table exists" not in str(err).lower() and "already exists" not in str(err).lower():
-                            print(f"Error saat menjalankan perintah SQL: {command}\nError: {err}")
-            conn.commit()
-        print("DEBUG: Tabel database MySQL berhasil diinisialisasi dari schema.sql.")
-    except mysql.connector.Error as err:
+        newly_applied = run_migrations(conn)
+        print(f"DEBUG: Skema database MySQL up to date ({len(newly_applied)} migrasi baru dijalankan).")
+    except (mysql.connector.Error, RuntimeError, ValueError) as err:
         print(f"Error saat inisialisasi database MySQL: {err}")
     finally:
         if conn and conn.is_connected():
-            cursor.close()
             conn.close()
 
 
@@ -118,6 +426,9 @@ def setup_database_and_admin():
                 print(f"Gagal membuat file placeholder {path}: {e}")
 
     init_db_mysql()
+    ai_job_runner.recover()
+    ai_job_runner.start_maintenance()
+    ollama_dispatcher.start_keep_alive()
 
     conn = None
     cursor = None
@@ -186,116 +497,350 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+QUESTION_INDEX_TTL_SECONDS = float(os.getenv('QUESTION_INDEX_TTL_SECONDS', 60))
+
+class QuestionSampler:
+    # Pengganti ORDER BY RAND(): menyimpan indeks id soal per level di memori lalu memilih N id acak
+    # dalam O(N) dan mengambil barisnya lewat primary key. Indeks dibuang saat bank soal berubah
+    # (add/edit/delete/impor) dan juga kedaluwarsa setelah TTL agar perubahan dari worker lain ikut terlihat.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._index = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def invalidate(self, level=None):
+        with self._lock:
+            if level is None:
+                self._index.clear()
+            else:
+                self._index.pop(level, None)
+            self._stats['invalidations'] += 1
+
+    def _level_ids(self, db, level):
+        with self._lock:
+            entry = self._index.get(level)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._stats['index_hits'] += 1
+                return entry[0]
+            self._stats['index_loads'] += 1
+
+        cursor = db.cursor()
+        try:
+            cursor.execute("SELECT id FROM quiz_questions WHERE level = %s", (level,))
+            ids = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        with self._lock:
+            self._index[level] = (ids, time.monotonic())
+        print(f"DEBUG: Indeks soal level {level} dimuat ulang: {len(ids)} soal.")
+        return ids
+
+    def sample(self, db, level, num_questions, columns="question, options, correct_answer"):
+        for attempt in range(2):
+            ids = self._level_ids(db, level)
+            chosen_ids = random.sample(ids, min(num_questions, len(ids)))
+            if not chosen_ids:
+                return []
+
+            cursor = db.cursor(dictionary=True)
+            try:
+                placeholders = ', '.join(['%s'] * len(chosen_ids))
+                cursor.execute(f"SELECT id, {columns} FROM quiz_questions WHERE id IN ({placeholders})", tuple(chosen_ids))
+                rows_by_id = {row['id']: row for row in cursor.fetchall()}
+            finally:
+                cursor.close()
+
+            if len(rows_by_id) == len(chosen_ids) or attempt == 1:
+                return [rows_by_id[qid] for qid in chosen_ids if qid in rows_by_id]
+            # Sebagian id sudah dihapus (mis. oleh worker lain); muat ulang indeks dan coba sekali lagi.
+            with self._lock:
+                self._stats['stale_index_retries'] += 1
+            self.invalidate(level)
+        return []
+
+    def stats(self):
+        with self._lock:
+            levels = {level: len(entry[0]) for level, entry in self._index.items()}
+            return dict(self._stats, cached_levels=levels)
+
+question_sampler = QuestionSampler(QUESTION_INDEX_TTL_SECONDS)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# NEW: Function to import questions from CSV to quiz_questions table
-def import_questions_from_csv_to_db(filepath, level_context=None):
-    imported_count = 0
-    try:
-        df = pd.read_csv(filepath, sep=';', engine='python')
-        required_columns = ['TOPIK', 'SOAL', 'OPSI_A', 'OPSI_B', 'OPSI_C', 'OPSI_D', 'JAWABAN']
-        
-        if not all(col in df.columns for col in required_columns):
-            print(f"Error: CSV file {filepath} does not have required columns: {required_columns}.")
-            return 0
-
-        db = get_db()
-        cursor = db.cursor()
-        
-        # Determine level for the imported questions
-        level_to_import = level_context if level_context else "Unknown"
-        # Try to infer level from filename (e.g., "SD_100.csv" -> "SD")
-        filename_only = os.path.basename(filepath)
-        match_level_in_filename = re.match(r'([A-Za-z]+)_', filename_only)
-        if match_level_in_filename:
-            level_to_import = match_level_in_filename.group(1).upper()
-            if level_to_import not in ['SD', 'SMP', 'SMA']: # Only allow predefined levels
-                level_to_import = "Unknown"
-        
-        # Clear existing questions for this level before importing to prevent duplicates if re-importing
-        # You might want to refine this: e.g., delete only questions from this specific dataset, not all
-        cursor.execute("DELETE FROM quiz_questions WHERE level = %s", (level_to_import,))
-        db.commit()
-        print(f"DEBUG: Menghapus soal lama untuk level {level_to_import} sebelum mengimpor dari {filepath}.")
+QUESTION_CSV_COLUMNS = ['TOPIK', 'SOAL', 'OPSI_A', 'OPSI_B', 'OPSI_C', 'OPSI_D', 'JAWABAN']
+QUESTION_OPTION_COLUMNS = ['OPSI_A', 'OPSI_B', 'OPSI_C', 'OPSI_D']
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 500))
+IMPORT_REJECTED_REPORT_LIMIT = 100
+
+def read_question_csv(source, chunk_size=None):
+    reader = pd.read_csv(source, sep=';', dtype=str, keep_default_na=False, encoding='utf-8-sig', chunksize=chunk_size)
+    if chunk_size is None:
+        return _strip_csv_header(reader)
+    return (_strip_csv_header(chunk) for chunk in reader)
+
+def _strip_csv_header(df):
+    # Beberapa dataset (mis. SMA_100.csv) punya spasi di nama kolom header.
+    df.columns = [str(col).strip() for col in df.columns]
+    return df
+
+class TeeUploadStream:
+    # Membungkus stream unggahan: setiap blok yang dibaca parser CSV sekaligus ditulis ke file tujuan,
+    # sehingga file disimpan dan diimpor dalam satu kali baca tanpa memuat seluruh isi ke memori.
+    def __init__(self, stream, destination, block_size=1024 * 1024):
+        self.stream = stream
+        self.destination = destination
+        self.block_size = block_size
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.destination.write(data)
+            self.bytes_read += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def drain(self):
+        # Salin sisa stream (mis. jika impor berhenti lebih awal) agar file yang tersimpan tetap utuh.
+        while self.read(self.block_size):
+            pass
+        return self.bytes_read
+
+def validate_question_frame(df, first_row_number=2):
+    # Validasi tervektorisasi untuk seluruh frame: tidak ada kolom kosong dan jawaban harus salah satu dari
+    # empat opsi. JAWABAN boleh berupa teks opsi atau huruf A-D (format dataset bawaan).
+    fields = df[QUESTION_CSV_COLUMNS[1:]].apply(lambda col: col.astype(str).str.strip())
+    options = fields[QUESTION_OPTION_COLUMNS]
+
+    correct_answer = fields['JAWABAN'].copy()
+    literal_match = options.eq(correct_answer, axis=0).any(axis=1)
+    answer_letter = correct_answer.str.upper()
+    for letter, column in zip('ABCD', QUESTION_OPTION_COLUMNS):
+        letter_mask = ~literal_match & (answer_letter == letter)
+        correct_answer[letter_mask] = options.loc[letter_mask, column]
+
+    empty_fields = fields == ''
+    has_empty = empty_fields.any(axis=1)
+    answer_in_options = options.eq(correct_answer, axis=0).any(axis=1)
+    valid_mask = ~has_empty & answer_in_options
+
+    valid = pd.DataFrame({
+        'row': first_row_number + valid_mask.to_numpy().nonzero()[0],
+        'question': fields.loc[valid_mask, 'SOAL'],
+        'options': options.loc[valid_mask].values.tolist(),
+        'correct_answer': correct_answer[valid_mask],
+    })
+
+    rejected_positions = (~valid_mask).to_numpy().nonzero()[0]
+    rejected = []
+    for position in rejected_positions[:IMPORT_REJECTED_REPORT_LIMIT]:
+        if has_empty.iloc[position]:
+            empty_columns = [col for col in empty_fields.columns if empty_fields.iloc[position][col]]
+            reason = f"kolom kosong: {', '.join(empty_columns)}"
+        else:
+            reason = f"jawaban '{fields['JAWABAN'].iloc[position]}' tidak ada di opsi"
+        rejected.append({'row': first_row_number + int(position), 'reason': reason})
+    return valid, rejected, len(rejected_positions)
+
+def infer_dataset_level(filepath, level_context=None):
+    level_to_import = level_context if level_context else "Unknown"
+    # Try to infer level from filename (e.g., "SD_100.csv" -> "SD")
+    filename_only = os.path.basename(filepath)
+    match_level_in_filename = re.match(r'([A-Za-z]+)_', filename_only)
+    if match_level_in_filename:
+        level_to_import = match_level_in_filename.group(1).upper()
+        if level_to_import not in ['SD', 'SMP', 'SMA']: # Only allow predefined levels
+            level_to_import = "Unknown"
+    return level_to_import
+
+def question_source_key(question):
+    return hashlib.sha1(question.encode('utf-8')).hexdigest()
+
+def question_content_hash(level, question, options_list, correct_answer):
+    content = json.dumps([level, question, options_list, correct_answer], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def import_questions_from_csv_to_db(source, dataset_id, level_context=None, source_name=None):
+    # Impor ulang inkremental dan idempoten secara streaming: CSV dibaca per chunk IMPORT_CHUNK_SIZE baris
+    # (dari path file atau stream unggahan) dan divalidasi secara tervektorisasi. Setiap soal diidentifikasi
+    # oleh (dataset_id, source_key) dan diberi cap import_gen milik impor ini; perbandingan dengan isi lama
+    # dilakukan per chunk di database, sehingga memori tetap sebesar satu chunk berapa pun ukuran dataset.
+    # Setiap chunk di-commit sendiri (kuis yang berjalan melihat campuran soal lama dan baru, tidak pernah
+    # level yang kosong). Setelah chunk terakhir, soal dataset tanpa cap impor ini (hilang dari file, juga
+    # untuk file yang hanya berisi header) dihapus. Impor yang gagal di tengah tidak menghapus apa pun;
+    # menjalankannya ulang akan menyelesaikannya. Soal dengan teks yang sama dalam satu file (source_key
+    # sama) hanya diimpor sekali; kemunculan berikutnya dilaporkan sebagai baris yang ditolak.
+    # Mengembalikan laporan berisi jumlah soal per status dan baris yang ditolak beserta alasannya.
+    source_name = source_name or (source if isinstance(source, str) else 'upload')
+    report = {'imported': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0,
+              'rejected': 0, 'rejected_rows': [], 'chunks': 0, 'level': None, 'error': None}
+    level_to_import = infer_dataset_level(source_name, level_context)
+    report['level'] = level_to_import
+    import_gen = uuid.uuid4().hex
+    db = None
+    cursor = None
 
+    def reject_duplicate(row_number, first_row_number):
+        report['rejected'] += 1
+        if len(report['rejected_rows']) < IMPORT_REJECTED_REPORT_LIMIT:
+            report['rejected_rows'].append({'row': int(row_number), 'reason': f"soal duplikat dari baris {first_row_number}"})
 
-        for index, row in df.iterrows():
-            try:
-                question = str(row['SOAL']).strip()
-                options_list = [
-                    str(row['OPSI_A']).strip(),
-                    str(row['OPSI_B']).strip(),
-                    str(row['OPSI_C']).strip(),
-                    str(row['OPSI_D']).strip()
-                ]
-                correct_answer = str(row['JAWABAN']).strip()
-
-                if not question or not options_list or len(options_list) != 4 or not correct_answer or correct_answer not in options_list:
-                    print(f"Warning: Baris {index+1} di CSV {filepath} dilewati karena data tidak lengkap atau tidak valid.")
+    try:
+        next_row_number = 2
+        # pandas menghasilkan satu chunk kosong untuk file yang hanya berisi header, sehingga header tetap
+        # diperiksa dan soal lama tetap dihapus
+        for chunk_df in read_question_csv(source, chunk_size=IMPORT_CHUNK_SIZE):
+            if cursor is None:
+                missing_columns = [col for col in QUESTION_CSV_COLUMNS if col not in chunk_df.columns]
+                if missing_columns:
+                    report['error'] = f"kolom wajib tidak ditemukan: {', '.join(missing_columns)}"
+                    print(f"Error: CSV file {source_name} does not have required columns: {QUESTION_CSV_COLUMNS}.")
+                    return report
+
+                db = get_db()
+                cursor = db.cursor()
+
+            valid, rejected_rows, rejected_count = validate_question_frame(chunk_df, first_row_number=next_row_number)
+            next_row_number += len(chunk_df)
+            report['rejected'] += rejected_count
+            report['rejected_rows'].extend(rejected_rows[:IMPORT_REJECTED_REPORT_LIMIT - len(report['rejected_rows'])])
+
+            chunk_questions = {}
+            for row_number, question, options_list, correct_answer in zip(valid['row'], valid['question'], valid['options'], valid['correct_answer']):
+                source_key = question_source_key(question)
+                if source_key in chunk_questions:
+                    reject_duplicate(row_number, chunk_questions[source_key][0])
                     continue
+                chunk_questions[source_key] = (int(row_number), question, options_list, correct_answer)
 
-                options_json = json.dumps(options_list)
-                
+            if chunk_questions:
+                placeholders = ', '.join(['%s'] * len(chunk_questions))
                 cursor.execute(
-                    "INSERT INTO quiz_questions (level, question, options, correct_answer) VALUES (%s, %s, %s, %s)",
-                    (level_to_import, question, options_json, correct_answer)
+                    "SELECT source_key, content_hash, import_gen, import_row FROM quiz_questions "
+                    f"WHERE dataset_id = %s AND source_key IN ({placeholders})",
+                    (dataset_id, *chunk_questions)
                 )
-                imported_count += 1
-            except Exception as row_e:
-                print(f"Error memproses baris {index+1} dari {filepath}: {row_e}")
-        
-        db.commit()
-        print(f"DEBUG: Berhasil mengimpor {imported_count} soal dari {filepath} ke quiz_questions.")
+                existing = {source_key: (content_hash, gen, row) for source_key, content_hash, gen, row in cursor.fetchall()}
+
+                rows = []
+                for source_key, (row_number, question, options_list, correct_answer) in chunk_questions.items():
+                    content_hash = question_content_hash(level_to_import, question, options_list, correct_answer)
+                    previous_hash, previous_gen, previous_row = existing.get(source_key, (None, None, None))
+                    if previous_gen == import_gen:
+                        # Sudah diimpor dari chunk sebelumnya di file yang sama
+                        reject_duplicate(row_number, previous_row)
+                        continue
+                    if previous_hash == content_hash:
+                        report['unchanged'] += 1
+                    else:
+                        report['updated' if previous_hash else 'inserted'] += 1
+                    rows.append((level_to_import, question, json.dumps(options_list), correct_answer, dataset_id,
+                                 source_key, content_hash, import_gen, row_number))
+
+                if rows:
+                    # Soal yang tidak berubah tetap di-upsert agar mendapat cap import_gen impor ini
+                    cursor.executemany(
+                        "INSERT INTO quiz_questions (level, question, options, correct_answer, dataset_id, source_key, content_hash, import_gen, import_row) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                        "ON DUPLICATE KEY UPDATE level = VALUES(level), question = VALUES(question), options = VALUES(options), "
+                        "correct_answer = VALUES(correct_answer), content_hash = VALUES(content_hash), "
+                        "import_gen = VALUES(import_gen), import_row = VALUES(import_row)",
+                        rows
+                    )
+                db.commit()
+            report['chunks'] += 1
+            print(f"DEBUG: Impor {source_name}: chunk {report['chunks']} selesai, {report['inserted']} baru, {report['updated']} berubah, {report['unchanged']} tetap, {report['rejected']} baris ditolak.")
+
+        if cursor is not None:
+            # <=> agar soal dari sebelum kolom import_gen ada (NULL) juga ikut dihapus
+            cursor.execute("DELETE FROM quiz_questions WHERE dataset_id = %s AND NOT (import_gen <=> %s)", (dataset_id, import_gen))
+            report['deleted'] = cursor.rowcount
+            db.commit()
+            question_sampler.invalidate(level_to_import)
+            few_shot_selector.invalidate(level_to_import)
+
+        report['imported'] = report['inserted'] + report['updated'] + report['unchanged']
+        report['rejected_rows'].sort(key=lambda item: item['row'])
+        if report['rejected']:
+            print(f"Warning: {report['rejected']} baris di CSV {source_name} ditolak karena data tidak lengkap, tidak valid, atau duplikat.")
+        print(f"DEBUG: Impor {source_name} selesai: {report['inserted']} baru, {report['updated']} berubah, {report['unchanged']} tetap, {report['deleted']} dihapus.")
         
     except Exception as e:
-        print(f"Error importing CSV {filepath} to DB: {e}")
-        db.rollback()
+        print(f"Error importing CSV {source_name} to DB: {e}")
+        report['error'] = str(e)
+        report['imported'] = 0
+        if db:
+            db.rollback()
+            # Chunk yang sudah di-commit tetap tersimpan; cache level harus melihatnya
+            question_sampler.invalidate(level_to_import)
+            few_shot_selector.invalidate(level_to_import)
     finally:
-        cursor.close()
-    return imported_count
-
+        if cursor:
+            cursor.close()
+    return report
+
+def format_few_shot_example(question, options_list, correct_answer):
+    return (
+        f'{{"question": {json.dumps(question)}, '
+        f'"options": [{json.dumps(options_list[0])}, {json.dumps(options_list[1])}, {json.dumps(options_list[2])}, {json.dumps(options_list[3])}], '
+        f'"correct_answer": {json.dumps(correct_answer)}}}'
+    )
+
+class DatasetCache:
+    # Cache CSV dataset bawaan (DATASETS) dengan kunci path + mtime. Baris yang sudah divalidasi disimpan
+    # sebagai tuple ringkas (soal, (opsi A-D), jawaban), sehingga sampling few-shot tidak perlu mem-parse
+    # ulang file. File yang berubah di disk otomatis dimuat ulang pada akses berikutnya.
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def rows(self, path):
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == version:
+            self._stats['hits'] += 1
+            return entry[1]
+
+        self._stats['misses'] += 1
+        df = read_question_csv(path)
+        missing_columns = [col for col in QUESTION_CSV_COLUMNS if col not in df.columns]
+        if missing_columns:
+            print(f"Peringatan: Dataset CSV {path} tidak memiliki kolom yang diperlukan: {QUESTION_CSV_COLUMNS}. Kolom yang ada: {df.columns.tolist()}")
+            rows = ()
+        else:
+            valid, _, rejected_count = validate_question_frame(df)
+            rows = tuple(zip(valid['question'], map(tuple, valid['options']), valid['correct_answer']))
+            print(f"DEBUG: Dataset CSV {path} dimuat ke cache: {len(rows)} soal valid, {rejected_count} ditolak.")
+        with self._lock:
+            self._entries[path] = (version, rows)
+        return rows
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+            self._stats['invalidations'] += 1
 
-def get_sample_questions_from_csv(level, num_samples=1):
-    file_path = DATASETS.get(level)
-    if not file_path or not os.path.exists(file_path):
-        print(f"Peringatan: Dataset CSV default {level} tidak ditemukan di {file_path}")
-        return ""
+    def sample(self, path, num_samples):
+        rows = self.rows(path)
+        return random.sample(rows, min(num_samples, len(rows)))
 
-    try:
-        df = pd.read_csv(file_path, sep=';', engine='python')
-        if df.empty:
-            print(f"Peringatan: Dataset CSV default {level} kosong.")
-            return ""
-
-        required_columns = ['TOPIK', 'SOAL', 'OPSI_A', 'OPSI_B', 'OPSI_C', 'OPSI_D', 'JAWABAN']
-        if not all(col in df.columns for col in required_columns):
-            print(f"Peringatan: Dataset CSV default {level} tidak memiliki kolom yang diperlukan: {required_columns}. Kolom yang ada: {df.columns.tolist()}")
-            return ""
-
-        sample_df = df.sample(min(num_samples, len(df)))
-
-        samples = []
-        for index, row in sample_df.iterrows():
-            question = str(row['SOAL']).strip()
-            options_list = [
-                str(row['OPSI_A']).strip(),
-                str(row['OPSI_B']).strip(),
-                str(row['OPSI_C']).strip(),
-                str(row['OPSI_D']).strip()
-            ]
-            correct_answer_text = str(row['JAWABAN']).strip()
+    def stats(self):
+        with self._lock:
+            cached_files = {path: len(entry[1]) for path, entry in self._entries.items()}
+        return dict(self._stats, cached_files=cached_files)
 
-            samples.append(
-                f'{{"question": {json.dumps(question)}, '
-                f'"options": [{json.dumps(options_list[0])}, {json.dumps(options_list[1])}, {json.dumps(options_list[2])}, {json.dumps(options_list[3])}], '
-                f'"correct_answer": {json.dumps(correct_answer_text)}}}'
-            )
-        return "\n".join(samples)
-    except Exception as e:
-        print(f"Error saat mengambil sampel dari {file_path}: {e}")
-        return ""
+dataset_cache = DatasetCache()
 
 def fix_json_string(json_str):
     json_str = json_str.strip()
@@ -358,230 +903,599 @@ def fix_json_string(json_str):
         
     return json_str
 
-def calculate_correct_answer_and_options(question_text, ai_options, ai_correct_answer):
-    original_question_text = question_text
-    question_text_lower = question_text.lower()
-    calculated_answer = None
-    question_type = "unknown"
+NUM_WORD_MAP = {
+    'satu': 1, 'dua': 2, 'tiga': 3, 'empat': 4, 'lima': 5,
+    'enam': 6, 'tujuh': 7, 'delapan': 8, 'sembilan': 9, 'sepuluh': 10
+}
 
-    cleaned_question_for_eval = question_text_lower.replace('x', '*').replace(':', '/')
-    cleaned_question_for_eval = re.sub(r'(hasil dari|berapakah|adalah|=|\s*cm\^?\d*|\s*gram|\s*menit|\s*bulan|\s*tahun|\s*hari|\s*detik|\s*cm)', '', cleaned_question_for_eval).strip()
-    
-    def evaluate_sqrt_in_string(match):
-        num = float(match.group(1))
-        return str(math.sqrt(num))
-    
-    cleaned_question_for_eval = re.sub(r'akar kuadrat dari\s*(\d+)', evaluate_sqrt_in_string, cleaned_question_for_eval)
-    cleaned_question_for_eval = re.sub(r'sqrt\((\d+)\)', evaluate_sqrt_in_string, cleaned_question_for_eval)
+WORD_TO_NUM_MAP = {
+    "seratusan": 100, "duaratusan": 200, "limaratusan": 500,
+    "seribuan": 1000, "duaribuan": 2000, "limaribuan": 5000,
+    "enamribuan": 6000, "sepuluhribuan": 10000
+}
 
-    cleaned_question_for_eval = re.sub(r'(\d+)\s*pangkat\s*(\d+)', r'(\1**\2)', cleaned_question_for_eval)
+DEFINITION_MAP = {
+    "satuan suhu": "celcius",
+    "satuan berat baku": "kilogram",
+    "nilai tengah urut": "median",
+    "nilai tengah dari data yang sudah diurutkan": "median",
+    "perubahan waktu": "durasi",
+    "urutan bulan": "januari februari maret",
+    "diagram batang": "batang",
+    "diagram gambar": "piktogram",
+    "ukur panjang": "penggaris",
+    "lambang seratus tujuh": "107"
+}
 
-    cleaned_question_for_eval = re.sub(r'(\d+)\s*per\s*(\d+)', r'(\1/\2)', cleaned_question_for_eval)
+KNOWN_RELEVANT_OPTIONS = {
+    "satuan suhu": ["celcius", "fahrenheit", "kelvin", "reamur"],
+    "satuan berat baku": ["kilogram", "gram", "ton", "kuintal"],
+    "nilai tempat": ["satuan", "puluhan", "ratusan", "ribuan"],
+    "nilai tengah urut": ["rata-rata", "median", "modus", "jangkauan"],
+    "nilai tengah dari data yang sudah diurutkan": ["rata-rata", "median", "modus", "jangkauan"],
+    "perubahan waktu": ["durasi", "interval", "periode", "waktu"],
+    "urutan bulan": ["januari februari maret", "april mei juni", "juli agustus september", "oktober november desember"],
+    "diagram batang": ["batang", "garis", "lingkaran", "piktogram"],
+    "diagram gambar": ["piktogram", "garis", "lingkaran", "batang"],
+    "ukur panjang": ["penggaris", "meteran", "timbangan", "jam", "gelas ukur"],
+    "lambang seratus tujuh": ["107", "1007", "170", "701"],
+    "1/2 ... 0,5 =": ["=", ">", "<", "!="],
+}
 
-    match_x_y_an_eval = re.search(r'(satu|dua|tiga|empat|lima|enam|tujuh|delapan|sembilan|sepuluh)\s*(\d+)-an', cleaned_question_for_eval)
-    if match_x_y_an_eval:
-        num_word_map = {
-            'satu': 1, 'dua': 2, 'tiga': 3, 'empat': 4, 'lima': 5,
-            'enam': 6, 'tujuh': 7, 'delapan': 8, 'sembilan': 9, 'sepuluh': 10
-        }
-        multiplier = num_word_map.get(match_x_y_an_eval.group(1))
-        base_num = int(match_x_y_an_eval.group(2))
-        if multiplier is not None:
-            numeric_result = multiplier * base_num
-            calculated_answer = str(numeric_result)
-            question_type = "numeric"
-
-    if re.search(r'\b\d+\b.*[+\-]\b\d+\b', cleaned_question_for_eval) and not calculated_answer:
-        numeric_parts = re.findall(r'\d+', cleaned_question_for_eval)
-        operators = re.findall(r'[+\-]', cleaned_question_for_eval)
-        if len(numeric_parts) >= 2 and len(operators) >= 1:
-            try:
-                temp_eval_str = numeric_parts[0]
-                for i in range(len(operators)):
-                    temp_eval_str += operators[i] + numeric_parts[i+1]
-                cleaned_question_for_eval = temp_eval_str
-                question_type = "numeric"
-            except Exception as e:
-                print(f"DEBUG: Error building temp_eval_str: {e}")
+PLACE_NAMES = ["satuan", "puluhan", "ratusan", "ribuan", "puluh ribuan"]
+
+NUMERIC_OPTION_RE = re.compile(r'-?\d+(\.\d+)?|\d+/\d+')
+X_Y_AN_PATTERN = r'(satu|dua|tiga|empat|lima|enam|tujuh|delapan|sembilan|sepuluh)\s*(\d+)-an'
+
+ARITHMETIC_PARSE_CACHE_SIZE = int(os.getenv('ARITHMETIC_PARSE_CACHE_SIZE', '4096'))
+ARITHMETIC_MAX_EXPONENT = int(os.getenv('ARITHMETIC_MAX_EXPONENT', '100'))
+
+ARITHMETIC_TOKEN_RE = re.compile(
+    r'\s*(?:'
+    r'(?P<term>\d+(?:[.,]\d+)?(?!x(?=\s*[\d(]))(?!(?:cm|mm|km|gram|kg|menit|detik|jam|hari|bulan|tahun|liter|ml)(?![a-z]))[a-z]+)'
+    r'|(?P<num>\d+(?:[.,]\d+)?)'
+    r'|(?P<unit>(?:cm|mm|km)(?:\^\d+|[²³])?(?![a-z])|(?:gram|kg|menit|detik|jam|hari|bulan|tahun|liter|ml)(?![a-z]))'
+    r'|(?P<sqrt>(?:akar kuadrat dari|akar pangkat dua dari|akar|sqrt)(?![a-z])|√)'
+    r'|(?P<word_op>pangkat|per)(?![a-z])'
+    r'|(?P<ratio>(?<=\d):(?=\s*\d))'
+    r'|(?P<op>\*\*|x(?=\s*(?:[\d(√]|akar|sqrt))|[-+×*:/÷^()])'
+    r'|(?P<sep>[a-z]+|\S)'
+    r')'
+)
+ARITHMETIC_OPERATORS = {
+    'x': '*', '×': '*', '*': '*', ':': '/', '÷': '/', '/': 'per',
+    '**': '^', '^': '^', 'pangkat': '^', 'per': 'per',
+    '+': '+', '-': '-', '(': '(', ')': ')'
+}
 
+def tokenize_arithmetic(question_text_lower):
+    # Pecah kalimat soal menjadi segmen token aritmetika. Kata lain (dan '=', '?', '...') memisahkan segmen,
+    # sedangkan satuan seperti cm/gram/menit dilewati agar "5 cm + 3 cm" tetap satu ekspresi. 'x' hanya
+    # dianggap perkalian bila diikuti angka/kurung/akar (bukan variabel seperti "3x - 7"), suku aljabar atau
+    # imajiner seperti "7p"/"3i" memutus segmen, dan ':' yang menempel pada angka sebelumnya ("1:200", "1: 5")
+    # dibaca sebagai rasio; pembagian ditulis dengan spasi sebelum ':' ("15 : 3").
+    segments = [[]]
+    for match in ARITHMETIC_TOKEN_RE.finditer(question_text_lower):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'num':
+            segments[-1].append(('num', Fraction(value.replace(',', '.'))))
+        elif kind == 'sqrt':
+            segments[-1].append(('sqrt', None))
+        elif kind in ('op', 'word_op'):
+            segments[-1].append(('op', ARITHMETIC_OPERATORS[value]))
+        elif kind in ('sep', 'term', 'ratio') and segments[-1]:
+            segments.append([])
+    return [segment for segment in segments if segment]
+
+class ArithmeticParser:
+    # Recursive descent dengan presedensi: +,- < x,: < unary minus < per (a/b) < pangkat < akar/kurung.
+    # '/' dibaca sebagai pecahan seperti "per" (4/5 : 2/5 = 2), sedangkan ':' adalah pembagian biasa.
+    # Pangkat lebih kuat dari '/', sehingga "2 ^ 6 / 2" = (2^6)/2 = 32.
+    # Menghasilkan AST tuple, misal ('sub', ('mul', 5, 6), ('div', 15, 3)) untuk "5 x 6 - 15 : 3".
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def parse(self):
+        node = self.expression()
+        if self.pos != len(self.tokens):
+            raise ValueError("Token sisa setelah ekspresi.")
+        return node
+
+    def peek_op(self, *ops):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == 'op' and self.tokens[self.pos][1] in ops:
+            self.pos += 1
+            return self.tokens[self.pos - 1][1]
+        return None
+
+    def expression(self):
+        node = self.term()
+        while True:
+            op = self.peek_op('+', '-')
+            if op is None:
+                return node
+            node = ('add' if op == '+' else 'sub', node, self.term())
+
+    def term(self):
+        node = self.unary()
+        while True:
+            op = self.peek_op('*', '/')
+            if op is None:
+                return node
+            node = ('mul' if op == '*' else 'div', node, self.unary())
+
+    def unary(self):
+        op = self.peek_op('+', '-')
+        if op == '-':
+            return ('neg', self.unary())
+        if op == '+':
+            return self.unary()
+        return self.ratio()
+
+    def ratio(self):
+        node = self.power()
+        while self.peek_op('per'):
+            node = ('div', node, self.power())
+        return node
+
+    def power(self):
+        node = self.primary()
+        if self.peek_op('^'):
+            node = ('pow', node, self.exponent())
+        return node
+
+    def exponent(self):
+        # Pangkat hanya mengambil bilangan bertanda berikutnya (asosiatif kanan), bukan "6 / 2" seluruhnya
+        op = self.peek_op('+', '-')
+        if op == '-':
+            return ('neg', self.exponent())
+        if op == '+':
+            return self.exponent()
+        return self.power()
+
+    def primary(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError("Ekspresi terpotong.")
+        kind, value = self.tokens[self.pos]
+        if kind == 'num':
+            self.pos += 1
+            return ('num', value)
+        if kind == 'sqrt':
+            self.pos += 1
+            return ('sqrt', self.primary())
+        if self.peek_op('('):
+            node = self.expression()
+            if not self.peek_op(')'):
+                raise ValueError("Kurung tidak ditutup.")
+            return node
+        raise ValueError(f"Token tidak terduga: {value}")
+
+@lru_cache(maxsize=ARITHMETIC_PARSE_CACHE_SIZE)
+def parse_arithmetic_question(question_text_lower):
+    # Ambil segmen pertama yang berupa operasi (bukan angka tunggal) dan berhasil di-parse. Hasil (termasuk
+    # None untuk soal non-aritmetika) di-cache per teks soal.
+    for segment in tokenize_arithmetic(question_text_lower):
+        if not any(kind == 'num' for kind, _ in segment):
+            continue
+        try:
+            node = ArithmeticParser(segment).parse()
+        except ValueError:
+            continue
+        if node[0] == 'num' or (node[0] == 'neg' and node[1][0] == 'num'):
+            continue
+        return node
+    return None
+
+def evaluate_arithmetic(node):
+    kind = node[0]
+    if kind == 'num':
+        return node[1]
+    if kind == 'neg':
+        return -evaluate_arithmetic(node[1])
+    if kind == 'sqrt':
+        value = evaluate_arithmetic(node[1])
+        if value < 0:
+            raise ValueError("Akar dari bilangan negatif.")
+        numerator_root, denominator_root = math.isqrt(value.numerator), math.isqrt(value.denominator)
+        if numerator_root ** 2 != value.numerator or denominator_root ** 2 != value.denominator:
+            # Hasil irasional (mis. √75 = 5√3) dibiarkan ke jawaban AI yang bentuknya eksak
+            raise ValueError(f"Akar tidak rasional: {value}")
+        return Fraction(numerator_root, denominator_root)
+
+    left = evaluate_arithmetic(node[1])
+    right = evaluate_arithmetic(node[2])
+    if kind == 'add':
+        return left + right
+    if kind == 'sub':
+        return left - right
+    if kind == 'mul':
+        return left * right
+    if kind == 'div':
+        return left / right
+    if right.denominator != 1 or abs(right) > ARITHMETIC_MAX_EXPONENT:
+        raise ValueError(f"Pangkat tidak didukung: {right}")
+    return left ** int(right)
+
+def format_arithmetic_answer(value):
+    if value.denominator == 1:
+        return str(value.numerator)
+    answer = str(round(float(value), 2))
+    if answer.endswith('.0'): answer = str(int(float(answer)))
+    return answer
+
+def evaluate_arithmetic_question(question_text_lower):
+    node = parse_arithmetic_question(question_text_lower)
+    if node is None:
+        return None
     try:
-        safe_dict = {
-            "__builtins__": None,
-            "abs": abs, "min": min, "max": max, "round": round,
-            "math": math,
-            "sqrt": math.sqrt,
-            "pow": math.pow
-        }
-        
-        if re.fullmatch(r'[-+]?\d+(\.\d+)?([+\-*/]\d+(\.\d+)?)*|\d+(\.\d+)?\*\*(-?\d+(\.\d+)?)?', cleaned_question_for_eval.strip()):
-            calculated_answer_val = eval(cleaned_question_for_eval.strip(), safe_dict, {})
-            calculated_answer = str(round(calculated_answer_val, 2))
-            if calculated_answer.endswith('.0'): calculated_answer = str(int(float(calculated_answer)))
-            question_type = "numeric"
-            print(f"DEBUG: Calculated numeric answer using eval: {calculated_answer} from '{cleaned_question_for_eval}'")
-        else:
-            print(f"DEBUG: Cleaned question '{cleaned_question_for_eval}' not suitable for direct eval.")
-
-    except (SyntaxError, NameError, TypeError, ZeroDivisionError, ValueError) as e:
-        calculated_answer = None
-        print(f"DEBUG: Eval failed for '{cleaned_question_for_eval}': {e}")
-        
-    if calculated_answer is None:
-        match_arithmetic_fallback = re.search(r'(\d+)\s*([+\-xX*/])\s*(\d+)', question_text_lower)
-        if match_arithmetic_fallback:
-            num1 = float(match_arithmetic_fallback.group(1))
-            operator = match_arithmetic_fallback.group(2)
-            num2 = float(match_arithmetic_fallback.group(3))
-            try:
-                if operator == '+': calculated_answer = str(int(num1 + num2))
-                elif operator == '-': calculated_answer = str(int(num1 - num2))
-                elif operator in ('x', 'X', '*'): calculated_answer = str(int(num1 * num2))
-                elif operator == '/' and num2 != 0: calculated_answer = str(round(num1 / num2, 2))
-                question_type = "numeric"
-            except Exception as e: pass
-
-    if calculated_answer is None:
-        match_modus = re.search(r'modus\s*dari\s*data\s*([\d\s,]+)', question_text_lower)
-        if match_modus:
-            data_str = match_modus.group(1)
-            numbers = [int(n.strip()) for n in re.findall(r'\d+', data_str)]
-            if numbers:
-                counts = Counter(numbers)
-                if counts:
-                    max_count_val = max(counts.values())
-                    modes = [k for k, v in counts.items() if v == max_count_val]
-                    calculated_answer = str(min(modes))
-                    question_type = "numeric"
-                    print(f"DEBUG: Calculated mode: {calculated_answer}")
-
-    if calculated_answer is None:
-        match_nilai_tempat = re.search(r'nilai tempat\s*(\d+)\s*di\s*(\d+)', question_text_lower)
-        if match_nilai_tempat:
-            digit_to_find = match_nilai_tempat.group(1)
-            number_str = match_nilai_tempat.group(2)
-            try:
-                idx = number_str.rfind(digit_to_find)
-                if idx != -1:
-                    position = len(number_str) - 1 - idx
-                    place_names = ["satuan", "puluhan", "ratusan", "ribuan", "puluh ribuan"]
-                    calculated_answer = place_names[position] if position < len(place_names) else None
-                    question_type = "definition"
-                    print(f"DEBUG: Calculated place value: {calculated_answer}")
-            except Exception as e: pass
-
-    if calculated_answer is None:
-        match_unit_time = re.search(r'(\d+)\s*jam\s*=\s*\.\.\.\s*menit', question_text_lower)
-        if match_unit_time:
-            hours = int(match_unit_time.group(1))
-            calculated_answer = str(hours * 60)
-            question_type = "numeric"
-            print(f"DEBUG: Calculated unit conversion (time): {calculated_answer}")
-        
-        match_unit_weight = re.search(r'(\d+)\s*kg\s*=\s*\.\.\.\s*gram', question_text_lower)
-        if match_unit_weight:
-            kg = int(match_unit_weight.group(1))
-            calculated_answer = str(kg * 1000)
-            question_type = "numeric"
-            print(f"DEBUG: Calculated unit conversion (weight): {calculated_answer}")
-        
-        match_triwulan = re.search(r'(\d+)\s*triwulan\s*=\s*\.\.\.\s*bulan', question_text_lower)
-        if match_triwulan:
-            triwulan = int(match_triwulan.group(1))
-            calculated_answer = str(triwulan * 3)
-            question_type = "numeric"
-            print(f"DEBUG: Calculated triwulan: {calculated_answer}")
-
-    if calculated_answer is None:
-        match_x_y_an = re.search(r'(satu|dua|tiga|empat|lima|enam|tujuh|delapan|sembilan|sepuluh)\s*(\d+)-an', question_text_lower)
-        if match_x_y_an:
-            num_word_map = {
-                'satu': 1, 'dua': 2, 'tiga': 3, 'empat': 4, 'lima': 5,
-                'enam': 6, 'tujuh': 7, 'delapan': 8, 'sembilan': 9, 'sepuluh': 10
-            }
-            multiplier = num_word_map.get(match_x_y_an.group(1))
-            base_num = int(match_x_y_an.group(2))
-            if multiplier is not None:
-                numeric_result = multiplier * base_num
-                calculated_answer = str(numeric_result)
-                question_type = "numeric"
-                if numeric_result == 100: calculated_answer = "seratusan"
-                elif numeric_result == 200: calculated_answer = "duaratusan"
-                elif numeric_result == 500: calculated_answer = "limaratusan"
-                elif numeric_result == 1000: calculated_answer = "seribuan"
-                elif numeric_result == 2000: calculated_answer = "duaribuan"
-                elif numeric_result == 5000: calculated_answer = "limaribuan"
-                elif numeric_result == 6000: calculated_answer = "enamribuan"
-                elif numeric_result == 10000: calculated_answer = "sepuluhribuan"
-                print(f"DEBUG: Calculated X Y-an: {calculated_answer}")
-
+        return evaluate_arithmetic(node)
+    except (ZeroDivisionError, ValueError, OverflowError) as e:
+        print(f"DEBUG: Evaluasi aritmetika gagal untuk '{question_text_lower}': {e}")
+        return None
+
+class AnswerRule:
+    def __init__(self, name, solver, pattern=None, keywords=()):
+        self.name = name
+        self.solver = solver
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.keywords = tuple(keywords)
+
+class AnswerRuleEngine:
+    # Solver jawaban soal AI sebagai daftar rule berurutan. Setiap rule punya prefilter keyword murah
+    # (substring) dan regex yang sudah dikompilasi; rule pertama yang menghasilkan jawaban menghentikan
+    # dispatch.
+
+    def __init__(self):
+        self._rules = []
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._totals = Counter()
+
+    def register(self, name, pattern=None, keywords=(), before=None):
+        def decorator(solver):
+            rule = AnswerRule(name, solver, pattern=pattern, keywords=keywords)
+            with self._lock:
+                if any(existing.name == name for existing in self._rules):
+                    raise ValueError(f"Rule jawaban '{name}' sudah terdaftar.")
+                rules = list(self._rules)
+                position = len(rules)
+                if before is not None:
+                    position = next((i for i, existing in enumerate(rules) if existing.name == before), None)
+                    if position is None:
+                        raise ValueError(f"Rule jawaban '{before}' tidak ditemukan.")
+                rules.insert(position, rule)
+                # Daftar diganti utuh agar solve() yang sedang berjalan tidak melihat list setengah jadi
+                self._rules = rules
+                self._stats[name] = Counter()
+            return solver
+        return decorator
+
+    def solve(self, question_text_lower):
+        _, answer, question_type = self.dispatch(question_text_lower)
+        return answer, question_type
+
+    def dispatch(self, question_text_lower):
+        # Seperti solve(), tetapi juga mengembalikan nama rule yang menjawab (untuk laporan verifikasi)
+        text = question_text_lower
+        for rule in self._rules:
+            if rule.keywords and not any(keyword in text for keyword in rule.keywords):
+                continue
+
+            started = time.perf_counter()
+            match = None
+            result = None
+            if rule.pattern is not None:
+                match = rule.pattern.search(text)
+            if rule.pattern is None or match:
+                result = rule.solver(text, match)
+            elapsed_us = int((time.perf_counter() - started) * 1e6)
+
+            with self._lock:
+                stats = self._stats[rule.name]
+                stats['evaluated'] += 1
+                stats['microseconds'] += elapsed_us
+                if match:
+                    stats['matched'] += 1
+                if result is not None:
+                    stats['hits'] += 1
+                    self._totals['solved'] += 1
+            if result is not None:
+                return (rule.name,) + tuple(result)
+
+        with self._lock:
+            self._totals['unsolved'] += 1
+        return None, None, "unknown"
+
+    def stats(self):
+        with self._lock:
+            rules = {}
+            for rule in self._rules:
+                stats = dict(self._stats[rule.name])
+                evaluated = stats.get('evaluated', 0)
+                stats['avg_microseconds'] = round(stats.get('microseconds', 0) / evaluated, 1) if evaluated else 0.0
+                rules[rule.name] = stats
+            return dict(self._totals, rules=rules)
+
+answer_rules = AnswerRuleEngine()
+
+@answer_rules.register('x_y_an', pattern=X_Y_AN_PATTERN, keywords=('-an',))
+def solve_x_y_an(text, match):
+    multiplier = NUM_WORD_MAP.get(match.group(1))
+    if multiplier is None:
+        return None
+    calculated_answer = str(multiplier * int(match.group(2)))
+    print(f"DEBUG: Calculated X Y-an: {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('arithmetic', keywords=tuple('0123456789'))
+def solve_arithmetic(text, match):
+    value = evaluate_arithmetic_question(text)
+    if value is None:
+        return None
+    calculated_answer = format_arithmetic_answer(value)
+    print(f"DEBUG: Calculated numeric answer: {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('modus', pattern=r'modus\s*dari\s*data\s*([\d\s,]+)', keywords=('modus',))
+def solve_modus(text, match):
+    numbers = [int(n.strip()) for n in re.findall(r'\d+', match.group(1))]
+    if not numbers:
+        return None
+    counts = Counter(numbers)
+    max_count_val = max(counts.values())
+    modes = [k for k, v in counts.items() if v == max_count_val]
+    calculated_answer = str(min(modes))
+    print(f"DEBUG: Calculated mode: {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('nilai_tempat', pattern=r'nilai tempat\s*(\d+)\s*di\s*(\d+)', keywords=('nilai tempat',))
+def solve_nilai_tempat(text, match):
+    digit_to_find = match.group(1)
+    number_str = match.group(2)
+    idx = number_str.rfind(digit_to_find)
+    if idx == -1:
+        return None
+    position = len(number_str) - 1 - idx
+    if position >= len(PLACE_NAMES):
+        return None
+    calculated_answer = PLACE_NAMES[position]
+    print(f"DEBUG: Calculated place value: {calculated_answer}")
+    return calculated_answer, "definition"
+
+@answer_rules.register('konversi_jam', pattern=r'(\d+)\s*jam\s*=\s*\.\.\.\s*menit', keywords=('jam',))
+def solve_konversi_jam(text, match):
+    calculated_answer = str(int(match.group(1)) * 60)
+    print(f"DEBUG: Calculated unit conversion (time): {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('konversi_kg', pattern=r'(\d+)\s*kg\s*=\s*\.\.\.\s*gram', keywords=('kg',))
+def solve_konversi_kg(text, match):
+    calculated_answer = str(int(match.group(1)) * 1000)
+    print(f"DEBUG: Calculated unit conversion (weight): {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('konversi_triwulan', pattern=r'(\d+)\s*triwulan\s*=\s*\.\.\.\s*bulan', keywords=('triwulan',))
+def solve_konversi_triwulan(text, match):
+    calculated_answer = str(int(match.group(1)) * 3)
+    print(f"DEBUG: Calculated triwulan: {calculated_answer}")
+    return calculated_answer, "numeric"
+
+# Didaftarkan sebelum 'arithmetic' agar "1/2 ... 0,5 =" tidak dihitung sebagai pecahan
+@answer_rules.register('perbandingan', before='arithmetic', pattern=r'([\d.,/]+)\s*\.\.\.\s*([\d.,/]+)\s*=', keywords=('...',))
+def solve_perbandingan(text, match):
+    val1_str = match.group(1).replace(',', '.')
+    val2_str = match.group(2).replace(',', '.')
+    try:
+        val1 = Fraction(val1_str) if '/' in val1_str else Fraction(float(val1_str))
+        val2 = Fraction(val2_str) if '/' in val2_str else Fraction(float(val2_str))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+    if val1 == val2: calculated_answer = "="
+    elif val1 > val2: calculated_answer = ">"
+    else: calculated_answer = "<"
+    print(f"DEBUG: Calculated comparison: {calculated_answer}")
+    return calculated_answer, "comparison"
+
+@answer_rules.register('ganjil_genap_antara', pattern=r'(ganjil|genap)\s*antara\s*(\d+)\s*dan\s*(\d+)', keywords=('ganjil', 'genap'))
+def solve_ganjil_genap_antara(text, match):
+    parity = match.group(1)
+    start_num = int(match.group(2))
+    end_num = int(match.group(3))
+    remainder = 1 if parity == 'ganjil' else 0
+    sequence = [str(i) for i in range(start_num + 1, end_num) if i % 2 == remainder]
+    if not sequence:
+        return None
+    calculated_answer = " ".join(sequence)
+    print(f"DEBUG: Calculated sequence: {calculated_answer}")
+    return calculated_answer, "sequence"
+
+@answer_rules.register('keliling_persegi', pattern=r'keliling\s*(sisi|persegi)?\s*(\d+)\s*cm', keywords=('keliling',))
+def solve_keliling_persegi(text, match):
+    calculated_answer = str(int(match.group(2)) * 4)
+    print(f"DEBUG: Calculated perimeter: {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('volume_kubus', pattern=r'volume\s*(sisi|kubus)?\s*(\d+)\s*cm', keywords=('volume',))
+def solve_volume_kubus(text, match):
+    calculated_answer = str(int(match.group(2)) ** 3)
+    print(f"DEBUG: Calculated volume (cube): {calculated_answer}")
+    return calculated_answer, "numeric"
+
+@answer_rules.register('definisi')
+def solve_definisi(text, match):
+    calculated_answer = DEFINITION_MAP.get(text)
     if calculated_answer is None:
-        match_comparison = re.search(r'([\d.,/]+)\s*\.\.\.\s*([\d.,/]+)\s*=', question_text_lower)
-        if match_comparison:
-            val1_str = match_comparison.group(1).replace(',', '.')
-            val2_str = match_comparison.group(2).replace(',', '.')
-            try:
-                from fractions import Fraction
-                val1 = Fraction(val1_str) if '/' in val1_str else Fraction(float(val1_str))
-                val2 = Fraction(val2_str) if '/' in val2_str else Fraction(float(val2_str))
+        return None
+    print(f"DEBUG: Calculated definition: {calculated_answer}")
+    return calculated_answer, "definition"
 
-                if val1 == val2: calculated_answer = "="
-                elif val1 > val2: calculated_answer = ">"
-                else: calculated_answer = "<"
-                question_type = "comparison"
-                print(f"DEBUG: Calculated comparison: {calculated_answer}")
-            except Exception as e: pass
+DISTRACTOR_MAX_VALUE = 1e12
 
-    if calculated_answer is None:
-        match_odd_even_between = re.search(r'(ganjil|genap)\s*antara\s*(\d+)\s*dan\s*(\d+)', question_text_lower)
-        if match_odd_even_between:
-            parity = match_odd_even_between.group(1)
-            start_num = int(match_odd_even_between.group(2))
-            end_num = int(match_odd_even_between.group(3))
-            
-            sequence = []
-            for i in range(start_num + 1, end_num):
-                if (parity == 'ganjil' and i % 2 != 0) or \
-                   (parity == 'genap' and i % 2 == 0):
-                    sequence.append(str(i))
-            
-            if sequence:
-                calculated_answer = " ".join(sequence)
-                question_type = "sequence"
-                print(f"DEBUG: Calculated sequence: {calculated_answer}")
-
-    if calculated_answer is None:
-        match_keliling_sisi = re.search(r'keliling\s*(sisi|persegi)?\s*(\d+)\s*cm', question_text_lower)
-        if match_keliling_sisi:
-            side = int(match_keliling_sisi.group(2))
-            calculated_answer = str(side * 4)
-            question_type = "numeric"
-            print(f"DEBUG: Calculated perimeter: {calculated_answer}")
-        
-        match_volume_sisi = re.search(r'volume\s*(sisi|kubus)?\s*(\d+)\s*cm', question_text_lower)
-        if match_volume_sisi:
-            side = int(match_volume_sisi.group(2))
-            calculated_answer = str(side ** 3)
-            question_type = "numeric"
-            print(f"DEBUG: Calculated volume (cube): {calculated_answer}")
+def format_numeric_option(value):
+    if abs(value - round(value)) < 1e-9:
+        return str(int(round(value)))
+    option = str(round(value, 2))
+    if option.endswith('.0'): option = str(int(float(option)))
+    return option
 
-    if calculated_answer is None:
-        definition_map = {
-            "satuan suhu": "celcius",
-            "satuan berat baku": "kilogram",
-            "nilai tengah urut": "median",
-            "nilai tengah dari data yang sudah diurutkan": "median",
-            "perubahan waktu": "durasi",
-            "urutan bulan": "januari februari maret",
-            "diagram batang": "batang",
-            "diagram gambar": "piktogram",
-            "ukur panjang": "penggaris",
-            "lambang seratus tujuh": "107"
-        }
-        calculated_answer = definition_map.get(question_text_lower, calculated_answer)
-        if calculated_answer is not None:
-            question_type = "definition"
-            print(f"DEBUG: Calculated definition: {calculated_answer}")
+def distractor_float(value):
+    # Jawaban eksak yang terlalu besar untuk float (mis. 10000 pangkat 100) menjadi NaN, bukan OverflowError
+    try:
+        return float(value)
+    except (OverflowError, ValueError, TypeError):
+        return np.nan
+
+class DistractorGenerator:
+    # Pengecoh soal numerik dari model kesalahan siswa, dihitung untuk satu batch soal sekaligus dengan NumPy:
+    # setiap kolom matriks kandidat adalah satu model (salah hitung satu, salah operator, salah nilai tempat,
+    # tertukar pecahan/desimal). Kandidat tidak valid/duplikat dibuang per baris, lalu dipilih berdasarkan
+    # bobot model + noise dari Generator ber-seed, sehingga hasilnya deterministik untuk seed yang sama.
+    # Kandidat terbaik dari tiap model didahulukan sebelum kandidat kedua dari model mana pun. Kolom 'nearby'
+    # (jawaban +- beberapa langkah) berbobot nol dan hanya dipakai bila model lain kurang.
+    MODEL_WEIGHTS = {'wrong_operator': 3.0, 'fraction_decimal': 3.0, 'off_by_one': 2.0, 'place_value': 2.0, 'nearby': 0.0}
+
+    def __init__(self):
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def candidate_matrix(self, x, a, b, numerators, denominators):
+        nan = np.nan
+        magnitude = np.abs(x)
+        is_integer = np.isclose(x, np.round(x))
+        with np.errstate(all='ignore'):
+            exponent = np.floor(np.log10(np.where(magnitude > 0, magnitude, 1.0)))
+            leading = 10.0 ** exponent
+            step = np.where(is_integer, np.maximum(1.0, 10.0 ** (exponent - 1)), 0.1)
+            denominator_digits = np.floor(np.log10(np.maximum(denominators, 1.0))) + 1
+            columns = [
+                ('off_by_one', x + 1),
+                ('off_by_one', x - 1),
+                ('wrong_operator', a + b),
+                ('wrong_operator', a - b),
+                ('wrong_operator', a * b),
+                ('wrong_operator', a / b),
+                ('place_value', x * 10),
+                ('place_value', x / 10),
+                ('place_value', np.where(magnitude >= 10, x + 10, nan)),
+                ('place_value', np.where(magnitude >= 10, x - 10, nan)),
+                ('place_value', np.where(magnitude >= 100, x + leading, nan)),
+                ('place_value', np.where(magnitude >= 100, x - leading, nan)),
+                # 3/4 -> 4/3 (pecahan terbalik) dan 3/4 -> 3,4 (pembilang/penyebut dibaca sebagai desimal)
+                ('fraction_decimal', np.where(is_integer, nan, denominators / numerators)),
+                ('fraction_decimal', np.where(is_integer, nan, numerators + denominators / 10.0 ** denominator_digits)),
+                ('nearby', x + 2 * step),
+                ('nearby', x - 2 * step),
+                ('nearby', x + 3 * step),
+                ('nearby', x - 3 * step),
+                ('nearby', x + 5 * step),
+                ('nearby', x - 5 * step),
+            ]
+        models = np.array([model for model, _ in columns])
+        return models, np.column_stack([values for _, values in columns])
+
+    def generate(self, answers, operands=None, count=3, seed=None):
+        # answers: nilai jawaban benar (angka/Fraction); operands: (a, b) operasi biner soal atau None per soal.
+        # Mengembalikan list berisi paling banyak `count` pengecoh (string) per soal.
+        n = len(answers)
+        if n == 0:
+            return []
+        # Baris dengan jawaban tak hingga/NaN tidak mendapat pengecoh sama sekali; pemanggil mengisinya dengan perturbed_numeric_options.
+        x = np.array([distractor_float(answer) for answer in answers], dtype=float)
+        finite = np.isfinite(x)
+        a = np.full(n, np.nan)
+        b = np.full(n, np.nan)
+        for i, pair in enumerate(operands or ()):
+            if pair is not None and finite[i]:
+                a[i], b[i] = distractor_float(pair[0]), distractor_float(pair[1])
+        numerators = np.full(n, np.nan)
+        denominators = np.full(n, np.nan)
+        for i in np.flatnonzero(finite):
+            fraction = Fraction(answers[i]).limit_denominator(1000)
+            numerators[i], denominators[i] = distractor_float(fraction.numerator), distractor_float(fraction.denominator)
+
+        models, candidates = self.candidate_matrix(x, a, b, numerators, denominators)
+        rounded = np.round(candidates, 2)
+        with np.errstate(invalid='ignore'):
+            valid = (finite[:, None] & np.isfinite(candidates) & (np.abs(candidates) < DISTRACTOR_MAX_VALUE)
+                     & (rounded != np.round(x, 2)[:, None]) & ((x[:, None] < 0) | (candidates >= 0)))
+
+        rng = np.random.default_rng(seed)
+        weights = np.array([self.MODEL_WEIGHTS[model] for model in models])
+        priority = weights[None, :] + rng.random(candidates.shape)
+        priority[~valid] = -np.inf
+
+        # Duplikat nilai dalam satu baris: pertahankan kandidat berprioritas tertinggi
+        order = np.lexsort((-priority, rounded), axis=-1)
+        sorted_values = np.take_along_axis(rounded, order, axis=1)
+        duplicate_sorted = np.zeros_like(valid)
+        duplicate_sorted[:, 1:] = sorted_values[:, 1:] == sorted_values[:, :-1]
+        duplicate = np.zeros_like(valid)
+        np.put_along_axis(duplicate, order, duplicate_sorted, axis=1)
+        priority[duplicate] = -np.inf
+
+        # Kandidat terbaik tiap model didahulukan agar pengecoh bervariasi (tidak tiga-tiganya salah operator)
+        boosted = priority.copy()
+        rows = np.arange(n)
+        for model in self.MODEL_WEIGHTS:
+            columns = np.flatnonzero(models == model)
+            best = columns[np.argmax(priority[:, columns], axis=1)]
+            boosted[rows, best] += 10.0
+        priority = boosted
+
+        chosen = np.argsort(-priority, axis=1, kind='stable')[:, :count]
+        chosen_ok = np.isfinite(np.take_along_axis(priority, chosen, axis=1))
+        chosen_values = np.take_along_axis(candidates, chosen, axis=1)
+
+        with self._lock:
+            self._stats['questions'] += n
+            self._stats['batches'] += 1
+            self._stats['non_finite_answers'] += int(n - finite.sum())
+            self._stats.update(models[chosen[chosen_ok]].tolist())
+        return [[format_numeric_option(value) for value, ok in zip(row_values, row_ok) if ok]
+                for row_values, row_ok in zip(chosen_values.tolist(), chosen_ok.tolist())]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+distractor_generator = DistractorGenerator()
+
+def numeric_distractor_operands(question_text_lower):
+    # Operand (a, b) dari operasi biner teratas soal aritmetika, untuk model salah operator
+    node = parse_arithmetic_question(question_text_lower)
+    if node is None or node[0] not in ('add', 'sub', 'mul', 'div'):
+        return None
+    try:
+        return evaluate_arithmetic(node[1]), evaluate_arithmetic(node[2])
+    except (ZeroDivisionError, ValueError, OverflowError):
+        return None
+
+def perturbed_numeric_options(answer_value, existing, count):
+    # Cadangan bila AI dan distractor_generator tidak memberi cukup opsi (mis. jawaban terlalu besar untuk
+    # float): jawaban +1, +10%, +10, x2, lalu arah sebaliknya. Dihitung eksak dengan Fraction; untuk jawaban
+    # bulat atau besar hasilnya dibulatkan ke bilangan bulat. Nilai negatif hanya dipakai bila jawabannya negatif.
+    options = []
+    for value in (answer_value + 1, answer_value * Fraction(11, 10), answer_value + 10, answer_value * 2,
+                  answer_value - 1, answer_value * Fraction(9, 10), answer_value - 10, answer_value / 2,
+                  answer_value + 2, answer_value + 5):
+        if answer_value.denominator == 1 or abs(value) >= 1000:
+            value = Fraction(round(value))
+        if value < 0 <= answer_value:
+            continue
+        option = format_arithmetic_answer(value)
+        if len(options) < count and not any(answers_equivalent(option, other) for other in existing + options):
+            options.append(option)
+    return options
+
+def question_seed(question_text_lower):
+    return int(hashlib.sha1(question_text_lower.encode('utf-8')).hexdigest()[:8], 16)
 
+def calculate_correct_answer_and_options(question_text, ai_options, ai_correct_answer):
+    original_question_text = question_text
+    question_text_lower = question_text.lower()
+    calculated_answer, question_type = answer_rules.solve(question_text_lower)
 
     final_options = []
     
@@ -593,80 +1507,41 @@ def calculate_correct_answer_and_options(question_text, ai_options, ai_correct_a
         if question_type == "numeric":
             numeric_options_filtered = []
             for opt in cleaned_ai_options:
-                if re.fullmatch(r'-?\d+(\.\d+)?|\d+/\d+', opt.replace(',', '.')) or \
-                   opt in ["seratusan", "duaratusan", "limaratusan", "seribuan", "duaribuan", "limaribuan", "enamribuan", "sepuluhribuan"]:
+                if NUMERIC_OPTION_RE.fullmatch(opt.replace(',', '.')) or opt in WORD_TO_NUM_MAP:
                     numeric_options_filtered.append(opt)
                 else:
                     print(f"DEBUG: Removing non-numeric option '{opt}' for numeric question: {original_question_text}")
             
-            final_options = list(set(numeric_options_filtered))
-            
-            if final_correct_answer not in final_options:
-                if len(final_options) < 4:
-                    final_options.append(final_correct_answer)
-                else:
-                    incorrect_to_replace = [opt for opt in final_options if opt != final_correct_answer]
-                    if incorrect_to_replace:
-                        final_options.remove(random.choice(incorrect_to_replace))
-                        final_options.append(final_correct_answer)
-                    else:
-                        if len(final_options) < 4: final_options.append(final_correct_answer)
-
-
-            while len(final_options) < 4:
-                try:
-                    if isinstance(final_correct_answer, (int, float)):
-                        base_val = float(final_correct_answer)
-                    elif final_correct_answer.replace('.', '', 1).isdigit():
-                        base_val = float(final_correct_answer)
-                    else:
-                        word_to_num_map = {
-                            "seratusan": 100, "duaratusan": 200, "limaratusan": 500,
-                            "seribuan": 1000, "duaribuan": 2000, "limaribuan": 5000,
-                            "enamribuan": 6000, "sepuluhribuan": 10000
-                        }
-                        base_val = word_to_num_map.get(final_correct_answer, 0)
-                        if base_val == 0: base_val = random.randint(10, 100)
-                    
-                    distractor_val = base_val + random.choice([-1, 1]) * random.uniform(0.1, max(1.0, base_val * 0.1))
-                    
-                    if base_val >= 1000: distractor_val = base_val + random.choice([-1, 1]) * random.randint(1, 3) * 100
-                    elif base_val >= 100: distractor_val = base_val + random.choice([-1, 1]) * random.randint(1, 5) * 10
-                    elif base_val >= 10: distractor_val = base_val + random.choice([-1, 1]) * random.randint(1, 3)
-                    
-                    distractor = str(round(distractor_val, 2))
-                    if distractor.endswith('.0'): distractor = str(int(float(distractor)))
-                    
-                    if distractor not in final_options:
+            # Opsi numerik dari AI dipertahankan (tanpa duplikat nilai), sisanya diisi distractor_generator
+            for opt in numeric_options_filtered:
+                if len(final_options) < 3 and not any(answers_equivalent(opt, existing) for existing in final_options + [final_correct_answer]):
+                    final_options.append(opt)
+
+            # Nilai eksak (mis. 2/3, bukan 0.67) bila jawaban memang berasal dari evaluator aritmetika
+            answer_value = evaluate_arithmetic_question(question_text_lower)
+            if answer_value is None or format_arithmetic_answer(answer_value) != final_correct_answer:
+                answer_value = answer_numeric_value(final_correct_answer)
+            if len(final_options) < 3 and answer_value is not None:
+                distractors = distractor_generator.generate(
+                    [answer_value], [numeric_distractor_operands(question_text_lower)], count=6, seed=question_seed(question_text_lower)
+                )[0]
+                for distractor in distractors:
+                    if len(final_options) < 3 and not any(answers_equivalent(distractor, existing) for existing in final_options):
                         final_options.append(distractor)
-                except Exception as e:
-                    print(f"DEBUG: Failed to generate numeric distractor for {final_correct_answer}: {e}")
-                    if len(final_options) < 4: final_options.append(str(random.randint(1, 100)))
+            if len(final_options) < 3:
+                final_options.extend(perturbed_numeric_options(
+                    answer_value if answer_value is not None else Fraction(0),
+                    final_options + [final_correct_answer], 3 - len(final_options)
+                ))
 
-            final_options = list(set(final_options))
-            if len(final_options) > 4: final_options = random.sample(final_options, 4)
-            while len(final_options) < 4: final_options.append(str(random.randint(1, 100)))
+            final_options.append(final_correct_answer)
             random.shuffle(final_options)
 
         elif question_type == "definition" or question_type == "comparison" or question_type == "sequence" or question_type == "unknown":
-            known_relevant_options = {
-                "satuan suhu": ["celcius", "fahrenheit", "kelvin", "reamur"],
-                "satuan berat baku": ["kilogram", "gram", "ton", "kuintal"],
-                "nilai tempat": ["satuan", "puluhan", "ratusan", "ribuan"],
-                "nilai tengah urut": ["rata-rata", "median", "modus", "jangkauan"],
-                "nilai tengah dari data yang sudah diurutkan": ["rata-rata", "median", "modus", "jangkauan"],
-                "perubahan waktu": ["durasi", "interval", "periode", "waktu"],
-                "urutan bulan": ["januari februari maret", "april mei juni", "juli agustus september", "oktober november desember"],
-                "diagram batang": ["batang", "garis", "lingkaran", "piktogram"],
-                "diagram gambar": ["piktogram", "garis", "lingkaran", "batang"],
-                "ukur panjang": ["penggaris", "meteran", "timbangan", "jam", "gelas ukur"],
-                "lambang seratus tujuh": ["107", "1007", "170", "701"],
-                "1/2 ... 0,5 =": ["=", ">", "<", "!="],
-            }
             
             plausible_options = []
-            if question_text_lower in known_relevant_options:
-                plausible_options = [opt for opt in cleaned_ai_options if opt in known_relevant_options[question_text_lower]]
+            if question_text_lower in KNOWN_RELEVANT_OPTIONS:
+                plausible_options = [opt for opt in cleaned_ai_options if opt in KNOWN_RELEVANT_OPTIONS[question_text_lower]]
             
             final_options = list(set(plausible_options))
 
@@ -684,8 +1559,8 @@ def calculate_correct_answer_and_options(question_text, ai_options, ai_correct_a
             remaining_needed = 4 - len(final_options)
             if remaining_needed > 0:
                 potential_distractors = []
-                if question_text_lower in known_relevant_options:
-                    potential_distractors = [opt for opt in known_relevant_options[question_text_lower] if opt not in final_options]
+                if question_text_lower in KNOWN_RELEVANT_OPTIONS:
+                    potential_distractors = [opt for opt in KNOWN_RELEVANT_OPTIONS[question_text_lower] if opt not in final_options]
                 
                 while len(final_options) < 4 and potential_distractors:
                     distractor = random.choice(potential_distractors)
@@ -716,19 +1591,45 @@ def calculate_correct_answer_and_options(question_text, ai_options, ai_correct_a
         if len(final_options) > 4:
             final_options = random.sample(final_options, 4)
         elif len(final_options) < 4:
-            while len(final_options) < 4:
-                final_options.append(f"Opsi generik {len(final_options) + 1}")
+            # Hanya jawaban numerik yang bisa dilengkapi; soal teks dengan opsi kurang ditolak validate_ai_quiz_item
+            answer_value = answer_numeric_value(final_correct_answer)
+            if answer_value is not None:
+                distractors = [opt for opt in final_options if not answers_equivalent(opt, final_correct_answer)]
+                final_options = distractors + [final_correct_answer]
+                final_options[:0] = perturbed_numeric_options(answer_value, final_options, 4 - len(final_options))
         
         if final_correct_answer not in final_options:
             if len(final_options) > 0:
                 final_options[random.randint(0, len(final_options) - 1)] = final_correct_answer
             else:
-                final_options = [final_correct_answer, "Opsi 1", "Opsi 2", "Opsi 3"]
+                final_options = [final_correct_answer]
         
         random.shuffle(final_options)
 
     return original_question_text, final_options, final_correct_answer
 
+def answer_numeric_value(answer):
+    # "0,5", "(2/4)", "-3" dan "seribuan" menjadi Fraction; selain itu None
+    text = str(answer).strip().lower()
+    if text.startswith('(') and text.endswith(')'):
+        text = text[1:-1].strip()
+    if text in WORD_TO_NUM_MAP:
+        return Fraction(WORD_TO_NUM_MAP[text])
+    try:
+        return Fraction(text.replace(',', '.'))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def answers_equivalent(answer, expected):
+    # Jawaban hasil solver vs kunci tersimpan: angka (termasuk pecahan) dibandingkan dengan toleransi
+    # pembulatan 2 desimal, selain itu teks dibandingkan tanpa beda huruf besar/kecil.
+    if answer is None:
+        return False
+    answer_value, expected_value = answer_numeric_value(answer), answer_numeric_value(expected)
+    if answer_value is not None and expected_value is not None:
+        return abs(answer_value - expected_value) < Fraction(1, 100)
+    return str(answer).strip().lower() == str(expected).strip().lower()
+
 
 @app.route('/')
 def home():
@@ -829,6 +1730,1649 @@ def dashboard():
     print(f"DEBUG: Ditemukan {len(history)} riwayat kuis untuk user_id: {session['user_id']}")
     return render_template('includes/dashboard.html', history=history, username=session['username']) 
 
+class QuizGenerationError(Exception):
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+class AIDeadlineExceeded(Exception):
+    pass
+
+class AICircuitOpen(Exception):
+    pass
+
+def create_quiz_history(db, user_id, level, topic, num_questions):
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO quiz_history (user_id, level, topic, score, total_questions, timestamp) VALUES (%s, %s, %s, %s, %s, %s)",
+            (user_id, level, topic, 0, num_questions, datetime.datetime.now())
+        )
+        db.commit()
+        return cursor.lastrowid
+    except mysql.connector.Error:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def insert_quiz_taken_questions(db, quiz_history_id, items):
+    # Satu INSERT multi-baris (executemany ditulis ulang oleh connector) ditambah satu SELECT untuk id baris,
+    # jadi jumlah round-trip tidak bertambah seiring jumlah soal. Id diisi ke setiap item sesuai urutan.
+    if not items:
+        return []
+    cursor = db.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO quiz_taken_questions (quiz_history_id, question_text, options_json, correct_answer, source, user_answer, is_correct) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            [(quiz_history_id, item['question'], json.dumps(item['options']), item['correct_answer'], item.get('source'), None, None) for item in items]
+        )
+        cursor.execute("SELECT id FROM quiz_taken_questions WHERE quiz_history_id = %s ORDER BY id ASC", (quiz_history_id,))
+        ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    for item, taken_id in zip(items, ids[-len(items):]):
+        item['id'] = taken_id
+    return ids
+
+# Layanan pembuatan kuis. Dipanggil langsung oleh rute /quiz dan dibungkus oleh endpoint JSON /api/...,
+# sehingga memulai kuis hanya memakai satu worker dan satu koneksi database.
+def generate_manual_quiz(user_id, level, num_questions):
+    print(f"DEBUG: generate_manual_quiz dipanggil oleh user_id: {user_id} untuk level: {level}, jumlah soal: {num_questions}")
+
+    db = get_db()
+    try:
+        quiz_history_id = create_quiz_history(db, user_id, level, 'Manual', num_questions)
+        print(f"DEBUG: quiz_history_id (Manual) berhasil dibuat: {quiz_history_id}")
+    except mysql.connector.Error as e:
+        print(f"Error saving manual quiz to DB: {e}")
+        raise QuizGenerationError(f"Gagal menyimpan riwayat kuis awal: {str(e)}")
+
+    questions_from_db = question_sampler.sample(db, level, num_questions)
+
+    questions_to_return = []
+    for q in questions_from_db:
+        try:
+            options_list = json.loads(q['options'])
+            if len(options_list) >= 4 and q['correct_answer'] in options_list:
+                questions_to_return.append({
+                    'question': q['question'],
+                    'options': options_list,
+                    'correct_answer': q['correct_answer']
+                })
+            else:
+                print(f"Warning: Soal dari DB tidak valid (opsi < 4 atau jawaban tidak ada di opsi): {q['question']}")
+        except json.JSONDecodeError as e:
+            print(f"Warning: Opsi soal dari DB tidak valid JSON: {q['options']} - {e}")
+        except Exception as e:
+            print(f"Warning: Error memproses soal dari DB: {e} - {q['question']}")
+
+    try:
+        insert_quiz_taken_questions(db, quiz_history_id, questions_to_return)
+        db.commit()
+        print(f"DEBUG: Detail soal kuis manual disimpan ke quiz_taken_questions untuk quiz_history_id: {quiz_history_id}")
+    except mysql.connector.Error as e:
+        print(f"Error saving questions to quiz_taken_questions: {e}")
+        db.rollback()
+        raise QuizGenerationError(f"Gagal menyimpan detail soal: {str(e)}")
+
+    if not questions_to_return:
+        raise QuizGenerationError("Tidak ada soal yang tersedia untuk level ini.", 404)
+
+    return {"quiz": questions_to_return[:num_questions], "quiz_history_id": quiz_history_id}
+
+def generate_ai_quiz(user_id, topic, num_questions, level_context):
+    print(f"DEBUG: generate_ai_quiz dipanggil oleh user_id: {user_id} untuk topik: {topic}, level: {level_context}, jumlah soal: {num_questions}")
+
+    db = get_db()
+    try:
+        quiz_history_id = create_quiz_history(db, user_id, level_context, topic, num_questions)
+        print(f"DEBUG: quiz_history_id (AI) berhasil dibuat: {quiz_history_id}")
+    except mysql.connector.Error as e:
+        print(f"Error saving AI quiz to DB: {e}")
+        raise QuizGenerationError(f"Gagal menyimpan riwayat kuis AI awal: {str(e)}")
+
+    validated_quiz_items = fill_ai_quiz(quiz_history_id, topic, num_questions, level_context)
+    return {"quiz": validated_quiz_items, "quiz_history_id": quiz_history_id}
+
+AI_FEW_SHOT_TOKEN_BUDGET = int(os.getenv('AI_FEW_SHOT_TOKEN_BUDGET', 300))
+AI_FEW_SHOT_MAX_EXAMPLES = int(os.getenv('AI_FEW_SHOT_MAX_EXAMPLES', 3))
+AI_FEW_SHOT_CANDIDATES = int(os.getenv('AI_FEW_SHOT_CANDIDATES', 500))
+
+def estimate_tokens(text):
+    # Perkiraan kasar ~4 karakter per token; cukup untuk anggaran prompt tanpa memuat tokenizer model.
+    return len(text) // 4 + 1
+
+class FewShotSelector:
+    # Memilih contoh few-shot dari bank soal (quiz_questions, atau CSV bawaan jika bank kosong) dalam batas
+    # AI_FEW_SHOT_TOKEN_BUDGET. Pilihan deterministik: kandidat diurutkan menurut jumlah kata topik yang muncul
+    # di soal, lalu hash (topik, varian, soal), sehingga permintaan yang sama menghasilkan prompt yang sama
+    # (bisa dilayani llm_cache dan prefix cache Ollama). Varian berbeda dipakai per chunk agar contohnya bervariasi.
+    def __init__(self, ttl, max_candidates):
+        self.ttl = ttl
+        self.max_candidates = max_candidates
+        self._candidates = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def invalidate(self, level=None):
+        with self._lock:
+            if level is None:
+                self._candidates.clear()
+            else:
+                self._candidates.pop(level, None)
+
+    def _load(self, db, level):
+        with self._lock:
+            entry = self._candidates.get(level)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+
+        self._stats['loads'] += 1
+        rows = []
+        cursor = db.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT question, options, correct_answer FROM quiz_questions WHERE level = %s ORDER BY id LIMIT %s", (level, self.max_candidates))
+            for row in cursor.fetchall():
+                try:
+                    options_list = json.loads(row['options'])
+                except json.JSONDecodeError:
+                    continue
+                if len(options_list) == 4 and row['correct_answer'] in options_list:
+                    rows.append((row['question'], options_list, row['correct_answer']))
+        finally:
+            cursor.close()
+        if not rows and DATASETS.get(level) and os.path.exists(DATASETS[level]):
+            rows = [(q, list(opts), ans) for q, opts, ans in dataset_cache.rows(DATASETS[level])[:self.max_candidates]]
+
+        candidates = []
+        for question, options_list, correct_answer in rows:
+            text = format_few_shot_example(question, options_list, correct_answer)
+            candidates.append({'text': text, 'tokens': estimate_tokens(text), 'words': set(normalize_topic(question).split())})
+        with self._lock:
+            self._candidates[level] = (candidates, time.monotonic())
+        return candidates
+
+    def select(self, db, level, topic, token_budget, max_examples, variant=0):
+        candidates = self._load(db, level)
+        topic_key = normalize_topic(topic)
+        topic_words = set(topic_key.split())
+        ranked = sorted(
+            candidates,
+            key=lambda c: (-len(topic_words & c['words']), hashlib.sha1(f"{topic_key}|{variant}|{c['text']}".encode('utf-8')).hexdigest())
+        )
+        chosen = []
+        used = 0
+        for candidate in ranked:
+            if len(chosen) >= max_examples:
+                break
+            if used + candidate['tokens'] > token_budget:
+                continue
+            chosen.append(candidate['text'])
+            used += candidate['tokens']
+        self._stats['selections'] += 1
+        self._stats['example_tokens'] += used
+        return "\n".join(chosen)
+
+    def stats(self):
+        with self._lock:
+            levels = {level: len(entry[0]) for level, entry in self._candidates.items()}
+        result = dict(self._stats, cached_levels=levels)
+        if self._stats['selections']:
+            result['example_tokens_avg'] = round(self._stats['example_tokens'] / self._stats['selections'], 1)
+        return result
+
+few_shot_selector = FewShotSelector(QUESTION_INDEX_TTL_SECONDS, AI_FEW_SHOT_CANDIDATES)
+
+def get_few_shot_context(db, level_context, topic=None, variant=0):
+    context_samples_str = few_shot_selector.select(db, level_context, topic, AI_FEW_SHOT_TOKEN_BUDGET, AI_FEW_SHOT_MAX_EXAMPLES, variant)
+    if not context_samples_str:
+        print("Warning: Tidak ada contoh soal valid dari DB maupun CSV default untuk few-shot learning.")
+    return context_samples_str
+
+# Naikkan setiap kali teks prompt atau cara respons diolah berubah, agar entri llm_cache lama tidak dipakai lagi.
+PROMPT_TEMPLATE_VERSION = '3'
+
+# Bagian statis prompt disusun sekali saat impor dan selalu diletakkan di awal, sehingga token awalnya identik
+# di setiap permintaan dan Ollama dapat memakai ulang cache evaluasi prompt (prefix) untuk bagian ini.
+# Semua yang bergantung pada permintaan (contoh few-shot, jenjang, topik, jumlah soal) ada di bagian akhir.
+AI_PROMPT_STATIC_PREFIX = textwrap.dedent("""
+    Anda adalah pembuat soal kuis matematika yang presisi dan **AKURAT 100%**.
+    Soal-soal yang diminta **HARUS** mengenai topik pada bagian PERMINTAAN dan **khususnya BERSIFAT MATEMATIKA MURNI** (bukan sekadar tentang topik itu secara umum, tapi operasi/konsep matematika langsung).
+    Tingkat kesulitan dan gaya soal harus **mirip dengan soal jenjang pada bagian PERMINTAAN** dan **sesuai untuk anak-anak jenjang tersebut**.
+
+    **Fokus utama adalah soal-soal sederhana, langsung, dan berbasis perhitungan atau konsep dasar.**
+    **JANGAN membuat soal cerita yang panjang, skenario rumit, atau pertanyaan yang membutuhkan banyak konteks.**
+    **Contoh soal yang diharapkan (fokus pada perhitungan langsung, semua opsi adalah angka):**
+    - "Hasil dari 5 + 3 adalah..." (Opsi: 7, 8, 9, 10. Jawaban: 8)
+    - "Angka setelah 10 adalah..." (Opsi: 9, 10, 11, 12. Jawaban: 11)
+    - "Bentuk desimal dari 3/4 adalah..." (Opsi: 0.25, 0.50, 0.75, 1.00. Jawaban: 0.75)
+    - "Akar kuadrat dari 49 adalah..." (Opsi: 6, 7, 8, 9. Jawaban: 7)
+    - "Modus dari data 5, 7, 5, 8, 9 adalah..." (Opsi: 5, 6, 7, 8. Jawaban: 5)
+    - "2 kg = ... gram" (Opsi: 20, 200, 2000, 0.002. Jawaban: 2000)
+    - "Pembulatan 67 ke puluhan terdekat adalah..." (Opsi: 60, 65, 70, 80. Jawaban: 70)
+    - "Dua 500-an = ..." (Opsi: 500, 1000, 1500, 2000. Jawaban: 1000)
+    - "Tiga 2000-an = ..." (Opsi: 2000, 4000, 6000, 8000. Jawaban: 6000)
+    - "Nilai tengah dari data yang sudah diurutkan adalah..." (Opsi: rata-rata, median, modus, jangkauan. Jawaban: median)
+    - "Satuan berat baku adalah..." (Opsi: meter, liter, kilogram, detik. Jawaban: kilogram)
+    - "Satuan suhu adalah..." (Opsi: meter, kilogram, celcius, liter. Jawaban: celcius)
+    - "1/2 ... 0,5 =" (Opsi: =, >, !=, <. Jawaban: =)
+    - "Volume sisi 3 cm =" (Opsi: 9, 12, 27, 81. Jawaban: 27)
+    - "Ganjil antara 10 dan 20 =" (Opsi: "10 12 14 16 18", "11 13 15 17 19", "12 14 16 18 20", "11 12 13 14 15". Jawaban: "11 13 15 17 19")
+    - "5 x 6 - 15 : 3 =" (Opsi: 5, 15, 25, 35. Jawaban: 25)
+    - "Buku 5000 + pensil 1000 =" (Opsi: 4000, 5000, 6000, 7000. Jawaban: 6000)
+    - "1 triwulan = ... bulan" (Opsi: 2, 3, 4, 6. Jawaban: 3)
+    - "Keliling sisi 8 cm =" (Opsi: 16, 24, 32, 64. Jawaban: 32)
+
+    **Setiap soal yang Anda hasilkan WAJIB memiliki format JSON berikut:**
+    {
+        "question": "Teks soal pertanyaan matematika yang jelas, singkat, dan langsung.",
+        "options": ["Pilihan A (angka/nilai)", "Pilihan B (angka/nilai)", "Pilihan C (angka/nilai)", "Pilihan D (angka/nilai)"],
+        "correct_answer": "Jawaban yang BENAR SECARA MATEMATIKA untuk 'question' yang Anda buat. Ini HARUS SAMA PERSIS dengan salah satu dari empat 'options' yang Anda berikan. Pastikan ini adalah nilai numerik atau string yang tepat, BUKAN KATA-KATA NON-NUMERIK JIKA SOALNYA NUMERIK."
+    }
+
+    **FORMAT PENTING & ATURAN KETAT (BACA DAN IKUTI DENGAN SANGAT HATI-HATI):**
+    1.  Output Anda **HARUS berupa JSON array yang VALID**, berisi **TEPAT sejumlah objek soal yang diminta pada bagian PERMINTAAN**.
+    2.  **JANGAN tambahkan teks lain di awal atau akhir** selain JSON array.
+    3.  **JANGAN gunakan kurung kurawal ganda** seperti `{{` atau `}}` di output JSON Anda.
+    4.  **Mulailah output Anda dengan karakter `[` dan akhiri dengan `]`** untuk memastikan ini adalah array JSON yang lengkap.
+    5.  Setiap soal **WAJIB memiliki TEPAT 4 pilihan jawaban yang berbeda dan relevan**.
+    6.  **PENTING SEKALI: Salah satu dari pilihan ini (options) HARUS menjadi `correct_answer` yang benar secara matematis.** Pastikan `correct_answer` adalah nilai yang sama persis dengan salah satu opsi.
+    7.  **SANGAT PENTING: Opsi jawaban (Pilihan A, B, C, D) HARUS berupa angka atau nilai yang relevan secara matematis.** JANGAN PERNAH menyertakan kata-kata non-matematika atau konsep yang tidak terkait (misalnya, "kubus", "celcius", "lancip", "sejajar", "kerucut", "segitiga", "balok", "ruas", "batang", "lingkaran", "garis", "gambar") sebagai opsi jika soalnya adalah perhitungan atau konsep angka.
+    8.  Untuk ekspresi matematika, gunakan angka biasa dan simbol operasi matematika standar (misal: `+`, `-`, `*`, `/`) atau kata-kata (misal: 'pecahan', 'pangkat') daripada notasi khusus (misal: $\\frac{1}{2}$, $10^2$). Contoh: '1 per 2' atau '1 dibagi 2' untuk pecahan, '10 pangkat 2' untuk eksponen.
+    9.  **Pastikan soal-soal yang dihasilkan masuk akal, relevan secara matematika, dan jawabannya AKURAT 100%.**
+    10. **PERIKSA KEMBALI JAWABAN ANDA SENDIRI** sebelum menghasilkan output. Pastikan perhitungan Anda benar.
+""").strip()
+
+AI_PROMPT_REQUEST_TEMPLATE = textwrap.dedent("""
+    --- Contoh Referensi Soal dari Dataset Saya (Sangat Penting untuk Diikuti) ---
+    {examples}
+    --- Akhir Contoh Referensi ---
+
+    --- PERMINTAAN ---
+    Jenjang: {level_context} (soal harus mirip dengan soal {level_context} dan sesuai untuk anak-anak {level_context})
+    Topik: **{topic}**
+    Jumlah soal: **TEPAT {num_questions} soal** pilihan ganda baru.
+
+    Hasilkan JSON array dengan format di atas, berisi {num_questions} soal baru yang sesuai topik dan tingkat kesulitan.
+""").strip()
+
+def build_ai_quiz_prompt(topic, num_questions, level_context, context_samples_str):
+    request_part = AI_PROMPT_REQUEST_TEMPLATE.format(
+        examples=context_samples_str if context_samples_str else "Tidak ada contoh yang tersedia. Buat soal berdasarkan topik dan level.",
+        level_context=level_context,
+        topic=topic,
+        num_questions=num_questions,
+    )
+    return f"{AI_PROMPT_STATIC_PREFIX}\n\n{request_part}"
+
+AI_STRUCTURED_OUTPUT = os.getenv('AI_STRUCTURED_OUTPUT', '1') == '1'
+
+# Counter dengan awalan responses_ dihitung per respons Ollama utuh (parse_ai_quiz_response, mode non-streaming),
+# awalan items_ per objek soal (IncrementalQuizParser dalam mode streaming, dan pengecekan schema per soal).
+class AIOutputStats:
+    # Dipanggil dari thread request, job runner, dan refill pool sekaligus
+    def __init__(self):
+        self._stats = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            return Counter(self._stats)
+
+ai_output_stats = AIOutputStats()
+
+def ai_quiz_response_schema(num_questions):
+    # JSON schema untuk parameter "format" Ollama (structured outputs). Decoding model dibatasi grammar dari
+    # schema ini, jadi respons selalu berupa array objek {question, options[4], correct_answer} yang valid.
+    return {
+        "type": "array",
+        "minItems": num_questions,
+        "maxItems": num_questions,
+        "items": {
+            "type": "object",
+            "properties": {
+                "question": {"type": "string"},
+                "options": {"type": "array", "items": {"type": "string"}, "minItems": 4, "maxItems": 4},
+                "correct_answer": {"type": "string"},
+            },
+            "required": ["question", "options", "correct_answer"],
+        },
+    }
+
+def matches_quiz_item_schema(item):
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get('question'), str) and item['question'].strip() != ''
+        and isinstance(item.get('options'), list) and len(item['options']) == 4
+        and all(isinstance(option, str) for option in item['options'])
+        and isinstance(item.get('correct_answer'), str)
+    )
+
+def repair_json_string(json_str, unit):
+    # Jalur perbaikan (fix_json_string) hanya dipakai jika json.loads langsung gagal; frekuensi dan biayanya dicatat.
+    # unit: 'responses' atau 'items', sesuai apa yang sedang di-parse.
+    started = time.perf_counter()
+    repaired = fix_json_string(json_str)
+    ai_output_stats.incr(f'{unit}_repairs')
+    ai_output_stats.incr(f'{unit}_repair_microseconds', int((time.perf_counter() - started) * 1e6))
+    return repaired
+
+def parse_ai_quiz_response(ai_response_content_str):
+    # Jalur cepat: satu json.loads. Dengan format JSON schema respons Ollama hampir selalu valid di sini.
+    try:
+        generated_quiz_items = json.loads(ai_response_content_str)
+        ai_output_stats.incr('responses_direct_parses')
+    except json.JSONDecodeError:
+        extracted_json_str = repair_json_string(ai_response_content_str, 'responses')
+        
+        print(f"DEBUG: Extracted and Fixed JSON String for parsing:\n{extracted_json_str}")
+
+        if not extracted_json_str:
+            ai_output_stats.incr('responses_repair_failures')
+            raise ValueError(f"Model lokal menghasilkan respons tetapi tidak mengandung JSON yang valid setelah ekstraksi dan perbaikan. Respons mentah: {ai_response_content_str[:500]}...")
+        
+        try:
+            generated_quiz_items = json.loads(extracted_json_str)
+        except json.JSONDecodeError as e:
+            ai_output_stats.incr('responses_repair_failures')
+            raise ValueError(f"Gagal mengurai JSON dari respons AI bahkan setelah perbaikan: {e}. Respon mentah (setelah ekstraksi): {extracted_json_str[:500]}...")
+
+        print(f"DEBUG: Parsed JSON Object: {json.dumps(generated_quiz_items, indent=2)}")
+    
+    final_quiz_list = []
+    if isinstance(generated_quiz_items, list):
+        final_quiz_list = generated_quiz_items
+    elif isinstance(generated_quiz_items, dict):
+        if 'question' in generated_quiz_items and \
+           'options' in generated_quiz_items and \
+           isinstance(generated_quiz_items.get('options'), list): 
+            final_quiz_list = [generated_quiz_items]
+        elif 'quiz' in generated_quiz_items and isinstance(generated_quiz_items['quiz'], list):
+            final_quiz_list = generated_quiz_items['quiz']
+        else:
+            raise ValueError(f"Format JSON yang dihasilkan AI tidak sesuai. Diharapkan array, objek dengan kunci 'quiz', atau objek soal tunggal. Tipe root: {repr(type(generated_quiz_items))}, Kunci ditemukan: {list(generated_quiz_items.keys()) if isinstance(generated_quiz_items, dict) else 'N/A'}")
+    else:
+        raise ValueError(f"Format JSON yang dihasilkan AI tidak sesuai. Diharapkan array, objek dengan kunci 'quiz', atau objek soal tunggal. Tipe root: {repr(type(generated_quiz_items))}")
+    for item in final_quiz_list:
+        ai_output_stats.incr('items_schema_match' if matches_quiz_item_schema(item) else 'items_schema_mismatch')
+    return final_quiz_list
+
+def ai_output_stats_summary():
+    # Rasio dihitung per satuan; counter responses_ dan items_ tidak pernah dijumlahkan satu sama lain.
+    stats = ai_output_stats.stats()
+    result = dict(stats, structured_output=AI_STRUCTURED_OUTPUT)
+    for unit in ('responses', 'items'):
+        repairs = stats[f'{unit}_repairs']
+        parses = stats[f'{unit}_direct_parses'] + repairs
+        if parses:
+            result[f'{unit}_repair_rate'] = round(repairs / parses, 3)
+        if repairs:
+            result[f'{unit}_repair_avg_microseconds'] = round(stats[f'{unit}_repair_microseconds'] / repairs, 1)
+    checked_items = stats['items_schema_match'] + stats['items_schema_mismatch']
+    if checked_items:
+        result['items_schema_mismatch_rate'] = round(stats['items_schema_mismatch'] / checked_items, 3)
+    return result
+
+def is_ai_quiz_item_shaped(item):
+    # Cek struktur murah tanpa menghitung jawaban; validasi lengkap tetap di validate_ai_quiz_item
+    return isinstance(item, dict) and bool(item.get('question')) and isinstance(item.get('options'), list)
+
+def validate_ai_quiz_item(item):
+    if not isinstance(item, dict):
+        print(f"Peringatan: Item kuis bukan objek JSON: {item}")
+        return None
+    question_text = item.get('question')
+    options_raw = item.get('options')
+    correct_answer_text_ai = item.get('correct_answer')
+    if not question_text or not isinstance(options_raw, list):
+        print(f"Peringatan: Item kuis tidak valid atau tidak lengkap (Masalah: question/options): {item}")
+        return None
+
+    # Use the new calculate_correct_answer_and_options for robust processing
+    final_question_text, final_options, final_correct_answer = \
+        calculate_correct_answer_and_options(question_text, options_raw, correct_answer_text_ai)
+
+    # Final validation before appending
+    if (final_question_text and isinstance(final_question_text, str) and
+        final_options and len(final_options) == 4 and 
+        final_correct_answer and isinstance(final_correct_answer, str) and 
+        str(final_correct_answer).strip() in final_options): 
+
+        return {
+            'question': str(final_question_text).strip(),
+            'options': final_options,
+            'correct_answer': str(final_correct_answer).strip()
+        }
+
+    missing_info = []
+    if not final_question_text: missing_info.append('question')
+    if not final_options or len(final_options) != 4: missing_info.append(f'options (invalid/not 4, current: {final_options})')
+    if not final_correct_answer or not isinstance(final_correct_answer, str): missing_info.append('correct_answer (missing/invalid type)')
+    elif final_correct_answer and str(final_correct_answer).strip() not in final_options: missing_info.append(f'correct_answer (not in options, current: {final_correct_answer})')
+    
+    print(f"Peringatan: Item kuis tidak valid atau tidak lengkap (Masalah: {', '.join(missing_info)}): {item}")
+    return None
+
+class IncrementalQuizParser:
+    # Parser JSON inkremental untuk output model yang datang per token. Melacak kedalaman kurung kurawal
+    # (dengan memperhatikan string dan escape) dan mengembalikan setiap objek soal begitu kurung penutupnya
+    # diterima, tanpa menunggu seluruh array selesai.
+    def __init__(self):
+        self.buffer = ''
+        self._scan_pos = 0
+        self._open_braces = []
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        self.buffer += text
+        items = []
+        while self._scan_pos < len(self.buffer):
+            char = self.buffer[self._scan_pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._open_braces.append(self._scan_pos)
+            elif char == '}' and self._open_braces:
+                start = self._open_braces.pop()
+                item = self._parse_object(self.buffer[start:self._scan_pos + 1])
+                if isinstance(item, dict) and 'question' in item and 'options' in item:
+                    items.append(item)
+            self._scan_pos += 1
+        return items
+
+    def _parse_object(self, object_str):
+        try:
+            item = json.loads(object_str)
+            ai_output_stats.incr('items_direct_parses')
+        except json.JSONDecodeError:
+            try:
+                item = json.loads(repair_json_string(object_str, 'items'))
+            except json.JSONDecodeError:
+                ai_output_stats.incr('items_repair_failures')
+                return None
+        if isinstance(item, dict) and 'question' in item:
+            ai_output_stats.incr('items_schema_match' if matches_quiz_item_schema(item) else 'items_schema_mismatch')
+        return item
+
+def ollama_timeout(deadline=None):
+    # Timeout (connect, read) untuk requests. Read timeout berlaku per pembacaan socket, jadi dibatasi juga
+    # oleh sisa waktu deadline agar model yang macet tidak menahan worker.
+    read_timeout = OLLAMA_READ_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise AIDeadlineExceeded("Batas waktu pembuatan soal AI habis.")
+        read_timeout = min(read_timeout, remaining)
+    return (OLLAMA_CONNECT_TIMEOUT, read_timeout)
+
+OLLAMA_TIMING_FIELDS = ('total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration')
+
+def stream_ollama_quiz_items(ollama_api_url, payload, deadline=None, meta=None):
+    # Mengonsumsi stream NDJSON dari Ollama dan menghasilkan objek soal mentah satu per satu.
+    # Jika stream selesai tanpa satu pun objek lengkap, seluruh teks diurai ulang dengan fix_json_string.
+    # Field waktu dari pesan terakhir Ollama (load_duration dst.) disalin ke meta bila diberikan.
+    meta = meta if meta is not None else {}
+    started = time.monotonic()
+    parser = IncrementalQuizParser()
+    yielded = 0
+    with requests.post(ollama_api_url, json=payload, stream=True, timeout=ollama_timeout(deadline)) as response:
+        response.raise_for_status()
+        # chunk_size=None: baris diproses segera setelah tiba, tidak menunggu buffer 512 byte penuh.
+        for line in response.iter_lines(chunk_size=None):
+            if deadline is not None and time.monotonic() > deadline:
+                raise AIDeadlineExceeded("Batas waktu pembuatan soal AI habis.")
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('error'):
+                raise ValueError(f"Ollama mengembalikan error: {chunk['error']}")
+            if chunk.get('done'):
+                meta.update({field: chunk[field] for field in OLLAMA_TIMING_FIELDS if field in chunk})
+            for item in parser.feed(chunk.get('response', '')):
+                if not yielded:
+                    meta['first_item_seconds'] = time.monotonic() - started
+                yielded += 1
+                yield item
+            if chunk.get('done'):
+                break
+
+    if not yielded:
+        if not parser.buffer:
+            raise ValueError("Model lokal tidak menghasilkan respons yang valid atau respons kosong.")
+        print(f"DEBUG: Stream Ollama tidak menghasilkan objek soal lengkap, mengurai ulang seluruh respons.")
+        for item in parse_ai_quiz_response(parser.buffer):
+            yield item
+
+AI_STREAMING = os.getenv('AI_STREAMING', '1') == '1'
+
+# Daftar backend Ollama dipisah koma, mis. "http://10.0.0.5:11434,http://10.0.0.6:11434|2".
+# Akhiran "|N" menetapkan batas permintaan bersamaan untuk backend tersebut.
+OLLAMA_BACKENDS = os.getenv('OLLAMA_BACKENDS', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3')
+OLLAMA_BACKEND_MAX_CONCURRENCY = int(os.getenv('OLLAMA_BACKEND_MAX_CONCURRENCY', 1))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', 120))
+OLLAMA_HEALTH_CHECK_SECONDS = float(os.getenv('OLLAMA_HEALTH_CHECK_SECONDS', 15))
+OLLAMA_EJECT_AFTER_FAILURES = int(os.getenv('OLLAMA_EJECT_AFTER_FAILURES', 3))
+OLLAMA_LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+# Lama model tetap dimuat di memori Ollama setelah permintaan terakhir (format durasi Ollama, mis. "30m", "-1").
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_WARM_MODELS = [m.strip() for m in os.getenv('OLLAMA_WARM_MODELS', OLLAMA_MODEL).split(',') if m.strip()]
+OLLAMA_WARMUP_ENABLED = os.getenv('OLLAMA_WARMUP_ENABLED', '1') == '1'
+OLLAMA_WARMUP_TIMEOUT = float(os.getenv('OLLAMA_WARMUP_TIMEOUT', 300))
+OLLAMA_KEEPALIVE_PING_SECONDS = float(os.getenv('OLLAMA_KEEPALIVE_PING_SECONDS', 600))
+# load_duration di atas ambang ini berarti model harus dimuat dulu (cold start).
+OLLAMA_COLD_LOAD_THRESHOLD_SECONDS = float(os.getenv('OLLAMA_COLD_LOAD_THRESHOLD_SECONDS', 1))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', 5))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', 60))
+AI_QUIZ_DEADLINE_SECONDS = float(os.getenv('AI_QUIZ_DEADLINE_SECONDS', 120))
+AI_FALLBACK_TO_BANK = os.getenv('AI_FALLBACK_TO_BANK', '1') == '1'
+AI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('AI_CIRCUIT_FAILURE_THRESHOLD', 3))
+AI_CIRCUIT_RESET_SECONDS = float(os.getenv('AI_CIRCUIT_RESET_SECONDS', 60))
+
+class CircuitBreaker:
+    # closed: semua panggilan diteruskan. Setelah failure_threshold kegagalan berturut-turut menjadi open dan
+    # panggilan langsung ditolak selama reset_seconds; setelah itu half_open meloloskan satu panggilan percobaan
+    # yang menentukan apakah kembali closed atau open lagi.
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+                self._trial_in_flight = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print("DEBUG: Circuit breaker Ollama kembali closed.")
+            self.state = 'closed'
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+            self._stats['successes'] += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._stats['failures'] += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self._stats['opened'] += 1
+                    print(f"Peringatan: Circuit breaker Ollama open setelah {self.consecutive_failures} kegagalan berturut-turut.")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        # Melepas panggilan percobaan half_open tanpa menilai Ollama, agar panggilan berikutnya boleh mencoba lagi.
+        with self._lock:
+            self._trial_in_flight = False
+            self._stats['released'] += 1
+
+    def record_error(self, e):
+        # Ollama tidak terjangkau atau terlalu lambat dihitung gagal. Output model yang rusak (ValueError dari parser
+        # atau validasi) berarti Ollama tetap menjawab, jadi dihitung sukses. Error lain (database, klien putus)
+        # tidak menilai Ollama dan hanya melepas panggilan percobaan.
+        if isinstance(e, (requests.exceptions.RequestException, AIDeadlineExceeded)):
+            self.record_failure()
+        elif isinstance(e, ValueError):
+            self.record_success()
+        else:
+            self.release()
+
+    @contextlib.contextmanager
+    def guard(self):
+        # Dipakai setelah allow() mengembalikan True: setiap hasil panggilan, termasuk exception apa pun,
+        # selalu menyelesaikan panggilan percobaan half_open. GeneratorExit berarti konsumen berhenti setelah
+        # menerima soal dari Ollama, jadi dihitung sukses.
+        try:
+            yield
+        except GeneratorExit:
+            self.record_success()
+            raise
+        except BaseException as e:
+            self.record_error(e)
+            raise
+        else:
+            self.record_success()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, state=self.state, consecutive_failures=self.consecutive_failures)
+
+ollama_circuit = CircuitBreaker(AI_CIRCUIT_FAILURE_THRESHOLD, AI_CIRCUIT_RESET_SECONDS)
+
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(app.root_path, 'llm_cache.sqlite3'))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 5000))
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', 24 * 3600))
+# Jumlah varian (seed + contoh few-shot) per (topik, level, jumlah soal) untuk permintaan pengguna. Setiap
+# permintaan memilih satu varian secara acak, jadi siswa yang meminta topik yang sama mendapat salah satu dari
+# LLM_CACHE_VARIANTS set soal, bukan set yang sama selama TTL. Makin besar, makin bervariasi tetapi makin jarang hit.
+LLM_CACHE_VARIANTS = int(os.getenv('LLM_CACHE_VARIANTS', 4))
+
+class LLMResponseCache:
+    # Cache persisten hasil Ollama, dialamatkan dengan fingerprint SHA-256 dari model, PROMPT_TEMPLATE_VERSION,
+    # prompt lengkap (topik, level, jumlah soal, contoh few-shot), format, dan opsi sampling.
+    # Disimpan di SQLite mode WAL sehingga aman dipakai bersama oleh beberapa worker gunicorn di satu host;
+    # setiap thread memakai koneksinya sendiri. Entri kedaluwarsa setelah TTL dan entri yang paling lama tidak
+    # diakses dibuang saat jumlahnya melebihi max_entries. Kegagalan cache tidak pernah menggagalkan generasi.
+    def __init__(self, path, max_entries, ttl, enabled=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._local = threading.local()
+        self._stats = Counter()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, raw TEXT NOT NULL, validated TEXT, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def fingerprint(self, payload):
+        material = {key: value for key, value in payload.items() if key not in ('stream', 'keep_alive')}
+        material['template_version'] = PROMPT_TEMPLATE_VERSION
+        return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT raw, validated, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            if time.time() - row[2] > self.ttl:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            self._stats['hits'] += 1
+            return {'raw': json.loads(row[0]), 'validated': json.loads(row[1]) if row[1] else None}
+        except sqlite3.Error as e:
+            self._stats['errors'] += 1
+            print(f"Peringatan: Gagal membaca cache LLM: {e}")
+            return None
+
+    def put(self, key, raw_items, validated_items=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, raw, validated, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(raw_items), json.dumps(validated_items) if validated_items is not None else None, now, now)
+            )
+            expired = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,)).rowcount
+            count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            evicted = 0
+            if count > self.max_entries:
+                evicted = conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                ).rowcount
+            conn.commit()
+            self._stats['stores'] += 1
+            self._stats['expired'] += expired
+            self._stats['evictions'] += evicted
+        except sqlite3.Error as e:
+            self._stats['errors'] += 1
+            print(f"Peringatan: Gagal menyimpan cache LLM: {e}")
+
+    def stats(self):
+        result = dict(self._stats, enabled=self.enabled, path=self.path, max_entries=self.max_entries)
+        lookups = self._stats['hits'] + self._stats['misses']
+        result['hit_rate'] = round(self._stats['hits'] / lookups, 3) if lookups else None
+        if self.enabled:
+            try:
+                result['entries'] = self._conn().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            except sqlite3.Error as e:
+                result['error'] = str(e)
+        return result
+
+llm_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS, LLM_CACHE_ENABLED)
+
+class OllamaBackend:
+    def __init__(self, base_url, max_concurrency):
+        self.base_url = base_url.rstrip('/')
+        self.generate_url = f"{self.base_url}/api/generate"
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency_total = 0.0
+        self.latency_buckets = [0] * (len(OLLAMA_LATENCY_BUCKETS) + 1)
+        self.loaded_models = {}
+        self.last_used = 0
+        self.warmups = 0
+        self.generations = {'cold': deque(maxlen=100), 'warm': deque(maxlen=100)}
+
+    def record_generation(self, state, elapsed, load_seconds, first_item_seconds):
+        self.generations[state].append((elapsed, load_seconds, first_item_seconds))
+
+    def record(self, elapsed, ok):
+        self.requests += 1
+        self.latency_total += elapsed
+        bucket = len(OLLAMA_LATENCY_BUCKETS)
+        for i, bound in enumerate(OLLAMA_LATENCY_BUCKETS):
+            if elapsed <= bound:
+                bucket = i
+                break
+        self.latency_buckets[bucket] += 1
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+    def stats(self):
+        histogram = {f"le_{bound}s": count for bound, count in zip(OLLAMA_LATENCY_BUCKETS, self.latency_buckets)}
+        histogram['gt_' + str(OLLAMA_LATENCY_BUCKETS[-1]) + 's'] = self.latency_buckets[-1]
+        return {
+            'url': self.base_url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'max_concurrency': self.max_concurrency,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency_avg_seconds': round(self.latency_total / self.requests, 3) if self.requests else None,
+            'latency_histogram': histogram,
+            'loaded_models': dict(self.loaded_models),
+            'warmups': self.warmups,
+            'cold_vs_warm': {state: self._generation_stats(samples) for state, samples in self.generations.items()},
+        }
+
+    def _generation_stats(self, samples):
+        if not samples:
+            return {'count': 0}
+        first_items = [s[2] for s in samples if s[2] is not None]
+        loads = [s[1] for s in samples if s[1] is not None]
+        return {
+            'count': len(samples),
+            'latency_avg_seconds': round(sum(s[0] for s in samples) / len(samples), 3),
+            'latency_max_seconds': round(max(s[0] for s in samples), 3),
+            'first_item_avg_seconds': round(sum(first_items) / len(first_items), 3) if first_items else None,
+            'load_avg_seconds': round(sum(loads) / len(loads), 3) if loads else None,
+        }
+
+class OllamaLease:
+    def __init__(self, dispatcher, backend):
+        self.dispatcher = dispatcher
+        self.backend = backend
+        self.started = time.monotonic()
+
+    def __enter__(self):
+        return self.backend
+
+    def __exit__(self, exc_type, exc, tb):
+        # Hanya kegagalan jaringan/HTTP yang dihitung sebagai kegagalan backend, bukan JSON model yang rusak.
+        ok = exc_type is None or not issubclass(exc_type, requests.exceptions.RequestException)
+        self.dispatcher.release(self.backend, time.monotonic() - self.started, ok)
+        return False
+
+class OllamaDispatcher:
+    # Membagi panggilan generate ke beberapa host Ollama. Backend dipilih berdasarkan permintaan yang sedang berjalan
+    # relatif terhadap batasnya (least outstanding requests); jika semua penuh, pemanggil menunggu di antrean.
+    # Backend dikeluarkan setelah OLLAMA_EJECT_AFTER_FAILURES kegagalan berturut-turut atau health check /api/tags
+    # yang gagal, dan masuk kembali saat health check berikutnya berhasil. Jika semua backend tidak sehat,
+    # semuanya tetap dicoba agar satu health check yang keliru tidak mematikan fitur AI.
+    def __init__(self, backends_spec, model, default_concurrency, queue_timeout, health_check_seconds, eject_after_failures):
+        self.model = model
+        self.queue_timeout = queue_timeout
+        self.health_check_seconds = health_check_seconds
+        self.eject_after_failures = eject_after_failures
+        self.backends = []
+        for spec in backends_spec.split(','):
+            spec = spec.strip()
+            if not spec:
+                continue
+            url, _, cap = spec.partition('|')
+            self.backends.append(OllamaBackend(url, int(cap) if cap else default_concurrency))
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._health_thread = None
+        self._keep_alive_thread = None
+        self._timing = Counter()
+
+    def _start_health_checks(self):
+        if self._health_thread is None and self.health_check_seconds > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, name='ollama-health', daemon=True)
+            self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_check_seconds)
+            for backend in self.backends:
+                self.check_health(backend)
+
+    def check_health(self, backend):
+        try:
+            response = requests.get(f"{backend.base_url}/api/tags", timeout=5)
+            response.raise_for_status()
+            names = [m.get('name', '') for m in response.json().get('models', [])]
+            healthy = any(name == self.model or name.split(':')[0] == self.model for name in names)
+        except (requests.exceptions.RequestException, ValueError):
+            healthy = False
+        with self._condition:
+            if healthy != backend.healthy:
+                print(f"DEBUG: Backend Ollama {backend.base_url} sekarang {'sehat' if healthy else 'tidak sehat'}.")
+            backend.healthy = healthy
+            if healthy:
+                backend.consecutive_failures = 0
+            self._condition.notify_all()
+        return healthy
+
+    def start_keep_alive(self):
+        # Memanaskan model di semua backend saat startup, lalu secara berkala memeriksa /api/ps dan mengirim
+        # ping keep_alive ke backend yang menganggur agar model tidak dibongkar oleh Ollama.
+        if not OLLAMA_WARMUP_ENABLED or not self.backends:
+            return
+        with self._condition:
+            if self._keep_alive_thread is not None:
+                return
+            self._keep_alive_thread = threading.Thread(target=self._keep_alive_loop, name='ollama-keep-alive', daemon=True)
+            self._keep_alive_thread.start()
+
+    def _keep_alive_loop(self):
+        for backend in self.backends:
+            for model in OLLAMA_WARM_MODELS:
+                self.warm_up(backend, model)
+        while True:
+            time.sleep(OLLAMA_KEEPALIVE_PING_SECONDS)
+            for backend in self.backends:
+                self.refresh_loaded_models(backend)
+                if time.monotonic() - backend.last_used < OLLAMA_KEEPALIVE_PING_SECONDS:
+                    continue
+                for model in OLLAMA_WARM_MODELS:
+                    self.warm_up(backend, model)
+
+    def warm_up(self, backend, model):
+        # Prompt kosong membuat Ollama memuat model tanpa menghasilkan token; keep_alive memperpanjang masa tinggalnya.
+        started = time.monotonic()
+        try:
+            response = requests.post(
+                backend.generate_url,
+                json={"model": model, "prompt": "", "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_WARMUP_TIMEOUT)
+            )
+            response.raise_for_status()
+            load_seconds = response.json().get('load_duration', 0) / 1e9
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Peringatan: Gagal memanaskan model {model} di {backend.base_url}: {e}")
+            with self._condition:
+                backend.loaded_models[model] = False
+            return False
+        with self._condition:
+            backend.loaded_models[model] = True
+            backend.warmups += 1
+        print(f"DEBUG: Model {model} di {backend.base_url} siap ({time.monotonic() - started:.1f} detik, load {load_seconds:.1f} detik).")
+        return True
+
+    def refresh_loaded_models(self, backend):
+        try:
+            response = requests.get(f"{backend.base_url}/api/ps", timeout=5)
+            response.raise_for_status()
+            names = [m.get('name', '') for m in response.json().get('models', [])]
+        except (requests.exceptions.RequestException, ValueError):
+            return
+        with self._condition:
+            for model in set(OLLAMA_WARM_MODELS) | set(backend.loaded_models):
+                backend.loaded_models[model] = any(name == model or name.split(':')[0] == model for name in names)
+
+    def record_generation(self, backend, model, elapsed, meta, was_loaded):
+        # Cold start dikenali dari load_duration respons Ollama; jika stream dihentikan sebelum pesan terakhir
+        # (load_duration tidak ada), dipakai status model yang diketahui sebelum permintaan dikirim.
+        load_seconds = meta['load_duration'] / 1e9 if 'load_duration' in meta else None
+        if load_seconds is not None:
+            state = 'cold' if load_seconds >= OLLAMA_COLD_LOAD_THRESHOLD_SECONDS else 'warm'
+        elif was_loaded is not None:
+            state = 'warm' if was_loaded else 'cold'
+        else:
+            state = None
+        with self._condition:
+            backend.last_used = time.monotonic()
+            backend.loaded_models[model] = True
+            if state:
+                backend.record_generation(state, elapsed, load_seconds, meta.get('first_item_seconds'))
+            if 'prompt_eval_duration' in meta or 'eval_duration' in meta:
+                self._timing['responses'] += 1
+                for field in ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration'):
+                    self._timing[field] += meta.get(field, 0)
+
+    def timing_stats(self):
+        # Perbandingan waktu evaluasi prompt dan waktu generasi token dari field respons Ollama.
+        # prompt_eval_count yang jauh lebih kecil dari panjang prompt berarti prefix prompt dilayani dari cache.
+        timing = self._timing
+        responses = timing['responses']
+        if not responses:
+            return {'responses': 0}
+        prompt_seconds = timing['prompt_eval_duration'] / 1e9
+        eval_seconds = timing['eval_duration'] / 1e9
+        total_seconds = prompt_seconds + eval_seconds
+        return {
+            'responses': responses,
+            'prompt_eval_avg_seconds': round(prompt_seconds / responses, 3),
+            'eval_avg_seconds': round(eval_seconds / responses, 3),
+            'prompt_eval_share': round(prompt_seconds / total_seconds, 3) if total_seconds else None,
+            'prompt_tokens_avg': round(timing['prompt_eval_count'] / responses, 1),
+            'generated_tokens_avg': round(timing['eval_count'] / responses, 1),
+            'prompt_tokens_per_second': round(timing['prompt_eval_count'] / prompt_seconds, 1) if prompt_seconds else None,
+            'generated_tokens_per_second': round(timing['eval_count'] / eval_seconds, 1) if eval_seconds else None,
+        }
+
+    def _pick(self):
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        available = [b for b in candidates if b.outstanding < b.max_concurrency]
+        if not available:
+            return None
+        lowest = min(b.outstanding / b.max_concurrency for b in available)
+        return random.choice([b for b in available if b.outstanding / b.max_concurrency == lowest])
+
+    def lease(self):
+        if not self.backends:
+            raise requests.exceptions.ConnectionError("Tidak ada backend Ollama yang dikonfigurasi (OLLAMA_BACKENDS).")
+        with self._condition:
+            self._start_health_checks()
+            deadline = time.monotonic() + self.queue_timeout
+            self._waiting += 1
+            try:
+                backend = self._pick()
+                while backend is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise requests.exceptions.ConnectionError("Semua backend Ollama sedang sibuk, batas waktu antrean habis.")
+                    self._condition.wait(remaining)
+                    backend = self._pick()
+            finally:
+                self._waiting -= 1
+            backend.outstanding += 1
+        return OllamaLease(self, backend)
+
+    def release(self, backend, elapsed, ok):
+        with self._condition:
+            backend.outstanding -= 1
+            backend.record(elapsed, ok)
+            if not ok and backend.healthy and backend.consecutive_failures >= self.eject_after_failures:
+                backend.healthy = False
+                print(f"Peringatan: Backend Ollama {backend.base_url} dikeluarkan setelah {backend.consecutive_failures} kegagalan berturut-turut.")
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'model': self.model,
+                'waiting': self._waiting,
+                'backends': [b.stats() for b in self.backends],
+                'timing': self.timing_stats(),
+            }
+
+ollama_dispatcher = OllamaDispatcher(OLLAMA_BACKENDS, OLLAMA_MODEL, OLLAMA_BACKEND_MAX_CONCURRENCY, OLLAMA_QUEUE_TIMEOUT, OLLAMA_HEALTH_CHECK_SECONDS, OLLAMA_EJECT_AFTER_FAILURES)
+
+def normalize_topic(topic):
+    return ' '.join((topic or '').lower().split())
+
+def build_ollama_payload(topic, num_questions, level_context, context_samples_str, seed=None):
+    prompt_message = build_ai_quiz_prompt(topic, num_questions, level_context, context_samples_str)
+
+    payload = {
+        "model": OLLAMA_MODEL,
+        "prompt": prompt_message,
+        "format": ai_quiz_response_schema(num_questions) if AI_STRUCTURED_OUTPUT else "json",
+        "stream": AI_STREAMING,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "temperature": 0.1, # Menurunkan temperature lebih rendah lagi untuk konsistensi maksimal
+            "top_p": 0.9 # Menambahkan top_p untuk fokus pada token probabilitas tinggi
+        }
+    }
+    if seed is not None:
+        payload["options"]["seed"] = seed
+    return payload
+
+def generate_raw_ai_quiz_items(payload, deadline=None):
+    # Generator objek soal mentah (belum divalidasi) dari satu panggilan Ollama.
+    # Dalam mode streaming soal dihasilkan begitu objeknya lengkap; konsumen boleh berhenti lebih awal.
+    # Backend dipinjam dari ollama_dispatcher selama stream berlangsung. Circuit breaker diperiksa di sini, di
+    # satu-satunya titik yang benar-benar memanggil Ollama, sehingga hit llm_cache tidak pernah menyelesaikan
+    # panggilan percobaan half_open tanpa Ollama benar-benar dicoba.
+    if not ollama_circuit.allow():
+        raise AICircuitOpen("Layanan model AI sedang tidak tersedia (circuit breaker open). Silakan coba lagi nanti.")
+    with ollama_circuit.guard(), ollama_dispatcher.lease() as backend:
+        print(f"DEBUG: Mengirim payload ke Ollama {backend.base_url}: {json.dumps(payload, indent=2)}")
+        raw_items = None
+        meta = {}
+        started = time.monotonic()
+        was_loaded = backend.loaded_models.get(payload['model'])
+        failed = False
+        try:
+            if AI_STREAMING:
+                raw_items = stream_ollama_quiz_items(backend.generate_url, payload, deadline, meta)
+            else:
+                response = requests.post(backend.generate_url, json=payload, timeout=ollama_timeout(deadline))
+                response.raise_for_status()
+
+                ollama_response_data = response.json()
+                meta.update({field: ollama_response_data[field] for field in OLLAMA_TIMING_FIELDS if field in ollama_response_data})
+                
+                ai_response_content_str = ollama_response_data.get('response', '') 
+                
+                if not ai_response_content_str:
+                    raise ValueError("Model lokal tidak menghasilkan respons yang valid atau respons kosong.")
+
+                print(f"DEBUG: Raw AI Response from Ollama (first 1000 chars):\n{ai_response_content_str[:1000]}\n...")
+                raw_items = parse_ai_quiz_response(ai_response_content_str)
+
+            for item in raw_items:
+                yield item
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if raw_items is not None and hasattr(raw_items, 'close'):
+                raw_items.close()
+            if not failed:
+                ollama_dispatcher.record_generation(backend, payload['model'], time.monotonic() - started, meta, was_loaded)
+
+class AIGenerationFlight:
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+class AIGenerationCoalescer:
+    # Single-flight untuk panggilan Ollama: permintaan bersamaan dengan (topik, level_context, jumlah soal) yang sama
+    # hanya memicu satu generasi. Pemanggil pertama (leader) menjalankan generasi dan menambahkan setiap soal mentah
+    # ke flight; pemanggil lain (follower) ikut membaca soal yang sama begitu muncul, termasuk saat streaming.
+    # Yang dibagi hanya soal mentah: validasi dan pengacakan opsi tetap dilakukan per pengguna.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = Counter()
+
+    def iter_items(self, key, producer, deadline=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = AIGenerationFlight()
+                self._flights[key] = flight
+                self._stats['leaders'] += 1
+            else:
+                self._stats['followers'] += 1
+        if leader:
+            return self._lead(key, flight, producer)
+        print(f"DEBUG: Generasi AI untuk {key} sedang berjalan, permintaan ini ikut menunggu hasilnya.")
+        return self._follow(flight, deadline)
+
+    def _lead(self, key, flight, producer):
+        items = None
+        try:
+            items = producer()
+            for item in items:
+                with flight.condition:
+                    flight.items.append(item)
+                    flight.condition.notify_all()
+                yield copy.deepcopy(item)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            if items is not None and hasattr(items, 'close'):
+                items.close()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            # Jika leader berhenti lebih awal, follower menerima soal yang sudah terkumpul sejauh ini.
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def _follow(self, flight, deadline=None):
+        index = 0
+        while True:
+            with flight.condition:
+                while index >= len(flight.items) and not flight.done:
+                    if deadline is None:
+                        flight.condition.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AIDeadlineExceeded("Batas waktu menunggu generasi AI bersama habis.")
+                    flight.condition.wait(remaining)
+                if index < len(flight.items):
+                    item = flight.items[index]
+                elif flight.error is not None:
+                    raise flight.error
+                else:
+                    return
+            index += 1
+            self._stats['shared_items'] += 1
+            yield copy.deepcopy(item)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        return dict(self._stats, in_flight=in_flight)
+
+ai_generation_coalescer = AIGenerationCoalescer()
+
+AI_CHUNK_SIZE = int(os.getenv('AI_CHUNK_SIZE', 5))
+AI_CHUNK_CONCURRENCY = int(os.getenv('AI_CHUNK_CONCURRENCY', 2))
+AI_CHUNK_MAX_EXTRA = int(os.getenv('AI_CHUNK_MAX_EXTRA', 2))
+AI_CHUNK_DEADLINE_SECONDS = float(os.getenv('AI_CHUNK_DEADLINE_SECONDS', 180))
+
+ai_chunk_executor = ThreadPoolExecutor(max_workers=AI_CHUNK_CONCURRENCY, thread_name_prefix='ai-chunk')
+ai_chunk_stats = Counter()
+
+def question_dedupe_key(question_text):
+    return ' '.join(str(question_text).lower().split())
+
+def is_duplicate_question(seen, question_text):
+    # True jika teks soal ternormalisasi sudah ada di seen; jika belum, dicatat ke seen
+    dedupe_key = question_dedupe_key(question_text)
+    if dedupe_key in seen:
+        return True
+    seen.add(dedupe_key)
+    return False
+
+def run_ai_quiz_chunk(payload, deadline, use_cache=True):
+    if not use_cache:
+        return list(generate_raw_ai_quiz_items(payload, deadline))
+    cache_key = llm_cache.fingerprint(payload)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached['raw']
+    items = list(generate_raw_ai_quiz_items(payload, deadline))
+    llm_cache.put(cache_key, items)
+    return items
+
+def generate_raw_ai_quiz_items_chunked(db, topic, num_questions, level_context, deadline=None, variant=0, use_cache=True):
+    # Permintaan besar dipecah menjadi beberapa prompt kecil berisi AI_CHUNK_SIZE soal yang dijalankan paralel
+    # (dibatasi AI_CHUNK_CONCURRENCY di seluruh proses). Prompt kecil lebih cepat dan jarang terpotong.
+    # Setiap chunk memakai contoh few-shot dan seed berbeda agar soalnya bervariasi. Seed chunk adalah nomor urut
+    # chunk digeser variant * max_chunks (bukan acak) sehingga prompt yang sama menghasilkan fingerprint yang sama di
+    # llm_cache dan varian yang berbeda tidak berbagi seed chunk. Hasil digabung dan soal
+    # duplikat dibuang; jika ada chunk yang gagal atau kurang, chunk tambahan dikirim sampai jumlah soal
+    # terpenuhi, batas AI_CHUNK_MAX_EXTRA tercapai, atau AI_CHUNK_DEADLINE_SECONDS habis.
+    # Di sini soal hanya dicek strukturnya (is_ai_quiz_item_shaped) dan duplikatnya dibuang; validasi lengkap
+    # dijalankan sekali oleh iter_ai_quiz_items. Soal yang gagal di sana diisi dari bank soal oleh fill_ai_quiz.
+    chunk_deadline = time.monotonic() + AI_CHUNK_DEADLINE_SECONDS
+    deadline = chunk_deadline if deadline is None else min(deadline, chunk_deadline)
+    max_chunks = math.ceil(num_questions / AI_CHUNK_SIZE) + AI_CHUNK_MAX_EXTRA
+    pending = {}
+    seen = set()
+    produced = 0
+    submitted = 0
+    last_error = None
+    try:
+        while produced < num_questions:
+            in_flight = sum(pending.values())
+            while produced + in_flight < num_questions and submitted < max_chunks and time.monotonic() < deadline:
+                chunk_size = min(AI_CHUNK_SIZE, num_questions - produced - in_flight)
+                chunk_variant = variant * max_chunks + submitted
+                context_samples_str = get_few_shot_context(db, level_context, topic, variant=chunk_variant)
+                payload = build_ollama_payload(topic, chunk_size, level_context, context_samples_str, seed=chunk_variant)
+                future = ai_chunk_executor.submit(run_ai_quiz_chunk, payload, deadline, use_cache)
+                pending[future] = chunk_size
+                in_flight += chunk_size
+                submitted += 1
+                ai_chunk_stats['chunks_submitted'] += 1
+                if submitted > math.ceil(num_questions / AI_CHUNK_SIZE):
+                    ai_chunk_stats['top_up_chunks'] += 1
+
+            if not pending:
+                break
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                ai_chunk_stats['deadline_exceeded'] += 1
+                print(f"Peringatan: Batas waktu generasi chunk AI habis dengan {produced}/{num_questions} soal.")
+                break
+            done, _ = wait(pending, timeout=remaining_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                try:
+                    chunk_items = future.result()
+                except Exception as e:
+                    last_error = e
+                    ai_chunk_stats['chunks_failed'] += 1
+                    print(f"Peringatan: Satu chunk generasi AI gagal: {e}")
+                    continue
+                ai_chunk_stats['chunks_done'] += 1
+                for item in chunk_items:
+                    if produced >= num_questions:
+                        break
+                    if not is_ai_quiz_item_shaped(item):
+                        ai_chunk_stats['malformed_dropped'] += 1
+                        continue
+                    dedupe_key = question_dedupe_key(item.get('question'))
+                    if dedupe_key in seen:
+                        ai_chunk_stats['duplicates_dropped'] += 1
+                        continue
+                    seen.add(dedupe_key)
+                    produced += 1
+                    yield item
+    finally:
+        for future in pending:
+            future.cancel()
+
+    if not produced:
+        if last_error is not None:
+            raise last_error
+        if time.monotonic() >= deadline:
+            raise AIDeadlineExceeded("Batas waktu pembuatan soal AI habis.")
+
+def iter_ai_quiz_items(db, topic, num_questions, level_context, deadline=None, variant=0, use_cache=True):
+    # Generator soal AI yang sudah lolos validate_ai_quiz_item. Dipakai fill_ai_quiz dan pengisi pool soal AI.
+    # validate_ai_quiz_item mengacak opsi, jadi pengguna yang berbagi satu generasi tetap mendapat urutan opsi berbeda.
+    # variant menentukan seed dan contoh few-shot; fill_ai_quiz memilih salah satu dari LLM_CACHE_VARIANTS.
+    # Untuk prompt tunggal, hasil mentah dan hasil validasi disimpan di llm_cache; prompt yang sama dilayani dari
+    # cache tanpa Ollama maupun calculate_correct_answer_and_options, hanya urutan opsinya yang diacak ulang.
+    # Pengisi pool memberi variant acak setiap pass dengan use_cache=False: llm_cache dilewati dan generasinya tidak
+    # digabung dengan permintaan pengguna, agar pool tidak terisi salinan soal yang sama.
+    num_questions = int(num_questions)
+    key = (normalize_topic(topic), level_context, num_questions, variant, use_cache)
+    cache_key = None
+    if num_questions > AI_CHUNK_SIZE:
+        producer = lambda: generate_raw_ai_quiz_items_chunked(db, topic, num_questions, level_context, deadline, variant, use_cache)
+    elif not use_cache:
+        payload = build_ollama_payload(topic, num_questions, level_context, get_few_shot_context(db, level_context, topic, variant=variant), seed=variant)
+        producer = lambda: generate_raw_ai_quiz_items(payload, deadline)
+    else:
+        payload = build_ollama_payload(topic, num_questions, level_context, get_few_shot_context(db, level_context, topic, variant=variant), seed=variant)
+        cache_key = llm_cache.fingerprint(payload)
+        cached = llm_cache.get(cache_key)
+        if cached is not None and cached['validated']:
+            for cached_item in cached['validated']:
+                cached_item = copy.deepcopy(cached_item)
+                random.shuffle(cached_item['options'])
+                yield cached_item
+            return
+        producer = lambda: generate_raw_ai_quiz_items(payload, deadline)
+
+    raw_items = ai_generation_coalescer.iter_items(key, producer, deadline)
+    raw_list = []
+    validated_list = []
+    failed = False
+    try:
+        for item in raw_items:
+            raw_list.append(copy.deepcopy(item))
+            validated_item = validate_ai_quiz_item(item)
+            if validated_item is not None:
+                validated_list.append(copy.deepcopy(validated_item))
+                yield validated_item
+    except Exception:
+        failed = True
+        raise
+    finally:
+        raw_items.close()
+        if cache_key is not None and not failed and validated_list:
+            llm_cache.put(cache_key, raw_list, validated_list)
+
+AI_POOL_ENABLED = os.getenv('AI_POOL_ENABLED', '1') == '1'
+AI_POOL_SIZE = int(os.getenv('AI_POOL_SIZE', 30))
+AI_POOL_REFILL_BATCH = int(os.getenv('AI_POOL_REFILL_BATCH', 10))
+AI_POOL_TTL_SECONDS = int(os.getenv('AI_POOL_TTL_SECONDS', 7 * 24 * 3600))
+AI_POOL_REFILL_WORKERS = int(os.getenv('AI_POOL_REFILL_WORKERS', 1))
+
+class AIQuestionPool:
+    # Pool soal AI yang sudah divalidasi per (level_context, topik ternormalisasi), disimpan di tabel ai_question_pool.
+    # Kuis AI mengambil soal dari pool lebih dulu (setiap soal dipakai sekali lalu dihapus) dan hanya sisanya yang
+    # dibuat oleh Ollama. Setiap kali sebuah topik diminta, pool topik itu diisi ulang di latar belakang sampai
+    # AI_POOL_SIZE soal. Soal yang lebih tua dari AI_POOL_TTL_SECONDS tidak dipakai lagi dan dibuang saat pengisian.
+    def __init__(self, target_size, refill_batch, ttl, max_workers):
+        self.target_size = target_size
+        self.refill_batch = refill_batch
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._refilling = set()
+        self._stats = Counter()
+        self._refill_latencies = deque(maxlen=100)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ai-pool-refill')
+            return self._executor
+
+    def take(self, db, level_context, topic, num_questions, partial=True, commit=True):
+        # Mengambil dan menghapus hingga num_questions soal dari pool secara atomik. SKIP LOCKED membuat
+        # permintaan bersamaan mengambil soal yang berbeda tanpa saling menunggu. Jika partial=False dan pool
+        # tidak cukup, tidak ada soal yang diambil. Dengan commit=False penghapusan belum di-commit: pemanggil
+        # meng-commit-nya bersama soal yang disimpannya, atau rollback mengembalikan soal ke pool.
+        topic_key = normalize_topic(topic)
+        items = []
+        cursor = db.cursor(dictionary=True)
+        try:
+            cursor.execute(
+                "SELECT id, question, options, correct_answer FROM ai_question_pool WHERE level_context = %s AND topic_key = %s AND expires_at > NOW() ORDER BY id ASC LIMIT %s FOR UPDATE SKIP LOCKED",
+                (level_context, topic_key, num_questions)
+            )
+            rows = cursor.fetchall()
+            if rows and (partial or len(rows) >= num_questions):
+                placeholders = ', '.join(['%s'] * len(rows))
+                cursor.execute(f"DELETE FROM ai_question_pool WHERE id IN ({placeholders})", tuple(row['id'] for row in rows))
+                items = [{'question': row['question'], 'options': json.loads(row['options']), 'correct_answer': row['correct_answer'], 'source': 'pool'} for row in rows]
+            # Jika tidak ada soal yang diambil, lock baris dari FOR UPDATE langsung dilepas
+            if commit or not items:
+                db.commit()
+        except mysql.connector.Error as e:
+            print(f"Error saat mengambil soal dari pool AI: {e}")
+            if commit:
+                db.rollback()
+            items = []
+        finally:
+            cursor.close()
+
+        self._stats['requests'] += 1
+        self._stats['questions_requested'] += num_questions
+        self._stats['questions_served'] += len(items)
+        if len(items) >= num_questions:
+            self._stats['hits'] += 1
+        elif items:
+            self._stats['partial_hits'] += 1
+        else:
+            self._stats['misses'] += 1
+        print(f"DEBUG: Pool AI ({level_context}, '{topic_key}'): {len(items)}/{num_questions} soal diambil dari pool.")
+        self.schedule_refill(level_context, topic)
+        return items
+
+    def schedule_refill(self, level_context, topic):
+        key = (level_context, normalize_topic(topic))
+        if not key[1]:
+            return
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+        self._get_executor().submit(self._refill, level_context, topic, key)
+
+    def _refill(self, level_context, topic, key):
+        try:
+            with app.app_context():
+                db = get_db()
+                cursor = db.cursor()
+                try:
+                    cursor.execute("DELETE FROM ai_question_pool WHERE level_context = %s AND topic_key = %s AND expires_at <= NOW()", key)
+                    self._stats['expired'] += cursor.rowcount
+                    cursor.execute("SELECT COUNT(*) FROM ai_question_pool WHERE level_context = %s AND topic_key = %s", key)
+                    depth = cursor.fetchone()[0]
+                    db.commit()
+                finally:
+                    cursor.close()
+
+                while depth < self.target_size:
+                    batch_size = min(self.refill_batch, self.target_size - depth)
+                    started = time.monotonic()
+                    items = []
+                    try:
+                        for item in iter_ai_quiz_items(db, topic, batch_size, level_context, variant=random.randrange(1, 2 ** 24), use_cache=False):
+                            items.append(item)
+                            if len(items) >= batch_size:
+                                break
+                    except AICircuitOpen:
+                        self._stats['refill_skipped_circuit_open'] += 1
+                        break
+                    elapsed = time.monotonic() - started
+                    if not items:
+                        self._stats['refill_empty'] += 1
+                        break
+                    stored = self._store(db, key, items)
+                    depth += stored
+                    with self._lock:
+                        self._refill_latencies.append(elapsed)
+                    self._stats['refills'] += 1
+                    self._stats['questions_added'] += stored
+                    print(f"DEBUG: Pool AI {key} diisi {stored}/{len(items)} soal dalam {elapsed:.1f} detik (kedalaman {depth}).")
+                    if not stored:
+                        # Semua soal sudah ada di pool; berhenti agar tidak terus memanggil Ollama untuk salinan
+                        self._stats['refill_all_duplicates'] += 1
+                        break
+        except Exception as e:
+            self._stats['refill_failures'] += 1
+            print(f"ERROR: Gagal mengisi ulang pool soal AI {key}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def _store(self, db, key, items):
+        # Soal yang teks ternormalisasinya sudah ada di pool topik ini (atau muncul dua kali di batch) dibuang.
+        # Mengembalikan jumlah soal yang benar-benar disimpan.
+        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=self.ttl)
+        cursor = db.cursor()
+        try:
+            cursor.execute("SELECT question FROM ai_question_pool WHERE level_context = %s AND topic_key = %s", key)
+            seen = {question_dedupe_key(row[0]) for row in cursor.fetchall()}
+            rows = []
+            for item in items:
+                dedupe_key = question_dedupe_key(item['question'])
+                if dedupe_key in seen:
+                    self._stats['duplicates_dropped'] += 1
+                    continue
+                seen.add(dedupe_key)
+                rows.append((key[0], key[1], item['question'], json.dumps(item['options']), item['correct_answer'], expires_at))
+            if rows:
+                cursor.executemany(
+                    "INSERT INTO ai_question_pool (level_context, topic_key, question, options, correct_answer, expires_at) VALUES (%s, %s, %s, %s, %s, %s)",
+                    rows
+                )
+            db.commit()
+            return len(rows)
+        except mysql.connector.Error:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def depths(self, db):
+        cursor = db.cursor()
+        try:
+            cursor.execute("SELECT level_context, topic_key, COUNT(*) FROM ai_question_pool WHERE expires_at > NOW() GROUP BY level_context, topic_key")
+            return {f"{level_context}:{topic_key}": count for level_context, topic_key, count in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def stats(self, db=None):
+        with self._lock:
+            latencies = list(self._refill_latencies)
+            refilling = [f"{level_context}:{topic_key}" for level_context, topic_key in self._refilling]
+        result = dict(self._stats, refilling=refilling)
+        requested = self._stats['questions_requested']
+        result['hit_rate'] = round(self._stats['questions_served'] / requested, 3) if requested else None
+        if latencies:
+            result['refill_latency_avg_seconds'] = round(sum(latencies) / len(latencies), 3)
+            result['refill_latency_max_seconds'] = round(max(latencies), 3)
+        if db is not None:
+            try:
+                result['depth'] = self.depths(db)
+            except mysql.connector.Error as e:
+                result['depth_error'] = str(e)
+        return result
+
+ai_question_pool = AIQuestionPool(AI_POOL_SIZE, AI_POOL_REFILL_BATCH, AI_POOL_TTL_SECONDS, AI_POOL_REFILL_WORKERS)
+
+ai_fallback_stats = Counter()
+
+def store_ai_quiz_items(db, quiz_history_id, items):
+    try:
+        insert_quiz_taken_questions(db, quiz_history_id, items)
+        db.commit()
+    except mysql.connector.Error as e:
+        print(f"Error saving AI questions to quiz_taken_questions: {e}")
+        db.rollback()
+        raise QuizGenerationError(f"Gagal menyimpan detail soal AI: {str(e)}")
+
+def sample_bank_questions(db, level_context, num_questions, exclude_questions=()):
+    # Soal cadangan dari bank quiz_questions untuk level yang sama, dipakai saat Ollama lambat atau gagal.
+    excluded = {question_dedupe_key(q) for q in exclude_questions}
+    items = []
+    for q in question_sampler.sample(db, level_context, num_questions + len(excluded)):
+        try:
+            options_list = json.loads(q['options'])
+        except json.JSONDecodeError:
+            continue
+        if len(options_list) < 4 or q['correct_answer'] not in options_list or question_dedupe_key(q['question']) in excluded:
+            continue
+        items.append({'question': q['question'], 'options': options_list, 'correct_answer': q['correct_answer'], 'source': 'bank'})
+        if len(items) >= num_questions:
+            break
+    return items
+
+def describe_ai_error(e):
+    if isinstance(e, QuizGenerationError):
+        return e
+    if isinstance(e, AIDeadlineExceeded):
+        return QuizGenerationError(f"{e} Coba lagi dengan jumlah soal lebih sedikit.", 504)
+    if isinstance(e, AICircuitOpen):
+        return QuizGenerationError(str(e), 503)
+    if isinstance(e, requests.exceptions.RequestException):
+        error_message = str(e)
+        if hasattr(e, 'response') and e.response is not None:
+            try:
+                error_json = e.response.json()
+                error_message = error_json.get('error', error_message)
+            except json.JSONDecodeError:
+                pass
+        return QuizGenerationError(f"{error_message}. Pastikan Ollama berjalan dan model '{OLLAMA_MODEL}' sudah diunduh.")
+    if isinstance(e, ValueError):
+        return QuizGenerationError(f"Gagal menghasilkan kuis dengan model lokal: {str(e)}")
+    return QuizGenerationError(f"Terjadi kesalahan tak terduga saat menghasilkan kuis AI: {str(e)}")
+
+def fill_ai_quiz(quiz_history_id, topic, num_questions, level_context, on_item=None):
+    # Membuat soal AI untuk quiz_history yang sudah ada dan menyimpannya ke quiz_taken_questions.
+    # Dipakai oleh jalur sinkron (generate_ai_quiz) maupun job latar belakang (AIQuizJobRunner).
+    # Soal diambil dari pool soal AI lebih dulu; hanya kekurangannya yang dibuat oleh Ollama.
+    # Dalam mode streaming setiap soal divalidasi dan disimpan begitu objeknya lengkap, lalu diteruskan ke
+    # on_item, dan stream dihentikan segera setelah num_questions soal valid terkumpul.
+    # Generasi dibatasi AI_QUIZ_DEADLINE_SECONDS dan circuit breaker Ollama. Jika Ollama gagal, lambat, atau
+    # hanya menghasilkan sebagian soal, kekurangannya diisi dari bank soal level yang sama. Setiap soal
+    # membawa field 'source': 'pool', 'ai', atau 'bank'. Soal dengan teks yang sama (setelah normalisasi) hanya
+    # dipakai sekali dalam satu kuis, baik dari pool maupun dari generasi AI.
+    db = get_db()
+    deadline = time.monotonic() + AI_QUIZ_DEADLINE_SECONDS
+    validated_quiz_items = []
+    seen_questions = set()
+    ai_error = None
+
+    if AI_POOL_ENABLED:
+        pooled_items = ai_question_pool.take(db, level_context, topic, num_questions, commit=False)
+        pooled_items = [item for item in pooled_items if not is_duplicate_question(seen_questions, item['question'])]
+        if pooled_items:
+            # Penghapusan dari pool di-commit bersama insert soalnya; jika insert gagal soal kembali ke pool
+            store_ai_quiz_items(db, quiz_history_id, pooled_items)
+            for pooled_item in pooled_items:
+                if on_item:
+                    on_item(pooled_item)
+            validated_quiz_items.extend(pooled_items)
+            if len(validated_quiz_items) >= num_questions:
+                print(f"DEBUG: Semua {num_questions} soal kuis AI untuk quiz_history_id {quiz_history_id} diambil dari pool.")
+                return validated_quiz_items
+
+    remaining = num_questions - len(validated_quiz_items)
+    generated_items = None
+    new_items = []
+    try:
+        generated_items = iter_ai_quiz_items(db, topic, remaining, level_context, deadline, variant=random.randrange(LLM_CACHE_VARIANTS))
+        for validated_item in generated_items:
+            if is_duplicate_question(seen_questions, validated_item['question']):
+                ai_fallback_stats['duplicates_dropped'] += 1
+                print(f"DEBUG: Soal AI duplikat dibuang untuk quiz_history_id {quiz_history_id}: {validated_item['question']}")
+                continue
+            validated_item['source'] = 'ai'
+            if AI_STREAMING:
+                store_ai_quiz_items(db, quiz_history_id, [validated_item])
+                print(f"DEBUG: Soal AI ke-{len(validated_quiz_items) + 1} disimpan untuk quiz_history_id {quiz_history_id}.")
+                if on_item:
+                    on_item(validated_item)
+            validated_quiz_items.append(validated_item)
+            new_items.append(validated_item)
+            if len(validated_quiz_items) >= num_questions:
+                break
+        if not new_items:
+            ai_error = QuizGenerationError("Model lokal menghasilkan JSON, namun tidak ada soal yang memenuhi format yang diharapkan (setiap soal harus memiliki 'question', array 'options' dengan TEPAT 4, dan 'correct_answer' yang sesuai dengan opsi).")
+    except QuizGenerationError:
+        raise
+    except AICircuitOpen as e:
+        print(f"Peringatan: Circuit breaker Ollama open, kuis {quiz_history_id} dilayani dari bank soal.")
+        ai_error = describe_ai_error(e)
+    except Exception as e:
+        print(f"ERROR: {type(e).__name__} di fill_ai_quiz: {e}")
+        ai_error = describe_ai_error(e)
+    finally:
+        if generated_items is not None:
+            generated_items.close()
+
+    if not AI_STREAMING and new_items:
+        print(f"DEBUG: Validated quiz items to be stored in quiz_taken_questions for quiz_history_id {quiz_history_id}: {json.dumps(new_items, indent=2)}") 
+        store_ai_quiz_items(db, quiz_history_id, new_items)
+
+    shortfall = num_questions - len(validated_quiz_items)
+    if shortfall > 0 and AI_FALLBACK_TO_BANK:
+        bank_items = sample_bank_questions(db, level_context, shortfall, [item['question'] for item in validated_quiz_items])
+        if bank_items:
+            store_ai_quiz_items(db, quiz_history_id, bank_items)
+            for bank_item in bank_items:
+                if on_item:
+                    on_item(bank_item)
+            validated_quiz_items.extend(bank_items)
+            ai_fallback_stats['padded_quizzes' if len(bank_items) < num_questions else 'full_fallbacks'] += 1
+            ai_fallback_stats['bank_questions'] += len(bank_items)
+            print(f"DEBUG: {len(bank_items)} soal kuis {quiz_history_id} diisi dari bank soal level {level_context}.")
+
+    if not validated_quiz_items:
+        raise ai_error or QuizGenerationError("Tidak ada soal yang dapat dibuat untuk kuis ini.")
+
+    print(f"DEBUG: Detail soal kuis AI disimpan ke quiz_taken_questions untuk quiz_history_id: {quiz_history_id}")
+    return validated_quiz_items
+
 @app.route('/quiz')
 @login_required
 def quiz():
@@ -837,42 +3381,38 @@ def quiz():
     num_questions = request.args.get('num_questions', type=int)
     topic = request.args.get('topic')
     level_context = request.args.get('level_context')
+    user_id = session.get('user_id')
 
     print(f"DEBUG: Memulai rute /quiz. Tipe: {quiz_type}, Topik: {topic}, Level: {level}, Level Konteks: {level_context}, Jumlah Soal: {num_questions}")
-    print(f"DEBUG: session['user_id'] di /quiz: {session.get('user_id')}")
+    print(f"DEBUG: session['user_id'] di /quiz: {user_id}")
 
     session.pop('temp_quiz_items', None)
     session.pop('current_quiz_id', None)
 
     try:
         if quiz_type == 'manual':
-            response = requests.post(
-                url_for('api_generate_quiz', _external=True),
-                json={'level': level, 'num_questions': num_questions},
-                headers={'Content-Type': 'application/json', 'Cookie': request.headers.get('Cookie')}
-            )
-            response.raise_for_status()
-            data = response.json()
-            quiz_data = data.get('quiz', [])
-            quiz_history_id = data.get('quiz_history_id')
-            print(f"DEBUG: API Manual Quiz Response: quiz_history_id={quiz_history_id}, quiz_data_len={len(quiz_data)}")
-
+            data = generate_manual_quiz(user_id, level, num_questions)
         elif quiz_type == 'ai':
-            response = requests.post(
-                url_for('api_generate_quiz_ai', _external=True),
-                json={'topic': topic, 'num_questions': num_questions, 'level_context': level_context},
-                headers={'Content-Type': 'application/json', 'Cookie': request.headers.get('Cookie')}
-            )
-            response.raise_for_status()
-            data = response.json()
-            quiz_data = data.get('quiz', [])
-            quiz_history_id = data.get('quiz_history_id')
-            print(f"DEBUG: API AI Quiz Response: quiz_history_id={quiz_history_id}, quiz_data_len={len(quiz_data)}")
-
+            # Kuis AI dibuat oleh job latar belakang; halaman kuis menunggu job selesai lewat endpoint status.
+            job = ai_job_runner.submit(user_id, topic, num_questions, level_context)
+            session['current_quiz_id'] = job['quiz_history_id']
+            return render_template('quiz.html',
+                                   quiz_data_json=None,
+                                   quiz_history_id=job['quiz_history_id'],
+                                   ai_job_id=job['job_id'],
+                                   quiz_type=quiz_type,
+                                   topic=topic,
+                                   level=level,
+                                   num_questions=num_questions,
+                                   level_context=level_context)
         else:
             flash("Tipe kuis tidak valid.", 'error')
             return redirect(url_for('dashboard'))
 
+        quiz_data = data.get('quiz', [])
+        quiz_history_id = data.get('quiz_history_id')
+        print(f"DEBUG: Kuis {quiz_type} dibuat: quiz_history_id={quiz_history_id}, quiz_data_len={len(quiz_data)}")
+
         if not quiz_data:
             flash('Gagal menghasilkan kuis. Tidak ada soal yang valid.', 'error')
             return redirect(url_for('dashboard'))
@@ -893,16 +3433,9 @@ def quiz():
                                num_questions=num_questions,
                                level_context=level_context)
 
-    except requests.exceptions.RequestException as e:
-        error_message = str(e)
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_json = e.response.json()
-                error_message = error_json.get('error', error_message)
-            except json.JSONDecodeError:
-                pass
-        flash(f"Gagal memuat kuis: {error_message}. Pastikan Ollama berjalan dan model 'llama3' sudah diunduh jika menggunakan AI.", 'error')
-        print(f"ERROR: RequestException di /quiz ({quiz_type}): {e}")
+    except QuizGenerationError as e:
+        flash(f"Gagal memuat kuis: {e.message}", 'error')
+        print(f"ERROR: QuizGenerationError di /quiz ({quiz_type}): {e}")
         return redirect(url_for('dashboard'))
     except Exception as e:
         flash(f"Terjadi kesalahan tak terduga saat memuat kuis: {e}", 'error')
@@ -916,76 +3449,10 @@ def api_generate_quiz():
     data = request.json
     level = data.get('level')
     num_questions = data.get('num_questions', 5)
-    user_id = session.get('user_id')
-
-    print(f"DEBUG: api_generate_quiz (Manual) dipanggil oleh user_id: {user_id} untuk level: {level}, jumlah soal: {num_questions}")
-
-    db = get_db()
-    cursor = db.cursor()
-    quiz_history_id = None
-    try:
-        cursor.execute(
-            "INSERT INTO quiz_history (user_id, level, topic, score, total_questions, timestamp) VALUES (%s, %s, %s, %s, %s, %s)",
-            (user_id, level, 'Manual', 0, num_questions, datetime.datetime.now())
-        )
-        db.commit()
-        quiz_history_id = cursor.lastrowid
-        print(f"DEBUG: quiz_history_id (Manual API) berhasil dibuat: {quiz_history_id}")
-    except mysql.connector.Error as e:
-        print(f"Error saving manual quiz to DB: {e}")
-        db.rollback()
-        return jsonify({"error": f"Gagal menyimpan riwayat kuis awal: {str(e)}"}), 500
-    finally:
-        cursor.close()
-
-
-    quiz_items = []
-    db = get_db()
-    cursor = db.cursor(dictionary=True)
-
-    cursor.execute("SELECT id, question, options, correct_answer FROM quiz_questions WHERE level = %s ORDER BY RAND() LIMIT %s", (level, num_questions))
-    questions_from_db = cursor.fetchall()
-    
-    questions_to_return = []
     try:
-        quiz_taken_cursor = db.cursor()
-        for q in questions_from_db:
-            try:
-                options_list = json.loads(q['options'])
-                if len(options_list) >= 4 and q['correct_answer'] in options_list:
-                    quiz_taken_cursor.execute(
-                        "INSERT INTO quiz_taken_questions (quiz_history_id, question_text, options_json, correct_answer, user_answer, is_correct) VALUES (%s, %s, %s, %s, %s, %s)",
-                        (quiz_history_id, q['question'], json.dumps(options_list), q['correct_answer'], None, None)
-                    )
-                    questions_to_return.append({
-                        'id': quiz_taken_cursor.lastrowid,
-                        'question': q['question'],
-                        'options': options_list,
-                        'correct_answer': q['correct_answer']
-                    })
-                else:
-                    print(f"Warning: Soal dari DB tidak valid (opsi < 4 atau jawaban tidak ada di opsi): {q['question']}")
-            except json.JSONDecodeError as e:
-                print(f"Warning: Opsi soal dari DB tidak valid JSON: {q['options']} - {e}")
-            except Exception as e:
-                print(f"Warning: Error memproses soal dari DB: {e} - {q['question']}")
-        db.commit()
-        print(f"DEBUG: Detail soal kuis manual disimpan ke quiz_taken_questions untuk quiz_history_id: {quiz_history_id}")
-    except mysql.connector.Error as e:
-        print(f"Error saving questions to quiz_taken_questions: {e}")
-        db.rollback()
-        return jsonify({"error": f"Gagal menyimpan detail soal: {str(e)}"}), 500
-    finally:
-        quiz_taken_cursor.close()
-    
-    quiz_items = questions_to_return
-
-    cursor.close()
-
-    if not quiz_items:
-        return jsonify({"error": "Tidak ada soal yang tersedia untuk level ini."}), 404
-
-    return jsonify({"quiz": quiz_items[:num_questions], "quiz_history_id": quiz_history_id}) 
+        return jsonify(generate_manual_quiz(session.get('user_id'), level, num_questions))
+    except QuizGenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
 
 @app.route('/api/generate_quiz_ai', methods=['POST'])
 @login_required
@@ -994,239 +3461,411 @@ def api_generate_quiz_ai():
     topic = data.get('topic')
     num_questions = data.get('num_questions', 1)
     level_context = data.get('level_context', 'SD')
-    user_id = session.get('user_id')
-
-    print(f"DEBUG: api_generate_quiz_ai (AI) dipanggil oleh user_id: {user_id} untuk topik: {topic}, level: {level_context}, jumlah soal: {num_questions}")
-
-    db = get_db()
-    cursor = db.cursor()
-    quiz_history_id = None
     try:
-        cursor.execute(
-            "INSERT INTO quiz_history (user_id, level, topic, score, total_questions, timestamp) VALUES (%s, %s, %s, %s, %s, %s)",
-            (user_id, level_context, topic, 0, num_questions, datetime.datetime.now())
-        )
-        db.commit()
-        quiz_history_id = cursor.lastrowid
-        print(f"DEBUG: quiz_history_id (AI API) berhasil dibuat: {quiz_history_id}")
-    except mysql.connector.Error as e:
-        print(f"Error saving AI quiz to DB: {e}")
-        db.rollback()
-        return jsonify({"error": f"Gagal menyimpan riwayat kuis AI awal: {str(e)}"}), 500
-    finally:
-        cursor.close()
-
+        return jsonify(generate_ai_quiz(session.get('user_id'), topic, num_questions, level_context))
+    except QuizGenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+
+AI_JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', 2))
+AI_JOB_MAX_PENDING = int(os.getenv('AI_JOB_MAX_PENDING', 50))
+AI_JOB_MAX_ATTEMPTS = int(os.getenv('AI_JOB_MAX_ATTEMPTS', 2))
+AI_JOB_HEARTBEAT_SECONDS = int(os.getenv('AI_JOB_HEARTBEAT_SECONDS', 15))
+AI_JOB_STALE_SECONDS = int(os.getenv('AI_JOB_STALE_SECONDS', 90)) # harus beberapa kali AI_JOB_HEARTBEAT_SECONDS
+AI_JOB_SWEEP_SECONDS = int(os.getenv('AI_JOB_SWEEP_SECONDS', 60))
+
+class AIQuizJobRunner:
+    # Job pembuatan kuis AI di latar belakang: panggilan Ollama tidak lagi menahan worker web.
+    # Job disimpan di tabel ai_quiz_jobs sehingga tidak hilang saat worker restart; setiap worker
+    # mengklaim job secara atomik (status queued -> running) agar satu job hanya dikerjakan sekali.
+    # Selama job berjalan, thread maintenance memperbarui updated_at setiap AI_JOB_HEARTBEAT_SECONDS dan setiap
+    # AI_JOB_SWEEP_SECONDS menyapu job running tanpa heartbeat (workernya mati) serta job queued yang tidak
+    # dikerjakan proses mana pun, lalu menjadwalkannya ulang di proses ini.
+    def __init__(self, max_workers, max_pending):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._scheduled = set()
+        self._running = set()
+        self._maintenance_thread = None
+        self._updates = threading.Condition()
+        self._update_versions = {}
+        self._finished_at = {}
+        self._stats = Counter()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ai-quiz-job')
+            return self._executor
+
+    def _reserve(self, job_id=None, force=False):
+        # Cek kapasitas dan penambahan _pending dalam satu langkah di bawah lock, agar permintaan bersamaan
+        # tidak sama-sama lolos cek lalu melebihi max_pending.
+        with self._lock:
+            if job_id is not None and job_id in self._scheduled:
+                return False
+            if not force and self._pending >= self.max_pending:
+                self._stats['rejected' if job_id is None else 'sweep_deferred'] += 1
+                return False
+            self._pending += 1
+            if job_id is not None:
+                self._scheduled.add(job_id)
+            return True
+
+    def _release(self, job_id=None):
+        with self._lock:
+            self._pending -= 1
+            self._scheduled.discard(job_id)
+
+    def submit(self, user_id, topic, num_questions, level_context):
+        if not self._reserve():
+            raise QuizGenerationError("Antrean pembuatan kuis AI sedang penuh. Silakan coba lagi sebentar lagi.", 503)
 
-    try:
         db = get_db()
-        cursor = db.cursor(dictionary=True)
-        cursor.execute("SELECT question, options, correct_answer FROM quiz_questions WHERE level = %s ORDER BY RAND() LIMIT 1", (level_context,))
-        context_sample_db = cursor.fetchone()
-        cursor.close()
-
-        context_samples_str = ""
-        if context_sample_db:
-            options_list = json.loads(context_sample_db['options'])
-            if len(options_list) == 4 and context_sample_db['correct_answer'] in options_list:
-                context_samples_str = (
-                    f'{{"question": {json.dumps(context_sample_db["question"])}, '
-                    f'"options": [{json.dumps(options_list[0])}, {json.dumps(options_list[1])}, {json.dumps(options_list[2])}, {json.dumps(options_list[3])}], '
-                    f'"correct_answer": {json.dumps(context_sample_db["correct_answer"])}}}' # FIX: changed context_list to context_sample_db
-                )
-            else:
-                print(f"Warning: Contoh soal dari DB tidak valid untuk few-shot: {context_sample_db['question']}")
-        
-        if not context_samples_str:
-            context_samples_str = get_sample_questions_from_csv(level_context, num_samples=1)
-            if not context_samples_str:
-                 print("Warning: Tidak ada contoh soal valid dari DB maupun CSV default untuk few-shot learning.")
-
-
-        ollama_api_url = "http://localhost:11434/api/generate"
-        model_name = "llama3" 
-
-        prompt_message = f"""
-        Anda adalah pembuat soal kuis matematika yang presisi dan **AKURAT 100%**.
-        Buat **TEPAT {num_questions} soal** pilihan ganda baru.
-        Soal-soal ini **HARUS** mengenai topik **{topic}** dan **khususnya BERSIFAT MATEMATIKA MURNI** (bukan sekadar tentang '{topic}' secara umum, tapi operasi/konsep matematika langsung).
-        Tingkat kesulitan dan gaya soal harus **mirip dengan soal {level_context}** dan **sesuai untuk anak-anak {level_context}**.
-        
-        **Fokus utama adalah soal-soal sederhana, langsung, dan berbasis perhitungan atau konsep dasar.**
-        **JANGAN membuat soal cerita yang panjang, skenario rumit, atau pertanyaan yang membutuhkan banyak konteks.**
-        **Contoh soal yang diharapkan (fokus pada perhitungan langsung, semua opsi adalah angka):**
-        - "Hasil dari 5 + 3 adalah..." (Opsi: 7, 8, 9, 10. Jawaban: 8)
-        - "Angka setelah 10 adalah..." (Opsi: 9, 10, 11, 12. Jawaban: 11)
-        - "Bentuk desimal dari 3/4 adalah..." (Opsi: 0.25, 0.50, 0.75, 1.00. Jawaban: 0.75)
-        - "Akar kuadrat dari 49 adalah..." (Opsi: 6, 7, 8, 9. Jawaban: 7)
-        - "Modus dari data 5, 7, 5, 8, 9 adalah..." (Opsi: 5, 6, 7, 8. Jawaban: 5)
-        - "2 kg = ... gram" (Opsi: 20, 200, 2000, 0.002. Jawaban: 2000)
-        - "Pembulatan 67 ke puluhan terdekat adalah..." (Opsi: 60, 65, 70, 80. Jawaban: 70)
-        - "Dua 500-an = ..." (Opsi: 500, 1000, 1500, 2000. Jawaban: 1000)
-        - "Tiga 2000-an = ..." (Opsi: 2000, 4000, 6000, 8000. Jawaban: 6000)
-        - "Nilai tengah dari data yang sudah diurutkan adalah..." (Opsi: rata-rata, median, modus, jangkauan. Jawaban: median)
-        - "Satuan berat baku adalah..." (Opsi: meter, liter, kilogram, detik. Jawaban: kilogram)
-        - "Satuan suhu adalah..." (Opsi: meter, kilogram, celcius, liter. Jawaban: celcius)
-        - "1/2 ... 0,5 =" (Opsi: =, >, !=, <. Jawaban: =)
-        - "Volume sisi 3 cm =" (Opsi: 9, 12, 27, 81. Jawaban: 27)
-        - "Ganjil antara 10 dan 20 =" (Opsi: "10 12 14 16 18", "11 13 15 17 19", "12 14 16 18 20", "11 12 13 14 15". Jawaban: "11 13 15 17 19")
-        - "5 x 6 - 15 : 3 =" (Opsi: 5, 15, 25, 35. Jawaban: 25)
-        - "Buku 5000 + pensil 1000 =" (Opsi: 4000, 5000, 6000, 7000. Jawaban: 6000)
-        - "1 triwulan = ... bulan" (Opsi: 2, 3, 4, 6. Jawaban: 3)
-        - "Keliling sisi 8 cm =" (Opsi: 16, 24, 32, 64. Jawaban: 32)
-
-
-        --- Contoh Referensi Soal dari Dataset Saya (Sangat Penting untuk Diikuti) ---
-        {context_samples_str if context_samples_str else "Tidak ada contoh yang tersedia. Buat soal berdasarkan topik dan level."}
-        --- Akhir Contoh Referensi ---\n
-        **Setiap soal yang Anda hasilkan WAJIB memiliki format JSON berikut:**
-        {{
-            "question": "Teks soal pertanyaan matematika yang jelas, singkat, dan langsung.",
-            "options": ["Pilihan A (angka/nilai)", "Pilihan B (angka/nilai)", "Pilihan C (angka/nilai)", "Pilihan D (angka/nilai)"],
-            "correct_answer": "Jawaban yang BENAR SECARA MATEMATIKA untuk 'question' yang Anda buat. Ini HARUS SAMA PERSIS dengan salah satu dari empat 'options' yang Anda berikan. Pastikan ini adalah nilai numerik atau string yang tepat, BUKAN KATA-KATA NON-NUMERIK JIKA SOALNYA NUMERIK."
-        }}
-
-        **FORMAT PENTING & ATURAN KETAT (BACA DAN IKUTI DENGAN SANGAT HATI-HATI):**
-        1.  Output Anda **HARUS berupa JSON array yang VALID**, berisi **TEPAT {num_questions} objek soal**.
-        2.  **JANGAN tambahkan teks lain di awal atau akhir** selain JSON array.
-        3.  **JANGAN gunakan kurung kurawal ganda** seperti `{{` atau `}}` di output JSON Anda.
-        4.  **Mulailah output Anda dengan karakter `[` dan akhiri dengan `]`** untuk memastikan ini adalah array JSON yang lengkap.
-        5.  Setiap soal **WAJIB memiliki TEPAT 4 pilihan jawaban yang berbeda dan relevan**.
-        6.  **PENTING SEKALI: Salah satu dari pilihan ini (options) HARUS menjadi `correct_answer` yang benar secara matematis.** Pastikan `correct_answer` adalah nilai yang sama persis dengan salah satu opsi.
-        7.  **SANGAT PENTING: Opsi jawaban (Pilihan A, B, C, D) HARUS berupa angka atau nilai yang relevan secara matematis.** JANGAN PERNAH menyertakan kata-kata non-matematika atau konsep yang tidak terkait (misalnya, "kubus", "celcius", "lancip", "sejajar", "kerucut", "segitiga", "balok", "ruas", "batang", "lingkaran", "garis", "gambar") sebagai opsi jika soalnya adalah perhitungan atau konsep angka.
-        8.  Untuk ekspresi matematika, gunakan angka biasa dan simbol operasi matematika standar (misal: `+`, `-`, `*`, `/`) atau kata-kata (misal: 'pecahan', 'pangkat') daripada notasi khusus (misal: $\\frac{{1}}{{2}}$, $10^2$). Contoh: '1 per 2' atau '1 dibagi 2' untuk pecahan, '10 pangkat 2' untuk eksponen.
-        9.  **Pastikan soal-soal yang dihasilkan masuk akal, relevan secara matematika, dan jawabannya AKURAT 100%.**
-        10. **PERIKSA KEMBALI JAWABAN ANDA SENDIRI** sebelum menghasilkan output. Pastikan perhitungan Anda benar.
-
-        Hasilkan JSON array yang sama persis seperti contoh di atas, tetapi dengan {num_questions} soal baru yang sesuai topik dan tingkat kesulitan.
-        """
-        
-        payload = {
-            "model": model_name,
-            "prompt": prompt_message,
-            "format": "json",
-            "stream": False,
-            "options": {
-                "temperature": 0.1, # Menurunkan temperature lebih rendah lagi untuk konsistensi maksimal
-                "top_p": 0.9 # Menambahkan top_p untuk fokus pada token probabilitas tinggi
-            }
-        }
-
-        print(f"DEBUG: Mengirim payload ke Ollama: {json.dumps(payload, indent=2)}")
-
-        response = requests.post(ollama_api_url, json=payload)
-        response.raise_for_status()
-
-        ollama_response_data = response.json()
-        
-        ai_response_content_str = ollama_response_data.get('response', '') 
-        
-        if not ai_response_content_str:
-            raise ValueError("Model lokal tidak menghasilkan respons yang valid atau respons kosong.")
-
-        print(f"DEBUG: Raw AI Response from Ollama (first 1000 chars):\n{ai_response_content_str[:1000]}\n...")
-
-        extracted_json_str = fix_json_string(ai_response_content_str)
-        
-        print(f"DEBUG: Extracted and Fixed JSON String for parsing:\n{extracted_json_str}")
-
-        if not extracted_json_str:
-            raise ValueError(f"Model lokal menghasilkan respons tetapi tidak mengandung JSON yang valid setelah ekstraksi dan perbaikan. Respons mentah: {ai_response_content_str[:500]}...")
-        
+        job_id = uuid.uuid4().hex
+        status = 'queued'
         try:
-            generated_quiz_items = json.loads(extracted_json_str)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Gagal mengurai JSON dari respons AI bahkan setelah perbaikan: {e}. Respon mentah (setelah ekstraksi): {extracted_json_str[:500]}...")
+            quiz_history_id = create_quiz_history(db, user_id, level_context, topic, num_questions)
+            # Jika pool soal AI sudah cukup untuk seluruh kuis, job langsung selesai tanpa masuk antrean.
+            # Penghapusan dari pool di-commit dalam transaksi yang sama dengan insert job.
+            pooled_items = ai_question_pool.take(db, level_context, topic, num_questions, partial=False, commit=False) if AI_POOL_ENABLED else []
+            if pooled_items:
+                insert_quiz_taken_questions(db, quiz_history_id, pooled_items)
+                status = 'done'
+            cursor = db.cursor()
+            try:
+                cursor.execute(
+                    "INSERT INTO ai_quiz_jobs (id, user_id, quiz_history_id, topic, level_context, num_questions, status) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    (job_id, user_id, quiz_history_id, topic, level_context, num_questions, status)
+                )
+                db.commit()
+            finally:
+                cursor.close()
+        except mysql.connector.Error as e:
+            print(f"Error saving AI quiz job to DB: {e}")
+            db.rollback()
+            self._release()
+            raise QuizGenerationError(f"Gagal menyimpan job kuis AI: {str(e)}")
+        except Exception:
+            self._release()
+            raise
 
-        print(f"DEBUG: Parsed JSON Object: {json.dumps(generated_quiz_items, indent=2)}")
-        
-        final_quiz_list = []
-        if isinstance(generated_quiz_items, list):
-            final_quiz_list = generated_quiz_items
-        elif isinstance(generated_quiz_items, dict):
-            if 'question' in generated_quiz_items and \
-               'options' in generated_quiz_items and \
-               isinstance(generated_quiz_items.get('options'), list): 
-                final_quiz_list = [generated_quiz_items]
-            elif 'quiz' in generated_quiz_items and isinstance(generated_quiz_items['quiz'], list):
-                final_quiz_list = generated_quiz_items['quiz']
-            else:
-                raise ValueError(f"Format JSON yang dihasilkan AI tidak sesuai. Diharapkan array, objek dengan kunci 'quiz', atau objek soal tunggal. Tipe root: {repr(type(generated_quiz_items))}, Kunci ditemukan: {list(generated_quiz_items.keys()) if isinstance(generated_quiz_items, dict) else 'N/A'}")
+        print(f"DEBUG: Job kuis AI {job_id} dibuat untuk quiz_history_id {quiz_history_id} dengan status {status}.")
+        self._stats['submitted'] += 1
+        if status == 'done':
+            self._release()
+            self._stats['served_from_pool'] += 1
         else:
-            raise ValueError(f"Format JSON yang dihasilkan AI tidak sesuai. Diharapkan array, objek dengan kunci 'quiz', atau objek soal tunggal. Tipe root: {repr(type(generated_quiz_items))}")
-
-        validated_quiz_items = []
-        for item in final_quiz_list:
-            question_text = item.get('question')
-            options_raw = item.get('options')
-            correct_answer_text_ai = item.get('correct_answer')
+            with self._lock:
+                self._scheduled.add(job_id)
+            self._start(job_id)
+        return {"job_id": job_id, "quiz_history_id": quiz_history_id, "status": status}
+
+    def enqueue(self, job_id, force=True):
+        # Job yang sudah tersimpan (recover/sweep) tetap dijadwalkan walau melebihi max_pending kecuali force=False.
+        if not self._reserve(job_id, force):
+            return False
+        self._start(job_id)
+        return True
+
+    def _start(self, job_id):
+        self.start_maintenance()
+        self._get_executor().submit(self._run, job_id)
+
+    def _claim(self, db, job_id):
+        cursor = db.cursor(dictionary=True)
+        try:
+            cursor.execute(
+                "UPDATE ai_quiz_jobs SET status = 'running', attempts = attempts + 1 WHERE id = %s AND status = 'queued'",
+                (job_id,)
+            )
+            claimed = cursor.rowcount == 1
+            db.commit()
+            if not claimed:
+                return None
+            cursor.execute("SELECT id, quiz_history_id, topic, level_context, num_questions FROM ai_quiz_jobs WHERE id = %s", (job_id,))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
 
-            # Use the new calculate_correct_answer_and_options for robust processing
-            final_question_text, final_options, final_correct_answer = \
-                calculate_correct_answer_and_options(question_text, options_raw, correct_answer_text_ai)
-            
-            # Final validation before appending
-            if (final_question_text and isinstance(final_question_text, str) and
-                final_options and len(final_options) == 4 and 
-                final_correct_answer and isinstance(final_correct_answer, str) and 
-                str(final_correct_answer).strip() in final_options): 
-
-                validated_quiz_items.append({
-                    'question': str(final_question_text).strip(),
-                    'options': final_options,
-                    'correct_answer': str(final_correct_answer).strip()
-                })
-            else:
-                missing_info = []
-                if not final_question_text: missing_info.append('question')
-                if not final_options or len(final_options) != 4: missing_info.append(f'options (invalid/not 4, current: {final_options})')
-                if not final_correct_answer or not isinstance(final_correct_answer, str): missing_info.append('correct_answer (missing/invalid type)')
-                elif final_correct_answer and str(final_correct_answer).strip() not in final_options: missing_info.append(f'correct_answer (not in options, current: {final_correct_answer})')
-                
-                print(f"Peringatan: Item kuis tidak valid atau tidak lengkap (Masalah: {', '.join(missing_info)}): {item}")
+    def _finish(self, db, job_id, status, error=None):
+        cursor = db.cursor()
+        try:
+            cursor.execute("UPDATE ai_quiz_jobs SET status = %s, error = %s WHERE id = %s", (status, error, job_id))
+            db.commit()
+        finally:
+            cursor.close()
 
+    def _run(self, job_id):
+        try:
+            with app.app_context():
+                db = get_db()
+                job = self._claim(db, job_id)
+                if job is None:
+                    print(f"DEBUG: Job kuis AI {job_id} sudah diklaim worker lain atau tidak lagi antre, dilewati.")
+                    return
+                with self._lock:
+                    self._running.add(job_id)
+                started = time.monotonic()
+                try:
+                    fill_ai_quiz(job['quiz_history_id'], job['topic'], job['num_questions'], job['level_context'],
+                                 on_item=lambda item: self.notify_update(job_id))
+                    self._finish(db, job_id, 'done')
+                    self._stats['done'] += 1
+                    print(f"DEBUG: Job kuis AI {job_id} selesai dalam {time.monotonic() - started:.1f} detik.")
+                except Exception as e:
+                    error_message = e.message if isinstance(e, QuizGenerationError) else f"Terjadi kesalahan tak terduga: {e}"
+                    db.rollback()
+                    self._finish(db, job_id, 'failed', error_message)
+                    self._stats['failed'] += 1
+                    print(f"ERROR: Job kuis AI {job_id} gagal: {error_message}")
+        except Exception as e:
+            self._stats['crashed'] += 1
+            print(f"ERROR: Terjadi kesalahan tak terduga saat menjalankan job kuis AI {job_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+            self._release(job_id)
+            self.notify_update(job_id, finished=True)
+
+    def notify_update(self, job_id, finished=False):
+        # Membangunkan stream SSE yang menunggu job ini (soal baru tersimpan atau job selesai)
+        with self._updates:
+            self._update_versions[job_id] = self._update_versions.get(job_id, 0) + 1
+            now = time.monotonic()
+            if finished:
+                self._finished_at[job_id] = now
+            # Versi job yang sudah lama selesai tidak lagi ditunggu stream mana pun
+            for old_job_id in [j for j, finished_at in self._finished_at.items() if now - finished_at > AI_SSE_MAX_SECONDS]:
+                del self._finished_at[old_job_id]
+                self._update_versions.pop(old_job_id, None)
+            self._updates.notify_all()
+
+    def wait_for_update(self, job_id, last_version, timeout):
+        # Menunggu hingga job berubah di proses ini atau timeout habis (job yang dikerjakan proses lain tidak
+        # membangunkan stream, jadi timeout berfungsi sebagai polling cadangan). Mengembalikan versi terbaru.
+        with self._updates:
+            self._updates.wait_for(lambda: self._update_versions.get(job_id, 0) != last_version, timeout)
+            return self._update_versions.get(job_id, 0)
+
+    def start_maintenance(self):
+        with self._lock:
+            if self._maintenance_thread is not None:
+                return
+            self._maintenance_thread = threading.Thread(target=self._maintenance_loop, name='ai-quiz-job-maintenance', daemon=True)
+            self._maintenance_thread.start()
+
+    def _maintenance_loop(self):
+        last_sweep = time.monotonic()
+        while True:
+            time.sleep(min(AI_JOB_HEARTBEAT_SECONDS, AI_JOB_SWEEP_SECONDS))
+            try:
+                with app.app_context():
+                    self.heartbeat()
+                    if time.monotonic() - last_sweep >= AI_JOB_SWEEP_SECONDS:
+                        last_sweep = time.monotonic()
+                        self.recover(force=False)
+            except Exception as e:
+                print(f"ERROR: Maintenance job kuis AI gagal: {e}")
 
-        if not validated_quiz_items:
-            return jsonify({"error": "Model lokal menghasilkan JSON, namun tidak ada soal yang memenuhi format yang diharapkan (setiap soal harus memiliki 'question', array 'options' dengan TEPAT 4, dan 'correct_answer' yang sesuai dengan opsi)."}), 500
+    def heartbeat(self):
+        with self._lock:
+            job_ids = list(self._running)
+        if not job_ids:
+            return 0
+        db = get_db()
+        cursor = db.cursor()
+        try:
+            placeholders = ', '.join(['%s'] * len(job_ids))
+            cursor.execute(
+                f"UPDATE ai_quiz_jobs SET updated_at = NOW() WHERE status = 'running' AND id IN ({placeholders})",
+                tuple(job_ids)
+            )
+            db.commit()
+            self._stats['heartbeats'] += cursor.rowcount
+            return cursor.rowcount
+        except mysql.connector.Error as e:
+            print(f"Error saat memperbarui heartbeat job kuis AI: {e}")
+            db.rollback()
+            return 0
+        finally:
+            cursor.close()
 
-        print(f"DEBUG: Validated quiz items to be stored in quiz_taken_questions for quiz_history_id {quiz_history_id}: {json.dumps(validated_quiz_items, indent=2)}") 
-        
+    def recover(self, force=True):
+        # Dipanggil saat startup (force=True: semua job queued dijadwalkan walau melebihi max_pending) dan secara
+        # berkala oleh thread maintenance. Job running yang heartbeat-nya berhenti lebih dari AI_JOB_STALE_SECONDS
+        # (workernya mati) dikembalikan ke antrean, atau digagalkan setelah AI_JOB_MAX_ATTEMPTS percobaan.
+        # Klaim job tetap atomik, jadi job queued yang juga antre di proses lain hanya dikerjakan sekali.
         db = get_db()
+        cursor = db.cursor()
         try:
-            quiz_taken_cursor = db.cursor()
-            for item in validated_quiz_items:
-                quiz_taken_cursor.execute(
-                    "INSERT INTO quiz_taken_questions (quiz_history_id, question_text, options_json, correct_answer, user_answer, is_correct) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (quiz_history_id, item['question'], json.dumps(item['options']), item['correct_answer'], None, None)
+            cursor.execute(
+                "UPDATE ai_quiz_jobs SET status = 'failed', error = %s WHERE status = 'running' AND attempts >= %s AND updated_at < NOW() - INTERVAL %s SECOND",
+                ("Job dihentikan karena worker berhenti berulang kali.", AI_JOB_MAX_ATTEMPTS, AI_JOB_STALE_SECONDS)
+            )
+            failed = cursor.rowcount
+            cursor.execute(
+                "UPDATE ai_quiz_jobs SET status = 'queued' WHERE status = 'running' AND updated_at < NOW() - INTERVAL %s SECOND",
+                (AI_JOB_STALE_SECONDS,)
+            )
+            requeued = cursor.rowcount
+            if force:
+                cursor.execute("SELECT id FROM ai_quiz_jobs WHERE status = 'queued' ORDER BY created_at ASC")
+            else:
+                # Job queued yang baru dibuat sedang antre di proses pembuatnya; hanya yang sudah lama yang diambil alih
+                cursor.execute(
+                    "SELECT id FROM ai_quiz_jobs WHERE status = 'queued' AND updated_at < NOW() - INTERVAL %s SECOND ORDER BY created_at ASC",
+                    (AI_JOB_STALE_SECONDS,)
                 )
+            job_ids = [row[0] for row in cursor.fetchall()]
             db.commit()
-            print(f"DEBUG: Detail soal kuis AI disimpan ke quiz_taken_questions untuk quiz_history_id: {quiz_history_id}")
         except mysql.connector.Error as e:
-            print(f"Error saving AI questions to quiz_taken_questions: {e}")
+            print(f"Error saat memulihkan job kuis AI: {e}")
             db.rollback()
-            return jsonify({"error": f"Gagal menyimpan detail soal AI: {str(e)}"}), 500
+            return 0
         finally:
-            quiz_taken_cursor.close()
+            cursor.close()
+        self._stats['stale_failed'] += failed
+        self._stats['stale_requeued'] += requeued
+        scheduled = sum(1 for job_id in job_ids if self.enqueue(job_id, force))
+        self._stats['recovered'] += scheduled
+        if scheduled or failed:
+            print(f"DEBUG: {scheduled} job kuis AI yang tertunda dijadwalkan ulang ({requeued} running macet dikembalikan ke antrean, {failed} digagalkan).")
+        return scheduled
 
-        return jsonify({"quiz": validated_quiz_items[:num_questions], "quiz_history_id": quiz_history_id}) 
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=self._pending, running=len(self._running), workers=self.max_workers)
 
-    except requests.exceptions.RequestException as e:
-        error_message = str(e)
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_json = e.response.json()
-                error_message = error_json.get('error', error_message)
-            except json.JSONDecodeError:
-                pass
-        flash(f"Gagal memuat kuis: {error_message}. Pastikan Ollama berjalan dan model 'llama3' sudah diunduh jika menggunakan AI.", 'error')
-        print(f"ERROR: RequestException di /api/generate_quiz_ai: {e}")
-        return jsonify({"error": error_message}), 500
-    except ValueError as e:
-        print(f"ERROR: ValueError di /api/generate_quiz_ai: {e}")
-        return jsonify({"error": f"Gagal menghasilkan kuis dengan model lokal: {str(e)}"}), 500
-    except Exception as e:
-        print(f"ERROR: Terjadi kesalahan tak terduga di api_generate_quiz_ai: {e}")
-        return jsonify({"error": f"Terjadi kesalahan tak terduga saat menghasilkan kuis AI: {str(e)}"}), 500
+ai_job_runner = AIQuizJobRunner(AI_JOB_WORKERS, AI_JOB_MAX_PENDING)
+
+def get_ai_quiz_job_status(job_id, user_id):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT id, user_id, quiz_history_id, status, error FROM ai_quiz_jobs WHERE id = %s", (job_id,))
+        job = cursor.fetchone()
+        if not job or job['user_id'] != user_id:
+            return None
+
+        result = {"job_id": job['id'], "status": job['status'], "quiz_history_id": job['quiz_history_id'], "error": job['error']}
+        if job['status'] == 'done':
+            cursor.execute("SELECT id, question_text, options_json, correct_answer, source FROM quiz_taken_questions WHERE quiz_history_id = %s ORDER BY id ASC", (job['quiz_history_id'],))
+            result['quiz'] = [
+                {'id': q['id'], 'question': q['question_text'], 'options': json.loads(q['options_json']), 'correct_answer': q['correct_answer'], 'source': q['source']}
+                for q in cursor.fetchall()
+            ]
+        return result
+    finally:
+        cursor.close()
+
+@app.route('/api/ai_quiz_jobs', methods=['POST'])
+@login_required
+def api_submit_ai_quiz_job():
+    data = request.json
+    topic = data.get('topic')
+    num_questions = data.get('num_questions', 1)
+    level_context = data.get('level_context', 'SD')
+    try:
+        job = ai_job_runner.submit(session.get('user_id'), topic, num_questions, level_context)
+    except QuizGenerationError as e:
+        return jsonify({"error": e.message}), e.status_code
+    job['status_url'] = url_for('api_ai_quiz_job_status', job_id=job['job_id'])
+    return jsonify(job), 202
 
+@app.route('/api/ai_quiz_jobs/<job_id>')
+@login_required
+def api_ai_quiz_job_status(job_id):
+    job = get_ai_quiz_job_status(job_id, session.get('user_id'))
+    if job is None:
+        return jsonify({"error": "Job kuis AI tidak ditemukan."}), 404
+    return jsonify(job)
+
+AI_SSE_POLL_SECONDS = float(os.getenv('AI_SSE_POLL_SECONDS', 3))
+AI_SSE_MAX_SECONDS = float(os.getenv('AI_SSE_MAX_SECONDS', 300))
+# Setiap stream SSE yang terbuka menahan satu worker/thread web selama job berjalan. Di atas batas ini klien
+# mendapat 503 dan script.js beralih ke polling status job (waitForAiQuizJob), yang tidak menahan worker.
+AI_SSE_MAX_STREAMS = int(os.getenv('AI_SSE_MAX_STREAMS', 4))
+
+ai_sse_slots = threading.BoundedSemaphore(AI_SSE_MAX_STREAMS)
+ai_sse_stats = Counter()
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_ai_quiz_job_events(job_id, quiz_history_id):
+    # Mengirim setiap soal yang sudah disimpan job ke klien begitu muncul di quiz_taken_questions.
+    # Urutan dan id soal sama dengan yang dipakai submit_quiz (ORDER BY id), sehingga penilaian tetap cocok.
+    # Stream tidur di ai_job_runner.wait_for_update dan hanya membaca database saat job di proses ini menyimpan
+    # soal atau selesai, atau setiap AI_SSE_POLL_SECONDS sebagai cadangan untuk job yang dikerjakan proses lain.
+    # Koneksi database dipinjam dari pool hanya selama satu kali pembacaan, bukan selama stream terbuka.
+    last_id = 0
+    index = 0
+    version = 0
+    started = time.monotonic()
+    last_keepalive = started
+    while True:
+        conn = db_pool.acquire()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(
+                "SELECT id, question_text, options_json, correct_answer, source FROM quiz_taken_questions WHERE quiz_history_id = %s AND id > %s ORDER BY id ASC",
+                (quiz_history_id, last_id)
+            )
+            new_questions = cursor.fetchall()
+            cursor.execute("SELECT status, error FROM ai_quiz_jobs WHERE id = %s", (job_id,))
+            job = cursor.fetchone()
+            cursor.close()
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+
+        for q in new_questions:
+            yield format_sse('question', {
+                'index': index,
+                'id': q['id'],
+                'question': q['question_text'],
+                'options': json.loads(q['options_json']),
+                'correct_answer': q['correct_answer'],
+                'source': q['source'],
+            })
+            last_id = q['id']
+            index += 1
+
+        if job is None or job['status'] in ('done', 'failed'):
+            status = job['status'] if job else 'failed'
+            error = job['error'] if job else "Job kuis AI tidak ditemukan."
+            yield format_sse('status', {'status': status, 'error': error, 'total': index})
+            return
+        if time.monotonic() - started > AI_SSE_MAX_SECONDS:
+            yield format_sse('status', {'status': 'timeout', 'error': "Waktu tunggu pembuatan kuis AI habis.", 'total': index})
+            return
+        if time.monotonic() - last_keepalive > 15:
+            last_keepalive = time.monotonic()
+            yield ": keepalive\n\n"
+        version = ai_job_runner.wait_for_update(job_id, version, AI_SSE_POLL_SECONDS)
+
+@app.route('/api/ai_quiz_jobs/<job_id>/events')
+@login_required
+def api_ai_quiz_job_events(job_id):
+    job = get_ai_quiz_job_status(job_id, session.get('user_id'))
+    if job is None:
+        return jsonify({"error": "Job kuis AI tidak ditemukan."}), 404
+    if not ai_sse_slots.acquire(blocking=False):
+        ai_sse_stats['rejected'] += 1
+        return jsonify({"error": "Terlalu banyak stream kuis AI yang terbuka, gunakan polling status job."}), 503
+    ai_sse_stats['opened'] += 1
+    response = Response(
+        stream_ai_quiz_job_events(job_id, job['quiz_history_id']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # call_on_close tetap dipanggil walau klien putus sebelum generator sempat berjalan
+    response.call_on_close(ai_sse_slots.release)
+    return response
 
 @app.route('/submit_quiz', methods=['POST'])
 @login_required
@@ -1280,28 +3919,36 @@ def submit_quiz():
     total_questions = quiz_meta['total_questions']
     results = []
 
+    graded_answers = []
+    for i, q_db in enumerate(quiz_taken_questions_db):
+        user_answer = request.form.get(f'question_{i}')
+        is_correct = (user_answer == q_db['correct_answer'])
+        if is_correct:
+            score += 1
+        graded_answers.append((q_db['id'], user_answer, is_correct))
+
+        results.append({
+            'question_id': q_db['id'],
+            'question_text': q_db['question_text'],
+            'user_answer': user_answer,
+            'correct_answer': q_db['correct_answer'],
+            'is_correct': is_correct,
+            'options': json.loads(q_db['options_json'])
+        })
+
+    # Semua jawaban disimpan dengan satu UPDATE ... CASE, lalu skor diperbarui, dalam satu transaksi.
     quiz_taken_cursor = db.cursor()
     try:
-        for i, q_db in enumerate(quiz_taken_questions_db):
-            user_answer = request.form.get(f'question_{i}')
-            is_correct = (user_answer == q_db['correct_answer'])
-            if is_correct:
-                score += 1
-            
+        if graded_answers:
+            answer_cases = ' '.join(['WHEN %s THEN %s'] * len(graded_answers))
+            answer_params = [value for taken_id, user_answer, _ in graded_answers for value in (taken_id, user_answer)]
+            correct_params = [value for taken_id, _, is_correct in graded_answers for value in (taken_id, is_correct)]
             quiz_taken_cursor.execute(
-                "UPDATE quiz_taken_questions SET user_answer = %s, is_correct = %s WHERE id = %s",
-                (user_answer, is_correct, q_db['id'])
+                f"UPDATE quiz_taken_questions SET user_answer = CASE id {answer_cases} END, "
+                f"is_correct = CASE id {answer_cases} END WHERE quiz_history_id = %s",
+                tuple(answer_params + correct_params + [quiz_history_id])
             )
 
-            results.append({
-                'question_id': q_db['id'],
-                'question_text': q_db['question_text'],
-                'user_answer': user_answer,
-                'correct_answer': q_db['correct_answer'],
-                'is_correct': is_correct,
-                'options': json.loads(q_db['options_json'])
-            })
-
         quiz_taken_cursor.execute(
             "UPDATE quiz_history SET score = %s WHERE id = %s",
             (score, quiz_history_id)
@@ -1403,6 +4050,29 @@ def admin_dashboard():
                            overall_performance=overall_performance,
                            users=users)
 
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'question_sampler': question_sampler.stats(),
+        'dataset_cache': dataset_cache.stats(),
+        'ai_jobs': ai_job_runner.stats(),
+        'ai_sse_streams': dict(ai_sse_stats, max_streams=AI_SSE_MAX_STREAMS),
+        'ai_generation_coalescer': ai_generation_coalescer.stats(),
+        'ai_chunks': dict(ai_chunk_stats),
+        'ollama': ollama_dispatcher.stats(),
+        'ollama_circuit': ollama_circuit.stats(),
+        'llm_cache': llm_cache.stats(),
+        'few_shot': few_shot_selector.stats(),
+        'ai_output': ai_output_stats_summary(),
+        'answer_rules': answer_rules.stats(),
+        'arithmetic_parse_cache': parse_arithmetic_question.cache_info()._asdict(),
+        'distractors': distractor_generator.stats(),
+        'ai_fallback': dict(ai_fallback_stats),
+        'ai_question_pool': ai_question_pool.stats(get_db()),
+    })
+
 @app.route('/admin/toggle_admin/<int:user_id>', methods=['POST'])
 @admin_required
 def toggle_admin(user_id):
@@ -1469,6 +4139,14 @@ def admin_questions():
     cursor.close()
     return render_template('admin/questions.html', questions=questions)
 
+@app.route('/admin/answer_verifications')
+@admin_required
+def admin_answer_verifications():
+    # Laporan hasil `flask verify-answers`; verifikasinya sendiri dijalankan dari CLI (memakai proses worker)
+    counts, mismatches = answer_verification_report(get_db())
+    return render_template('admin/answer_verifications.html', counts=counts, mismatches=mismatches,
+                           solver_version=ANSWER_SOLVER_VERSION, report_limit=ANSWER_VERIFY_REPORT_LIMIT)
+
 @app.route('/admin/add_question', methods=['GET', 'POST'])
 @admin_required
 def add_question():
@@ -1491,9 +4169,11 @@ def add_question():
         db = get_db()
         cursor = db.cursor()
         try:
-            cursor.execute('INSERT INTO quiz_questions (level, question, options, correct_answer) VALUES (%s, %s, %s, %s)',
-                           (level, question, options_json, correct_answer))
+            cursor.execute('INSERT INTO quiz_questions (level, question, options, correct_answer, content_hash) VALUES (%s, %s, %s, %s, %s)',
+                           (level, question, options_json, correct_answer, question_content_hash(level, question, options_list, correct_answer)))
             db.commit()
+            question_sampler.invalidate(level)
+            few_shot_selector.invalidate(level)
             flash('Soal kuis berhasil ditambahkan!', 'success')
             return redirect(url_for('admin_questions'))
         except mysql.connector.Error as e:
@@ -1542,9 +4222,13 @@ def edit_question(question_id):
         db_conn = get_db()
         cursor = db_conn.cursor()
         try:
-            cursor.execute('UPDATE quiz_questions SET level = %s, question = %s, options = %s, correct_answer = %s WHERE id = %s',
-                           (level, question_text, options_json, correct_answer, question_id))
+            cursor.execute('UPDATE quiz_questions SET level = %s, question = %s, options = %s, correct_answer = %s, content_hash = %s WHERE id = %s',
+                           (level, question_text, options_json, correct_answer, question_content_hash(level, question_text, options_list, correct_answer), question_id))
             db_conn.commit()
+            question_sampler.invalidate(question['level'])
+            few_shot_selector.invalidate(question['level'])
+            question_sampler.invalidate(level)
+            few_shot_selector.invalidate(level)
             flash('Soal kuis berhasil diperbarui!', 'success')
             return redirect(url_for('admin_questions'))
         except mysql.connector.Error as e:
@@ -1564,6 +4248,8 @@ def delete_question(question_id):
     try:
         cursor.execute('DELETE FROM quiz_questions WHERE id = %s', (question_id,))
         db.commit()
+        question_sampler.invalidate()
+        few_shot_selector.invalidate()
         flash('Soal kuis berhasil dihapus!', 'success')
     except mysql.connector.Error as e:
         flash(f'Gagal menghapus soal: {str(e)}', 'error')
@@ -1596,45 +4282,76 @@ def admin_datasets():
             filename = secure_filename(file.filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             
+            # Mengunggah ulang file dengan nama yang sama akan mengimpor ulang dataset tersebut secara inkremental.
             db_conn = get_db()
             check_cursor = db_conn.cursor()
-            check_cursor.execute("SELECT COUNT(*) FROM uploaded_datasets WHERE filename = %s", (filename,))
-            if check_cursor.fetchone()[0] > 0:
-                flash(f'File "{filename}" sudah ada di database. Harap ganti nama atau hapus yang lama.', 'error')
-                check_cursor.close()
-                return render_template('admin/datasets.html', default_datasets=DATASETS, uploaded_datasets=uploaded_datasets_db)
+            check_cursor.execute("SELECT id FROM uploaded_datasets WHERE filename = %s", (filename,))
+            existing_dataset = check_cursor.fetchone()
             check_cursor.close()
 
+            upload_path = filepath + '.uploading'
             try:
-                file.save(filepath)
-                file_size = os.path.getsize(filepath)
-                upload_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                db_conn = get_db()
-                insert_cursor = db_conn.cursor()
-                insert_cursor.execute('INSERT INTO uploaded_datasets (filename, filepath, size, upload_date) VALUES (%s, %s, %s, %s)',
-                                       (filename, filepath, file_size, upload_date))
-                db_conn.commit()
-                insert_cursor.close()
+                if existing_dataset:
+                    dataset_id = existing_dataset[0]
+                    print(f"DEBUG: Dataset '{filename}' sudah ada (ID {dataset_id}), melakukan impor ulang inkremental.")
+                else:
+                    insert_cursor = db_conn.cursor()
+                    insert_cursor.execute('INSERT INTO uploaded_datasets (filename, filepath, size, upload_date) VALUES (%s, %s, %s, %s)',
+                                           (filename, filepath, 0, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                    db_conn.commit()
+                    dataset_id = insert_cursor.lastrowid
+                    insert_cursor.close()
 
                 inferred_level = filename.split('_')[0].upper() if '_' in filename else None
-                imported_count = import_questions_from_csv_to_db(filepath, level_context=inferred_level)
-                
-                if imported_count > 0:
-                    flash(f'Dataset "{filename}" berhasil diunggah dan {imported_count} soal berhasil diimpor!', 'success')
+                with open(upload_path, 'wb') as destination:
+                    upload_stream = TeeUploadStream(file.stream, destination)
+                    import_report = import_questions_from_csv_to_db(upload_stream, dataset_id, level_context=inferred_level, source_name=filename)
+                    file_size = upload_stream.drain()
+                if import_report['error']:
+                    # Impor sudah di-rollback; file dan soal lama dari dataset ini tetap utuh.
+                    os.remove(upload_path)
+                    if not existing_dataset:
+                        cleanup_cursor = db_conn.cursor()
+                        cleanup_cursor.execute('DELETE FROM uploaded_datasets WHERE id = %s', (dataset_id,))
+                        db_conn.commit()
+                        cleanup_cursor.close()
+                    flash(f'Gagal mengimpor dataset "{filename}": {import_report["error"]}', 'error')
                 else:
-                    flash(f'Dataset "{filename}" diunggah, tetapi tidak ada soal valid yang diimpor. Periksa format CSV.', 'warning')
+                    os.replace(upload_path, filepath)
+                    imported_count = import_report['imported']
+                    upload_date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+                    update_cursor = db_conn.cursor()
+                    update_cursor.execute('UPDATE uploaded_datasets SET filepath = %s, size = %s, upload_date = %s WHERE id = %s',
+                                           (filepath, file_size, upload_date, dataset_id))
+                    db_conn.commit()
+                    update_cursor.close()
+
+                    if imported_count > 0:
+                        flash(f'Dataset "{filename}" berhasil diunggah dan {imported_count} soal berhasil diimpor!', 'success')
+                    else:
+                        flash(f'Dataset "{filename}" diunggah, tetapi tidak ada soal valid yang diimpor. Periksa format CSV.', 'warning')
+                    if existing_dataset:
+                        flash(f'Impor ulang: {import_report["inserted"]} soal baru, {import_report["updated"]} berubah, {import_report["unchanged"]} tetap, {import_report["deleted"]} dihapus.', 'info')
+                    if import_report['rejected']:
+                        rejected_preview = '; '.join(f"baris {item['row']}: {item['reason']}" for item in import_report['rejected_rows'][:5])
+                        flash(f'{import_report["rejected"]} baris ditolak. Contoh: {rejected_preview}', 'warning')
 
             except mysql.connector.Error as e:
                 flash(f'Gagal mengunggah dataset ke database: {str(e)}', 'error')
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                if os.path.exists(upload_path):
+                    os.remove(upload_path)
                 if db_conn:
                     db_conn.rollback()
             except Exception as e:
                 flash(f'Terjadi kesalahan tak terduga saat mengunggah dataset: {str(e)}', 'error')
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                if os.path.exists(upload_path):
+                    os.remove(upload_path)
+                if not existing_dataset:
+                    cleanup_cursor = db_conn.cursor()
+                    cleanup_cursor.execute('DELETE FROM uploaded_datasets WHERE filename = %s', (filename,))
+                    db_conn.commit()
+                    cleanup_cursor.close()
         else:
             flash('Format file tidak diizinkan. Hanya file CSV.', 'error')
             
@@ -1658,15 +4375,23 @@ def delete_dataset(filename):
         return redirect(url_for('admin_datasets'))
 
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
+        # Soal dari dataset ini ikut dihapus (FK-nya ON DELETE SET NULL akan meninggalkan soal yatim yang
+        # terduplikasi saat file yang sama diunggah ulang), dalam transaksi yang sama dengan record dataset.
         db_conn = get_db()
         delete_cursor = db_conn.cursor()
-        delete_cursor.execute('DELETE FROM uploaded_datasets WHERE filename = %s', (filename,))
+        delete_cursor.execute('DELETE FROM quiz_questions WHERE dataset_id = %s', (dataset_record['id'],))
+        deleted_questions = delete_cursor.rowcount
+        delete_cursor.execute('DELETE FROM uploaded_datasets WHERE id = %s', (dataset_record['id'],))
         db_conn.commit()
         delete_cursor.close()
-        flash(f'Dataset "{filename}" berhasil dihapus.', 'success')
+        question_sampler.invalidate()
+        few_shot_selector.invalidate()
+        dataset_cache.invalidate(dataset_record['filepath'])
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        print(f"DEBUG: Dataset {filename} dihapus bersama {deleted_questions} soalnya.")
+        flash(f'Dataset "{filename}" berhasil dihapus beserta {deleted_questions} soalnya.', 'success')
     except mysql.connector.Error as e:
         flash(f'Gagal menghapus dataset "{filename}" dari database: {str(e)}', 'error')
         db_conn.rollback()
@@ -1676,5 +4401,431 @@ def delete_dataset(filename):
     return redirect(url_for('admin_datasets'))
 
 
+# Jalur numerik lama (eval() + fallback regex operasi pertama). Tidak dipakai lagi oleh answer_rules; hanya
+# dipertahankan sebagai pembanding di `flask benchmark-arithmetic`.
+LEGACY_EVAL_STRIP_RE = re.compile(r'(hasil dari|berapakah|adalah|=|\s*cm\^?\d*|\s*gram|\s*menit|\s*bulan|\s*tahun|\s*hari|\s*detik|\s*cm)')
+LEGACY_EVAL_SQRT_WORD_RE = re.compile(r'akar kuadrat dari\s*(\d+)')
+LEGACY_EVAL_SQRT_FUNC_RE = re.compile(r'sqrt\((\d+)\)')
+LEGACY_EVAL_POWER_RE = re.compile(r'(\d+)\s*pangkat\s*(\d+)')
+LEGACY_EVAL_PER_RE = re.compile(r'(\d+)\s*per\s*(\d+)')
+LEGACY_EVAL_ADDITIVE_RE = re.compile(r'\b\d+\b.*[+\-]\b\d+\b')
+LEGACY_EVAL_SAFE_RE = re.compile(r'[-+]?\d+(\.\d+)?([+\-*/]\d+(\.\d+)?)*|\d+(\.\d+)?\*\*(-?\d+(\.\d+)?)?')
+LEGACY_ARITHMETIC_FALLBACK_RE = re.compile(r'(\d+)\s*([+\-xX*/])\s*(\d+)')
+LEGACY_EVAL_SAFE_DICT = {
+    "__builtins__": None,
+    "abs": abs, "min": min, "max": max, "round": round,
+    "math": math,
+    "sqrt": math.sqrt,
+    "pow": math.pow
+}
+
+def legacy_eval_arithmetic(question_text_lower):
+    sqrt_in_string = lambda match: str(math.sqrt(float(match.group(1))))
+    expression = question_text_lower.replace('x', '*').replace(':', '/')
+    expression = LEGACY_EVAL_STRIP_RE.sub('', expression).strip()
+    expression = LEGACY_EVAL_SQRT_WORD_RE.sub(sqrt_in_string, expression)
+    expression = LEGACY_EVAL_SQRT_FUNC_RE.sub(sqrt_in_string, expression)
+    expression = LEGACY_EVAL_POWER_RE.sub(r'(\1**\2)', expression)
+    expression = LEGACY_EVAL_PER_RE.sub(r'(\1/\2)', expression)
+
+    if LEGACY_EVAL_ADDITIVE_RE.search(expression):
+        numeric_parts = re.findall(r'\d+', expression)
+        operators = re.findall(r'[+\-]', expression)
+        if len(numeric_parts) >= 2 and len(operators) >= 1:
+            try:
+                expression = numeric_parts[0] + ''.join(operators[i] + numeric_parts[i+1] for i in range(len(operators)))
+            except IndexError:
+                pass
+
+    if LEGACY_EVAL_SAFE_RE.fullmatch(expression.strip()):
+        try:
+            answer = str(round(eval(expression.strip(), LEGACY_EVAL_SAFE_DICT, {}), 2))
+            if answer.endswith('.0'): answer = str(int(float(answer)))
+            return answer
+        except (SyntaxError, NameError, TypeError, ZeroDivisionError, ValueError):
+            pass
+    # Lalu fallback regex: operasi biner pertama yang ditemukan, tanpa presedensi
+    match = LEGACY_ARITHMETIC_FALLBACK_RE.search(question_text_lower)
+    if not match:
+        return None
+    num1, operator, num2 = float(match.group(1)), match.group(2), float(match.group(3))
+    if operator == '+': return str(int(num1 + num2))
+    if operator == '-': return str(int(num1 - num2))
+    if operator in ('x', 'X', '*'): return str(int(num1 * num2))
+    if operator == '/' and num2 != 0: return str(round(num1 / num2, 2))
+    return None
+
+def new_eval_arithmetic(question_text_lower):
+    value = evaluate_arithmetic_question(question_text_lower)
+    return format_arithmetic_answer(value) if value is not None else None
+
+# Kasus presedensi dan tokenisasi yang harus tetap benar; None berarti bukan soal aritmetika
+ARITHMETIC_GOLDEN_CASES = [
+    ("5 x 6 - 15 : 3", "25"),
+    ("4/5 : 2/5", "2"),
+    ("2 ^ 6 / 2", "32"),
+    ("2 pangkat 3 per 4", "2"),
+    ("-2 ^ 2", "-4"),
+    ("2 ^ -1", "0.5"),
+    ("2 ^ 3 ^ 2", "512"),
+    ("√16 + 2 x 3", "10"),
+    ("1: 5", None),
+    ("1:200", None),
+    ("3x - 7 = 8", None),
+]
+
+@app.cli.command('benchmark-arithmetic', help='Bandingkan evaluator aritmetika dengan jalur eval() lama pada dataset SD/SMP/SMA.')
+@click.option('--repeat', default=20, show_default=True, help='Jumlah putaran waktu per jalur.')
+@click.option('--show', default=10, show_default=True, help='Jumlah contoh perbedaan yang ditampilkan.')
+def benchmark_arithmetic_command(repeat, show):
+    questions = []
+    for level, path in DATASETS.items():
+        if not os.path.exists(path):
+            click.echo(f"Peringatan: dataset {level} tidak ditemukan di {path}, dilewati.")
+            continue
+        questions.extend((level, question.lower(), correct_answer) for question, _, correct_answer in dataset_cache.rows(path))
+    golden_failures = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for question, expected in ARITHMETIC_GOLDEN_CASES:
+            answer = new_eval_arithmetic(question.lower())
+            if answer != expected:
+                golden_failures.append((question, expected, answer))
+    click.echo(f"Kasus golden     : {len(ARITHMETIC_GOLDEN_CASES) - len(golden_failures)}/{len(ARITHMETIC_GOLDEN_CASES)} benar")
+    for question, expected, answer in golden_failures:
+        click.echo(f"  GAGAL {question!r}: diharapkan={expected} didapat={answer}")
+    if not questions:
+        click.echo("Tidak ada soal untuk di-benchmark.")
+        return
+
+    def timed(evaluator):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for _, question, _ in questions:
+                evaluator(question)
+        return (time.perf_counter() - started) * 1e6 / (repeat * len(questions))
+
+    # Log DEBUG evaluator baru (mis. pembagian nol) tidak ikut diukur
+    with contextlib.redirect_stdout(io.StringIO()):
+        parse_arithmetic_question.cache_clear()
+        started = time.perf_counter()
+        new_answers = [new_eval_arithmetic(question) for _, question, _ in questions]
+        new_cold_us = (time.perf_counter() - started) * 1e6 / len(questions)
+        legacy_answers = [legacy_eval_arithmetic(question) for _, question, _ in questions]
+        legacy_us = timed(legacy_eval_arithmetic)
+        new_warm_us = timed(new_eval_arithmetic)
+
+    rows = Counter()
+    differences = []
+    for (level, question, correct_answer), legacy, new in zip(questions, legacy_answers, new_answers):
+        rows[(level, 'questions')] += 1
+        rows[(level, 'legacy_solved')] += legacy is not None
+        rows[(level, 'new_solved')] += new is not None
+        rows[(level, 'legacy_correct')] += answers_equivalent(legacy, correct_answer)
+        rows[(level, 'new_correct')] += answers_equivalent(new, correct_answer)
+        if legacy != new:
+            differences.append((level, question, legacy, new, correct_answer))
+
+    click.echo(f"{'level':<6}{'soal':>6}{'lama_terjawab':>15}{'lama_benar':>12}{'baru_terjawab':>15}{'baru_benar':>12}")
+    for level in DATASETS:
+        if rows[(level, 'questions')]:
+            click.echo(f"{level:<6}{rows[(level, 'questions')]:>6}{rows[(level, 'legacy_solved')]:>15}{rows[(level, 'legacy_correct')]:>12}"
+                       f"{rows[(level, 'new_solved')]:>15}{rows[(level, 'new_correct')]:>12}")
+    click.echo(f"jalur eval() lama: {legacy_us:.1f} us/soal")
+    click.echo(f"parser (cold)    : {new_cold_us:.1f} us/soal")
+    click.echo(f"parser (cached)  : {new_warm_us:.1f} us/soal")
+    click.echo(f"Jawaban berbeda  : {len(differences)}")
+    for level, question, legacy, new, correct_answer in differences[:show]:
+        click.echo(f"  [{level}] {question!r}: lama={legacy} baru={new} kunci={correct_answer}")
+    if golden_failures:
+        raise click.ClickException(f"{len(golden_failures)} kasus golden aritmetika gagal.")
+
+
+@app.cli.command('benchmark-distractors', help='Ukur throughput distractor_generator untuk soal numerik sintetis.')
+@click.option('--questions', default=100000, show_default=True, help='Jumlah soal sintetis dalam satu batch.')
+@click.option('--single', default=2000, show_default=True, help='Jumlah soal yang juga diukur satu per satu.')
+@click.option('--seed', default=0, show_default=True, help='Seed untuk soal sintetis dan generator.')
+def benchmark_distractors_command(questions, single, seed):
+    rng = random.Random(seed)
+    answers = []
+    operands = []
+    for _ in range(questions):
+        a, b = Fraction(rng.randint(1, 1000)), Fraction(rng.randint(1, 100))
+        op = rng.choice('+-*/')
+        answers.append({'+': a + b, '-': a - b, '*': a * b, '/': a / b}[op])
+        operands.append((a, b))
+    generator = DistractorGenerator()
+
+    started = time.perf_counter()
+    batch = generator.generate(answers, operands, count=3, seed=seed)
+    batch_seconds = time.perf_counter() - started
+    deterministic = generator.generate(answers[:1000], operands[:1000], count=3, seed=seed) == \
+        generator.generate(answers[:1000], operands[:1000], count=3, seed=seed)
+
+    single = min(single, questions)
+    started = time.perf_counter()
+    for answer, pair in zip(answers[:single], operands[:single]):
+        generator.generate([answer], [pair], count=3, seed=seed)
+    single_seconds = time.perf_counter() - started
+
+    complete = sum(1 for row in batch if len(row) == 3)
+    click.echo(f"Batch {questions} soal : {batch_seconds:.3f} detik ({questions / batch_seconds:,.0f} soal/detik)")
+    if single:
+        click.echo(f"Per soal ({single})  : {single_seconds * 1e6 / single:.1f} us/soal ({single / single_seconds:,.0f} soal/detik)")
+    click.echo(f"3 pengecoh lengkap : {complete}/{questions}")
+    click.echo(f"Deterministik      : {'ya' if deterministic else 'TIDAK'}")
+    stats = generator.stats()
+    total = sum(stats.get(model, 0) for model in DistractorGenerator.MODEL_WEIGHTS)
+    for model in DistractorGenerator.MODEL_WEIGHTS:
+        click.echo(f"  {model:<17}: {stats.get(model, 0) * 100 / max(total, 1):.1f}%")
+    for answer, row in list(zip(answers, batch))[:5]:
+        click.echo(f"  {format_numeric_option(float(answer))} -> {row}")
+
+    # Jawaban eksak di luar jangkauan float tidak boleh menggagalkan batch; baris itu jatuh ke perturbed_numeric_options
+    huge_answers = [Fraction(10000) ** 100, -Fraction(10) ** 400, Fraction(10) ** 400 / 3]
+    huge_batch = generator.generate(huge_answers + answers[:2], [(Fraction(10000), Fraction(100))] + [None] * 2 + operands[:2], count=3, seed=seed)
+    huge_ok = all(row == [] for row in huge_batch[:len(huge_answers)]) and all(len(row) == 3 for row in huge_batch[len(huge_answers):])
+    click.echo(f"Jawaban raksasa    : {'opsi +-1/10%' if huge_ok else 'TIDAK SESUAI'} ({len(huge_answers)} soal, mis. 10000 pangkat 100)")
+    question = "Berapakah hasil dari 10000 pangkat 100?"
+    answer, _ = answer_rules.solve(question.lower())
+    _, options, correct = calculate_correct_answer_and_options(question, ['satu', 'dua', 'tiga', 'empat'], answer or '0')
+    click.echo(f"  {question!r}: {len(options)} opsi, kunci {'ada' if correct in options else 'HILANG'} ({sorted(option[:12] + '...' for option in options if option != correct)})")
+
+
+ANSWER_SOLVER_VERSION = '1' # Naikkan jika answer_rules berubah agar verifikasi berikutnya memeriksa ulang seluruh bank
+ANSWER_VERIFY_CHUNK_SIZE = int(os.getenv('ANSWER_VERIFY_CHUNK_SIZE', '500'))
+ANSWER_VERIFY_WORKERS = int(os.getenv('ANSWER_VERIFY_WORKERS', str(os.cpu_count() or 2)))
+ANSWER_VERIFY_REPORT_LIMIT = int(os.getenv('ANSWER_VERIFY_REPORT_LIMIT', '200'))
+
+def verify_answer_rows(rows):
+    # Dijalankan di proses worker: hanya solver murni, tanpa akses database. Log DEBUG solver dibuang.
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for question_id, content_hash, question, correct_answer in rows:
+            rule, computed_answer, _ = answer_rules.dispatch(question.lower())
+            if computed_answer is None:
+                status = 'unsolved'
+            elif answers_equivalent(computed_answer, correct_answer):
+                status = 'match'
+            else:
+                status = 'mismatch'
+            results.append((question_id, content_hash, ANSWER_SOLVER_VERSION, rule, computed_answer, status))
+    return results
+
+def iter_answer_verification_chunks(db, full=False, chunk_size=ANSWER_VERIFY_CHUNK_SIZE):
+    # Membaca bank soal per chunk dengan keyset pagination (id > terakhir). Tanpa full, hanya soal yang belum
+    # pernah diverifikasi, isinya berubah (content_hash), atau diverifikasi dengan solver versi lama.
+    query = (
+        "SELECT q.id, q.level, q.question, q.options, q.correct_answer, q.content_hash, "
+        "v.content_hash AS verified_hash, v.solver_version "
+        "FROM quiz_questions q LEFT JOIN answer_verifications v ON v.question_id = q.id "
+        "WHERE q.id > %s"
+    )
+    if not full:
+        query += (" AND (v.question_id IS NULL OR q.content_hash IS NULL OR v.content_hash <> q.content_hash "
+                  "OR v.solver_version <> %s)")
+    query += " ORDER BY q.id LIMIT %s"
+
+    last_id = 0
+    while True:
+        cursor = db.cursor(dictionary=True)
+        try:
+            params = (last_id, chunk_size) if full else (last_id, ANSWER_SOLVER_VERSION, chunk_size)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        db.commit()
+        if not rows:
+            return
+        last_id = rows[-1]['id']
+
+        chunk = []
+        unchanged = 0
+        for row in rows:
+            content_hash = row['content_hash']
+            if not content_hash:
+                try:
+                    options_list = json.loads(row['options'])
+                except (TypeError, ValueError):
+                    options_list = row['options']
+                content_hash = question_content_hash(row['level'], row['question'], options_list, row['correct_answer'])
+            if not full and content_hash == row['verified_hash'] and row['solver_version'] == ANSWER_SOLVER_VERSION:
+                unchanged += 1
+                continue
+            chunk.append((row['id'], content_hash, row['question'], row['correct_answer']))
+        yield chunk, unchanged
+
+def store_answer_verifications(db, results):
+    if not results:
+        return
+    cursor = db.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO answer_verifications (question_id, content_hash, solver_version, rule, computed_answer, status, verified_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE content_hash = VALUES(content_hash), "
+            "solver_version = VALUES(solver_version), rule = VALUES(rule), computed_answer = VALUES(computed_answer), "
+            "status = VALUES(status), verified_at = VALUES(verified_at)",
+            [(question_id, content_hash, version, rule, computed_answer[:255] if computed_answer else None, status)
+             for question_id, content_hash, version, rule, computed_answer, status in results]
+        )
+        db.commit()
+    except mysql.connector.Error:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def run_answer_verification(db, full=False, chunk_size=ANSWER_VERIFY_CHUNK_SIZE, workers=ANSWER_VERIFY_WORKERS, progress=None):
+    # Verifikasi offline kunci jawaban seluruh bank soal. Chunk dibaca di proses utama, solver dijalankan di
+    # ProcessPoolExecutor (paling banyak workers * 2 chunk sedang diproses), hasil di-upsert ke
+    # answer_verifications begitu satu chunk selesai. workers <= 1 menjalankan solver langsung di proses ini.
+    summary = Counter()
+    started = time.monotonic()
+
+    def record(results):
+        store_answer_verifications(db, results)
+        summary['verified'] += len(results)
+        summary.update(result[5] for result in results)
+        if progress:
+            progress(summary)
+
+    chunks = iter_answer_verification_chunks(db, full=full, chunk_size=chunk_size)
+    if workers <= 1:
+        for chunk, unchanged in chunks:
+            summary['unchanged'] += unchanged
+            record(verify_answer_rows(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for chunk, unchanged in chunks:
+                summary['unchanged'] += unchanged
+                if chunk:
+                    pending.add(executor.submit(verify_answer_rows, chunk))
+                while len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(future.result())
+            for future in pending:
+                record(future.result())
+
+    summary['seconds'] = round(time.monotonic() - started, 2)
+    print(f"DEBUG: Verifikasi kunci jawaban selesai: {dict(summary)}")
+    return summary
+
+def answer_verification_report(db, limit=ANSWER_VERIFY_REPORT_LIMIT):
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT status, COUNT(*) AS count, MAX(verified_at) AS last_verified FROM answer_verifications GROUP BY status")
+        counts = {row['status']: row for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT q.id, q.level, q.question, q.options, q.correct_answer, v.computed_answer, v.rule, v.verified_at "
+            "FROM answer_verifications v JOIN quiz_questions q ON q.id = v.question_id "
+            "WHERE v.status = 'mismatch' ORDER BY q.level, q.id LIMIT %s",
+            (limit,)
+        )
+        mismatches = cursor.fetchall()
+    finally:
+        cursor.close()
+    for row in mismatches:
+        try:
+            row['options'] = json.loads(row['options'])
+        except (TypeError, ValueError):
+            pass
+    return counts, mismatches
+
+@app.cli.command('verify-answers', help='Periksa kunci jawaban bank soal dengan answer_rules dan laporkan yang tidak cocok.')
+@click.option('--full', is_flag=True, help='Periksa ulang semua soal, bukan hanya yang berubah sejak verifikasi terakhir.')
+@click.option('--chunk-size', default=ANSWER_VERIFY_CHUNK_SIZE, show_default=True, help='Jumlah soal per chunk.')
+@click.option('--workers', default=ANSWER_VERIFY_WORKERS, show_default=True, help='Jumlah proses worker (<= 1 berarti tanpa proses terpisah).')
+@click.option('--show', default=50, show_default=True, help='Jumlah soal tidak cocok yang ditampilkan.')
+def verify_answers_command(full, chunk_size, workers, show):
+    db = get_db()
+    progress = lambda summary: click.echo(f"  {summary['verified']} soal diverifikasi...", err=True)
+    summary = run_answer_verification(db, full=full, chunk_size=chunk_size, workers=workers, progress=progress)
+    click.echo(f"Diverifikasi: {summary['verified']} (cocok {summary['match']}, tidak cocok {summary['mismatch']}, "
+               f"tidak terjawab solver {summary['unsolved']}), tidak berubah: {summary['unchanged']}, waktu: {summary['seconds']} detik")
+
+    counts, mismatches = answer_verification_report(db, limit=show)
+    click.echo("Total di answer_verifications: " + ", ".join(f"{status}={row['count']}" for status, row in sorted(counts.items())))
+    for row in mismatches:
+        click.echo(f"  #{row['id']} [{row['level']}] {row['question'][:80]!r}: kunci={row['correct_answer']!r} "
+                   f"solver={row['computed_answer']!r} ({row['rule']})")
+
+
+@app.cli.command('migrate', help='Jalankan migrasi skema yang belum tercatat di schema_migrations.')
+@click.option('--status', is_flag=True, help='Tampilkan status migrasi tanpa menjalankan apa pun.')
+def migrate_command(status):
+    if not status:
+        init_db_mysql()
+        return
+    cursor = get_db().cursor()
+    try:
+        applied = applied_migrations(cursor)
+        progress = migration_progress(cursor)
+    finally:
+        cursor.close()
+    for migration in load_migrations():
+        checksum = applied.get(migration['version'])
+        if checksum is None and migration['version'] in progress:
+            state = f"gagal di statement {progress[migration['version']][1] + 1}"
+        elif checksum is None:
+            state = 'belum'
+        elif checksum != migration['checksum']:
+            state = 'berubah'
+        else:
+            state = 'sudah'
+        click.echo(f"  [{state:<7}] {migration['filename']}")
+
+# Query yang sering dipanggil beserta index yang seharusnya dipakai (migrations/0007_hot_path_indexes.sql)
+HOT_QUERIES = [
+    ('question_sampler', 'quiz_questions', 'idx_quiz_questions_level',
+     "SELECT id FROM quiz_questions WHERE level = %s", ('SD',)),
+    ('few_shot_candidates', 'quiz_questions', 'idx_quiz_questions_level',
+     "SELECT question, options, correct_answer FROM quiz_questions WHERE level = %s ORDER BY id LIMIT %s", ('SD', AI_FEW_SHOT_CANDIDATES)),
+    ('dashboard_history', 'quiz_history', 'idx_quiz_history_user_timestamp',
+     "SELECT id, level, topic, score, total_questions, timestamp FROM quiz_history WHERE user_id = %s ORDER BY timestamp DESC", (1,)),
+    ('quiz_taken_questions', 'quiz_taken_questions', 'idx_quiz_taken_questions_history',
+     "SELECT id, question_text, options_json, correct_answer FROM quiz_taken_questions WHERE quiz_history_id = %s ORDER BY id ASC", (1,)),
+    ('ai_question_pool_take', 'ai_question_pool', 'idx_ai_question_pool_key',
+     "SELECT id, question, options, correct_answer FROM ai_question_pool WHERE level_context = %s AND topic_key = %s AND expires_at > NOW() ORDER BY id ASC LIMIT %s", ('SD', 'umum', AI_POOL_REFILL_BATCH)),
+    ('ai_job_recover', 'ai_quiz_jobs', 'idx_ai_quiz_jobs_status_updated',
+     "SELECT id FROM ai_quiz_jobs WHERE status = 'running' AND updated_at < NOW() - INTERVAL %s SECOND", (AI_JOB_STALE_SECONDS,)),
+]
+
+def check_hot_query_indexes(db):
+    # EXPLAIN setiap HOT_QUERIES; gagal jika optimizer tidak memakai index yang diharapkan untuk tabelnya
+    # Di tabel yang hampir kosong optimizer bisa memilih full scan; tests/test_check_indexes.py menjalankan
+    # pemeriksaan ini pada database test yang sudah diisi cukup banyak baris
+    results = []
+    cursor = db.cursor(dictionary=True)
+    try:
+        for name, table, expected_index, query, params in HOT_QUERIES:
+            cursor.execute("EXPLAIN " + query, params)
+            plan = next((row for row in cursor.fetchall() if row.get('table') == table), {})
+            results.append({
+                'name': name,
+                'table': table,
+                'expected_index': expected_index,
+                'key': plan.get('key'),
+                'type': plan.get('type'),
+                'rows': plan.get('rows'),
+                'extra': plan.get('Extra'),
+                'ok': plan.get('key') == expected_index,
+            })
+    finally:
+        cursor.close()
+    return results
+
+@app.cli.command('check-indexes', help='Periksa dengan EXPLAIN bahwa query utama memakai index-nya; exit code 1 jika tidak.')
+def check_indexes_command():
+    results = check_hot_query_indexes(get_db())
+    for result in results:
+        click.echo(f"  [{'OK' if result['ok'] else 'GAGAL'}] {result['name']}: key={result['key']} (diharapkan {result['expected_index']}), "
+                   f"type={result['type']}, rows={result['rows']}, extra={result['extra']}")
+    failed = [result['name'] for result in results if not result['ok']]
+    if failed:
+        raise click.ClickException(f"Query tidak memakai index yang diharapkan: {', '.join(failed)}")
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -1,16 +1,10 @@
--- schema.sql
--- File ini berisi perintah SQL untuk membuat tabel database Anda di MySQL.
-
--- Hapus tabel jika sudah ada untuk memastikan skema bersih saat inisialisasi
--- Gunakan IF EXISTS untuk menghindari error jika tabel belum ada
-DROP TABLE IF EXISTS quiz_taken_questions;
-DROP TABLE IF EXISTS quiz_history;
-DROP TABLE IF EXISTS quiz_questions;
-DROP TABLE IF EXISTS users;
-DROP TABLE IF EXISTS uploaded_datasets;
+-- 0001_initial_schema.sql
+-- Skema awal database MySQL, sama persis dengan schema.sql lama. Database yang dibuat dengan schema.sql lama
+-- dianggap sudah menjalankan migrasi ini (CREATE TABLE IF NOT EXISTS). Perubahan skema berikutnya ditambahkan
+-- sebagai file migrasi baru, bukan di sini.
 
 -- Tabel untuk menyimpan informasi pengguna
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
     id INT PRIMARY KEY AUTO_INCREMENT,
     username VARCHAR(50) UNIQUE NOT NULL,
     password VARCHAR(255) NOT NULL,
@@ -18,7 +12,7 @@ CREATE TABLE users (
 );
 
 -- Tabel untuk menyimpan soal-soal kuis yang dikelola admin
-CREATE TABLE quiz_questions (
+CREATE TABLE IF NOT EXISTS quiz_questions (
     id INT PRIMARY KEY AUTO_INCREMENT,
     level VARCHAR(10) NOT NULL,
     question TEXT NOT NULL,
@@ -27,7 +21,7 @@ CREATE TABLE quiz_questions (
 );
 
 -- Tabel untuk menyimpan riwayat kuis pengguna (summary)
-CREATE TABLE quiz_history (
+CREATE TABLE IF NOT EXISTS quiz_history (
     id INT PRIMARY KEY AUTO_INCREMENT,
     user_id INT NOT NULL,
     level VARCHAR(50) NOT NULL,
@@ -39,7 +33,7 @@ CREATE TABLE quiz_history (
 );
 
 -- Tabel baru untuk menyimpan detail setiap soal kuis yang diambil
-CREATE TABLE quiz_taken_questions (
+CREATE TABLE IF NOT EXISTS quiz_taken_questions (
     id INT PRIMARY KEY AUTO_INCREMENT,
     quiz_history_id INT NOT NULL,
     question_text TEXT NOT NULL,
@@ -51,7 +45,7 @@ CREATE TABLE quiz_taken_questions (
 );
 
 -- Tabel untuk melacak dataset yang diunggah oleh admin
-CREATE TABLE uploaded_datasets (
+CREATE TABLE IF NOT EXISTS uploaded_datasets (
     id INT PRIMARY KEY AUTO_INCREMENT,
     filename VARCHAR(255) UNIQUE NOT NULL,
     filepath VARCHAR(512) NOT NULL,
@@ -0,0 +1,14 @@
+-- 0002_quiz_questions_dataset_source.sql
+-- dataset_id + source_key (hash teks soal) mengidentifikasi soal dari dataset yang sama saat impor ulang,
+-- content_hash (hash seluruh isi soal) dipakai untuk mendeteksi soal yang berubah.
+
+ALTER TABLE quiz_questions
+    ADD COLUMN dataset_id INT NULL,
+    ADD COLUMN source_key CHAR(40) NULL,
+    ADD COLUMN content_hash CHAR(40) NULL;
+
+ALTER TABLE quiz_questions ADD UNIQUE KEY uq_quiz_questions_dataset_source (dataset_id, source_key);
+
+-- Nama sama dengan nama otomatis MySQL di skema gabungan lama, agar database lama tidak mendapat FK kedua
+ALTER TABLE quiz_questions
+    ADD CONSTRAINT quiz_questions_ibfk_1 FOREIGN KEY (dataset_id) REFERENCES uploaded_datasets(id) ON DELETE SET NULL;
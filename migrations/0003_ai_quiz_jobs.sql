@@ -0,0 +1,18 @@
+-- 0003_ai_quiz_jobs.sql
+-- Tabel untuk job pembuatan kuis AI yang dikerjakan di latar belakang
+
+CREATE TABLE IF NOT EXISTS ai_quiz_jobs (
+    id CHAR(32) PRIMARY KEY,
+    user_id INT NOT NULL,
+    quiz_history_id INT NOT NULL,
+    topic VARCHAR(255) NOT NULL,
+    level_context VARCHAR(50) NOT NULL,
+    num_questions INT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    error TEXT,
+    attempts INT NOT NULL DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (quiz_history_id) REFERENCES quiz_history(id) ON DELETE CASCADE
+);
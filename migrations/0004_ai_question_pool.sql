@@ -0,0 +1,14 @@
+-- 0004_ai_question_pool.sql
+-- Pool soal AI yang sudah divalidasi per (level_context, topik ternormalisasi), diisi ulang di latar belakang
+
+CREATE TABLE IF NOT EXISTS ai_question_pool (
+    id INT PRIMARY KEY AUTO_INCREMENT,
+    level_context VARCHAR(50) NOT NULL,
+    topic_key VARCHAR(255) NOT NULL,
+    question TEXT NOT NULL,
+    options TEXT NOT NULL,
+    correct_answer VARCHAR(255) NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME NOT NULL,
+    KEY idx_ai_question_pool_key (level_context, topic_key, expires_at)
+);
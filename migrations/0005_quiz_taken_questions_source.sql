@@ -0,0 +1,4 @@
+-- 0005_quiz_taken_questions_source.sql
+-- Asal soal kuis AI: 'pool', 'ai', atau 'bank' (cadangan dari quiz_questions)
+
+ALTER TABLE quiz_taken_questions ADD COLUMN source VARCHAR(20) NULL AFTER correct_answer;
@@ -0,0 +1,15 @@
+-- 0006_answer_verifications.sql
+-- Hasil verifikasi offline kunci jawaban bank soal (`flask verify-answers`). content_hash dan solver_version
+-- menandai isi soal dan versi solver yang diperiksa, sehingga verifikasi ulang hanya memproses soal yang berubah.
+
+CREATE TABLE IF NOT EXISTS answer_verifications (
+    question_id INT PRIMARY KEY,
+    content_hash CHAR(40) NOT NULL,
+    solver_version VARCHAR(20) NOT NULL,
+    rule VARCHAR(50) NULL,
+    computed_answer VARCHAR(255) NULL,
+    status VARCHAR(20) NOT NULL, -- 'match', 'mismatch', atau 'unsolved' (tidak ada rule yang bisa menjawab)
+    verified_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_answer_verifications_status (status),
+    FOREIGN KEY (question_id) REFERENCES quiz_questions(id) ON DELETE CASCADE
+);
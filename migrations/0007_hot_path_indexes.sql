@@ -0,0 +1,16 @@
+-- 0007_hot_path_indexes.sql
+-- Index komposit untuk query yang sering dipanggil; diperiksa dengan `flask check-indexes` (HOT_QUERIES).
+-- Index FK otomatis pada quiz_history.user_id dan quiz_taken_questions.quiz_history_id digantikan oleh MySQL
+-- dengan index di bawah karena kolom pertamanya sama.
+
+-- QuestionSampler dan FewShotSelector: WHERE level = ? (ORDER BY id)
+CREATE INDEX idx_quiz_questions_level ON quiz_questions (level, id);
+
+-- Dashboard: WHERE user_id = ? ORDER BY timestamp DESC
+CREATE INDEX idx_quiz_history_user_timestamp ON quiz_history (user_id, timestamp);
+
+-- Penilaian, hasil kuis dan stream SSE: WHERE quiz_history_id = ? ORDER BY id
+CREATE INDEX idx_quiz_taken_questions_history ON quiz_taken_questions (quiz_history_id, id);
+
+-- AIQuizJobRunner.recover: WHERE status = 'running' AND updated_at < ?
+CREATE INDEX idx_ai_quiz_jobs_status_updated ON ai_quiz_jobs (status, updated_at);
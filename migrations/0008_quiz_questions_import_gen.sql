@@ -0,0 +1,8 @@
+-- 0008_quiz_questions_import_gen.sql
+-- import_gen menandai impor terakhir yang memuat soal ini; setelah impor ulang selesai, soal dataset yang
+-- tidak bertanda impor tersebut sudah hilang dari file dan dihapus. import_row adalah nomor baris CSV-nya,
+-- untuk melaporkan soal duplikat dalam satu file.
+
+ALTER TABLE quiz_questions
+    ADD COLUMN import_gen CHAR(32) NULL,
+    ADD COLUMN import_row INT NULL;
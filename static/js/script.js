@@ -39,6 +39,169 @@ function generateQuiz(type) {
     window.location.href = url;
 }
 
+// Membuat elemen form kuis kosong beserta hidden input quiz_history_id
+function createQuizForm(quizHistoryId) {
+    const quizForm = document.createElement('form');
+    quizForm.id = 'quizForm';
+    quizForm.action = '/submit_quiz'; 
+    quizForm.method = 'POST';
+
+    // PENTING: Tambahkan hidden input untuk quiz_history_id
+    const hiddenInput = document.createElement('input');
+    hiddenInput.type = 'hidden';
+    hiddenInput.name = 'quiz_history_id';
+    hiddenInput.value = quizHistoryId; // quiz_history_id comes from API response
+    quizForm.appendChild(hiddenInput);
+    console.log(`DEBUG JS: Hidden input quiz_history_id ditambahkan ke form dengan value: ${hiddenInput.value}`);
+    return quizForm;
+}
+
+// Menambahkan satu kartu soal ke form. Nama input question_{index} harus mengikuti urutan soal di server.
+function appendQuestionCard(quizForm, item, index) {
+    const questionCard = document.createElement('div');
+    questionCard.className = 'question-card'; // Menggunakan kelas yang sudah ada di style.css
+    
+    let optionsHtml = '<ul class="options-list">'; // Menggunakan kelas yang sudah ada di style.css
+    const optionsToShuffle = Array.isArray(item.options) && item.options.length >= 4 ? [...item.options] : [item.correct_answer, "Pilihan B", "Pilihan C", "Pilihan D"];
+    const shuffledOptions = optionsToShuffle.sort(() => Math.random() - 0.5);
+
+    shuffledOptions.forEach(option => {
+        // Menggunakan btoa() untuk meng-encode option agar ID HTML valid
+        const encodedOption = btoa(option).replace(/=/g, ''); 
+        optionsHtml += `
+            <li>
+                <input type="radio" id="q${index}_option_${encodedOption}" name="question_${index}" value="${option}" required>
+                <label for="q${index}_option_${encodedOption}">${option}</label>
+            </li>
+        `;
+    });
+    optionsHtml += '</ul>';
+
+    questionCard.innerHTML = `
+        <h3>${index + 1}. ${item.question}</h3>
+        ${optionsHtml}
+        <div class="feedback-area" style="display:none;"></div>
+    `;
+    quizForm.appendChild(questionCard);
+    console.log(`DEBUG JS: Soal ${index + 1} ditambahkan ke formulir.`);
+}
+
+function appendSubmitButton(quizForm) {
+    const submitButton = document.createElement('button');
+    submitButton.type = 'submit';
+    submitButton.className = 'btn-primary'; // Menggunakan kelas yang sudah ada di style.css
+    submitButton.textContent = 'Selesai Kuis';
+    submitButton.style.marginTop = '30px';
+    quizForm.appendChild(submitButton);
+    console.log("DEBUG JS: Tombol submit ditambahkan.");
+}
+
+// Membangun formulir kuis dari data {quiz, quiz_history_id}
+function renderQuiz(quizDisplayArea, data) {
+    quizDisplayArea.innerHTML = ''; // Bersihkan konten sebelumnya
+
+    if (data.quiz && data.quiz.length > 0 && data.quiz_history_id) {
+        console.log(`DEBUG JS: Kuis dan quiz_history_id (${data.quiz_history_id}) diterima. Membangun formulir kuis.`);
+        const quizForm = createQuizForm(data.quiz_history_id);
+        data.quiz.forEach((item, index) => appendQuestionCard(quizForm, item, index));
+        appendSubmitButton(quizForm);
+        quizDisplayArea.appendChild(quizForm);
+    } else {
+        quizDisplayArea.innerHTML = `
+            <p class="error-message status-message">
+                Tidak ada soal yang tersedia untuk kriteria ini atau ID riwayat kuis tidak ditemukan. Coba topik, level, atau jumlah soal lain.
+            </p>
+        `;
+        console.warn("DEBUG JS: Tidak ada kuis yang diterima atau quiz_history_id hilang.");
+    }
+}
+
+// Menampilkan soal kuis AI satu per satu lewat Server-Sent Events begitu backend selesai memvalidasinya.
+// Jika EventSource tidak didukung atau koneksi terputus sebelum ada soal, kembali ke polling status job.
+function streamAiQuizJob(quizDisplayArea, jobId, quizHistoryId) {
+    if (typeof EventSource === 'undefined') {
+        return waitForAiQuizJob(quizDisplayArea, jobId);
+    }
+
+    quizDisplayArea.innerHTML = `
+        <p class="loading-message status-message" id="ai-quiz-progress">
+            <span class="spinner"></span> Model AI sedang membuat soal kuis Anda. Soal akan muncul satu per satu...
+        </p>
+    `;
+    const progressMessage = document.getElementById('ai-quiz-progress');
+    const quizForm = createQuizForm(quizHistoryId);
+    quizDisplayArea.insertBefore(quizForm, progressMessage);
+    let receivedQuestions = 0;
+
+    const source = new EventSource(`/api/ai_quiz_jobs/${jobId}/events`);
+    source.addEventListener('question', event => {
+        const item = JSON.parse(event.data);
+        appendQuestionCard(quizForm, item, item.index);
+        receivedQuestions += 1;
+    });
+    source.addEventListener('status', event => {
+        const data = JSON.parse(event.data);
+        source.close();
+        console.log(`DEBUG JS: Stream job kuis AI ${jobId} selesai dengan status ${data.status}.`);
+        if (data.status === 'done' && receivedQuestions > 0) {
+            progressMessage.remove();
+            appendSubmitButton(quizForm);
+        } else {
+            progressMessage.className = 'error-message status-message';
+            progressMessage.textContent = `Error: Gagal memuat kuis. ${data.error || 'Tidak ada soal yang dihasilkan.'}`;
+        }
+    });
+    // Reconnect otomatis EventSource akan mengirim ulang soal dari awal, jadi tutup dan render ulang lewat polling.
+    source.onerror = () => {
+        console.warn("DEBUG JS: Stream SSE terputus, beralih ke polling status job.");
+        source.close();
+        waitForAiQuizJob(quizDisplayArea, jobId);
+    };
+}
+
+// Menunggu job kuis AI di latar belakang dengan polling endpoint status, lalu menampilkan kuisnya.
+// Polling berhenti setelah AI_JOB_POLL_TIMEOUT_MS agar halaman tidak menunggu selamanya jika job macet.
+const AI_JOB_POLL_TIMEOUT_MS = 5 * 60 * 1000;
+
+async function waitForAiQuizJob(quizDisplayArea, jobId) {
+    quizDisplayArea.innerHTML = `
+        <p class="loading-message status-message">
+            <span class="spinner"></span> Model AI sedang membuat soal kuis Anda...
+            <br><small>Ini mungkin membutuhkan waktu beberapa detik.</small>
+        </p>
+    `;
+    const pollIntervalMs = 1500;
+    const deadline = Date.now() + AI_JOB_POLL_TIMEOUT_MS;
+    try {
+        while (true) {
+            const response = await fetch(`/api/ai_quiz_jobs/${jobId}`);
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Gagal memeriksa status job kuis AI.');
+            }
+            console.log(`DEBUG JS: Status job kuis AI ${jobId}: ${data.status}`);
+            if (data.status === 'done') {
+                renderQuiz(quizDisplayArea, data);
+                return;
+            }
+            if (data.status === 'failed') {
+                throw new Error(data.error || 'Job kuis AI gagal.');
+            }
+            if (Date.now() + pollIntervalMs > deadline) {
+                throw new Error('Pembuatan kuis AI memakan waktu terlalu lama. Silakan muat ulang halaman atau coba lagi nanti.');
+            }
+            await new Promise(resolve => setTimeout(resolve, pollIntervalMs));
+        }
+    } catch (error) {
+        console.error('ERROR JS: Gagal memuat kuis AI:', error);
+        quizDisplayArea.innerHTML = `
+            <p class="error-message status-message">
+                Error: Gagal memuat kuis. ${error.message}
+            </p>
+        `;
+    }
+}
+
 // Fungsi untuk memuat dan menampilkan kuis (akan dipanggil oleh quiz.html)
 async function loadQuizContent() {
     const quizDisplayArea = document.getElementById('quiz-container');
@@ -48,6 +211,18 @@ async function loadQuizContent() {
     }
     quizDisplayArea.style.display = 'block'; // Pastikan kontainer kuis terlihat
 
+    if (window.AI_JOB_ID) {
+        streamAiQuizJob(quizDisplayArea, window.AI_JOB_ID, window.QUIZ_HISTORY_ID);
+        return;
+    }
+
+    // Rute /quiz sudah membuat kuis di server; gunakan data itu agar kuis tidak dibuat dua kali.
+    if (window.QUIZ_DATA && window.QUIZ_HISTORY_ID) {
+        console.log(`DEBUG JS: Menggunakan data kuis dari server (quiz_history_id ${window.QUIZ_HISTORY_ID}).`);
+        renderQuiz(quizDisplayArea, { quiz: window.QUIZ_DATA, quiz_history_id: window.QUIZ_HISTORY_ID });
+        return;
+    }
+
     const urlParams = new URLSearchParams(window.location.search);
     const quizType = urlParams.get('type');
     const numQuestions = parseInt(urlParams.get('num_questions'));
@@ -124,71 +299,7 @@ async function loadQuizContent() {
         const data = await response.json();
         console.log("DEBUG JS: Data respon API berhasil diterima:", data);
 
-        quizDisplayArea.innerHTML = ''; // Bersihkan konten sebelumnya
-
-        if (data.quiz && data.quiz.length > 0 && data.quiz_history_id) {
-            console.log(`DEBUG JS: Kuis dan quiz_history_id (${data.quiz_history_id}) diterima. Membangun formulir kuis.`);
-            const quizForm = document.createElement('form');
-            quizForm.id = 'quizForm';
-            quizForm.action = '/submit_quiz'; 
-            quizForm.method = 'POST';
-
-            // PENTING: Tambahkan hidden input untuk quiz_history_id
-            const hiddenInput = document.createElement('input');
-            hiddenInput.type = 'hidden';
-            hiddenInput.name = 'quiz_history_id';
-            hiddenInput.value = data.quiz_history_id; // data.quiz_history_id comes from API response
-            quizForm.appendChild(hiddenInput);
-            console.log(`DEBUG JS: Hidden input quiz_history_id ditambahkan ke form dengan value: ${hiddenInput.value}`);
-
-
-            data.quiz.forEach((item, index) => {
-                const questionCard = document.createElement('div');
-                questionCard.className = 'question-card'; // Menggunakan kelas yang sudah ada di style.css
-                
-                let optionsHtml = '<ul class="options-list">'; // Menggunakan kelas yang sudah ada di style.css
-                const optionsToShuffle = Array.isArray(item.options) && item.options.length >= 4 ? [...item.options] : [item.correct_answer, "Pilihan B", "Pilihan C", "Pilihan D"];
-                const shuffledOptions = optionsToShuffle.sort(() => Math.random() - 0.5);
-
-                shuffledOptions.forEach(option => {
-                    // Menggunakan btoa() untuk meng-encode option agar ID HTML valid
-                    const encodedOption = btoa(option).replace(/=/g, ''); 
-                    optionsHtml += `
-                        <li>
-                            <input type="radio" id="q${index}_option_${encodedOption}" name="question_${index}" value="${option}" required>
-                            <label for="q${index}_option_${encodedOption}">${option}</label>
-                        </li>
-                    `;
-                });
-                optionsHtml += '</ul>';
-
-                questionCard.innerHTML = `
-                    <h3>${index + 1}. ${item.question}</h3>
-                    ${optionsHtml}
-                    <div class="feedback-area" style="display:none;"></div>
-                `;
-                quizForm.appendChild(questionCard);
-                console.log(`DEBUG JS: Soal ${index + 1} ditambahkan ke formulir.`);
-            });
-
-            const submitButton = document.createElement('button');
-            submitButton.type = 'submit';
-            submitButton.className = 'btn-primary'; // Menggunakan kelas yang sudah ada di style.css
-            submitButton.textContent = 'Selesai Kuis';
-            submitButton.style.marginTop = '30px';
-            quizForm.appendChild(submitButton);
-            console.log("DEBUG JS: Tombol submit ditambahkan.");
-
-            quizDisplayArea.appendChild(quizForm);
-            
-        } else {
-            quizDisplayArea.innerHTML = `
-                <p class="error-message status-message">
-                    Tidak ada soal yang tersedia untuk kriteria ini atau ID riwayat kuis tidak ditemukan. Coba topik, level, atau jumlah soal lain.
-                </p>
-            `;
-            console.warn("DEBUG JS: Tidak ada kuis yang diterima atau quiz_history_id hilang.");
-        }
+        renderQuiz(quizDisplayArea, data);
     } catch (error) {
         console.error('ERROR JS: Gagal memuat kuis:', error);
         quizDisplayArea.innerHTML = `
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# app.py ada di root repo, bukan di package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,61 @@
+import os
+
+import mysql.connector
+import pytest
+
+import app as appmod
+
+# Butuh server MySQL sungguhan dan database khusus test (akan di-DROP dan dibuat ulang), mis.
+# TEST_MYSQL_DATABASE=kuis_test TEST_MYSQL_USER=root python -m pytest tests/test_check_indexes.py
+TEST_DATABASE = os.getenv('TEST_MYSQL_DATABASE')
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE, reason="TEST_MYSQL_DATABASE tidak di-set")
+
+LEVELS = ['SD', 'SMP', 'SMA', 'Kuliah', 'Umum']
+
+
+@pytest.fixture(scope='module')
+def seeded_db():
+    conn = mysql.connector.connect(
+        host=os.getenv('TEST_MYSQL_HOST', 'localhost'),
+        user=os.getenv('TEST_MYSQL_USER', 'root'),
+        password=os.getenv('TEST_MYSQL_PASSWORD', ''),
+    )
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{TEST_DATABASE}`")
+    cursor.execute(f"CREATE DATABASE `{TEST_DATABASE}`")
+    conn.database = TEST_DATABASE
+    appmod.run_migrations(conn)
+
+    # Tabel kecil membuat optimizer memilih full scan; isi cukup banyak baris agar rencana sama dengan produksi
+    cursor.executemany("INSERT INTO users (username, password) VALUES (%s, 'x')",
+                       [(f'user{i}',) for i in range(200)])
+    cursor.executemany("INSERT INTO quiz_questions (level, question, options, correct_answer) VALUES (%s, %s, '[]', '1')",
+                       [(LEVELS[i % len(LEVELS)], f'Soal {i}') for i in range(5000)])
+    cursor.executemany("INSERT INTO quiz_history (user_id, level, score, total_questions) VALUES (%s, 'SD', 0, 10)",
+                       [(i % 200 + 1,) for i in range(4000)])
+    cursor.executemany("INSERT INTO quiz_taken_questions (quiz_history_id, question_text, options_json, correct_answer) "
+                       "VALUES (%s, 'Soal', '[]', '1')",
+                       [(i % 4000 + 1,) for i in range(20000)])
+    cursor.executemany("INSERT INTO ai_question_pool (level_context, topic_key, question, options, correct_answer, expires_at) "
+                       "VALUES (%s, %s, 'Soal', '[]', '1', NOW() + INTERVAL 1 DAY)",
+                       [(LEVELS[i % len(LEVELS)], f'topik{i % 40}') for i in range(5000)])
+    cursor.executemany("INSERT INTO ai_quiz_jobs (id, user_id, quiz_history_id, topic, level_context, num_questions, status) "
+                       "VALUES (%s, %s, %s, 'topik', 'SD', 10, %s)",
+                       [(f'{i:032x}', i % 200 + 1, i % 4000 + 1, 'running' if i % 100 == 0 else 'done') for i in range(4000)])
+    conn.commit()
+    for table in ('quiz_questions', 'quiz_history', 'quiz_taken_questions', 'ai_question_pool', 'ai_quiz_jobs'):
+        cursor.execute(f"ANALYZE TABLE {table}")
+        cursor.fetchall()
+    cursor.close()
+    yield conn
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{TEST_DATABASE}`")
+    cursor.close()
+    conn.close()
+
+
+@pytest.mark.parametrize('name', [query[0] for query in appmod.HOT_QUERIES])
+def test_hot_query_uses_expected_index(seeded_db, name):
+    result = next(result for result in appmod.check_hot_query_indexes(seeded_db) if result['name'] == name)
+    assert result['ok'], f"{name}: key={result['key']} (diharapkan {result['expected_index']}), type={result['type']}, extra={result['extra']}"
@@ -0,0 +1,101 @@
+import mysql.connector
+import pytest
+
+import app as appmod
+
+
+def test_split_sql_statements_ignores_semicolons_in_quotes_and_comments():
+    sql = (
+        "-- komentar; bukan statement\n"
+        "INSERT INTO t VALUES ('a;b', \"c;--d\", 'it''s;', 'x\\';y');\n"
+        "SELECT `kolom;aneh` FROM t; -- akhir;\n"
+    )
+    assert appmod.split_sql_statements(sql) == [
+        "INSERT INTO t VALUES ('a;b', \"c;--d\", 'it''s;', 'x\\';y')",
+        "SELECT `kolom;aneh` FROM t",
+    ]
+
+
+def test_migration_statement_objects():
+    assert appmod.migration_statement_objects(
+        "CREATE INDEX idx_a ON t (a, b)") == [('index', 't', 'idx_a')]
+    assert appmod.migration_statement_objects(
+        "ALTER TABLE t ADD COLUMN a DECIMAL(5,2) NULL, ADD UNIQUE KEY uq_a (a, b)") == [
+        ('column', 't', 'a'), ('index', 't', 'uq_a')]
+    # Bentuk yang tidak dikenali tidak pernah dilewati
+    assert appmod.migration_statement_objects("ALTER TABLE t DROP COLUMN a") is None
+    assert appmod.migration_statement_objects("CREATE TABLE IF NOT EXISTS t (id INT)") is None
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def execute(self, query, params=None):
+        conn = self.conn
+        self.result = [(1,)]
+        if query.startswith(('SELECT GET_LOCK', 'SELECT RELEASE_LOCK', 'CREATE TABLE IF NOT EXISTS schema_')):
+            return
+        if query.startswith('SELECT version, checksum, statements_done'):
+            self.result = [(version, checksum, done) for version, (checksum, done) in conn.progress.items()]
+        elif query.startswith('SELECT version'):
+            self.result = list(conn.applied.items())
+        elif query.startswith('INSERT INTO schema_migrations '):
+            conn.applied[params[0]] = params[2]
+        elif query.startswith('INSERT INTO schema_migration_progress'):
+            conn.progress[params[0]] = (params[1], params[2])
+        elif query.startswith('DELETE FROM schema_migration_progress'):
+            conn.progress.pop(params[0], None)
+        elif 'information_schema' in query:
+            self.result = [(int(params[1] in conn.existing),)]
+        else:
+            conn.executed.append(query)
+            if conn.fail_on and conn.fail_on in query:
+                raise mysql.connector.Error(msg="Duplicate key name", errno=1061)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, existing=(), fail_on=None):
+        self.existing = set(existing)
+        self.fail_on = fail_on
+        self.applied = {}
+        self.progress = {}
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+
+def test_run_migrations_skips_only_statements_whose_objects_exist():
+    # Database dari skema gabungan lama: kolom dan index 0002-0007 sudah ada
+    existing = {'dataset_id', 'source_key', 'content_hash', 'uq_quiz_questions_dataset_source',
+                'quiz_questions_ibfk_1', 'source', 'idx_quiz_questions_level', 'idx_quiz_history_user_timestamp',
+                'idx_quiz_taken_questions_history', 'idx_ai_quiz_jobs_status_updated'}
+    conn = FakeConnection(existing)
+    applied = appmod.run_migrations(conn)
+    assert len(applied) == len(appmod.load_migrations())
+    # Hanya 0008 (import_gen), yang belum ada di skema gabungan lama, yang benar-benar dijalankan
+    ddl = [query for query in conn.executed if query.startswith(('ALTER TABLE', 'CREATE INDEX'))]
+    assert len(ddl) == 1 and 'import_gen' in ddl[0]
+
+
+def test_run_migrations_duplicate_name_error_is_not_swallowed():
+    # Index tidak tercatat di information_schema tetapi MySQL menolak namanya: migrasi harus gagal
+    conn = FakeConnection(fail_on='idx_quiz_taken_questions_history')
+    with pytest.raises(mysql.connector.Error):
+        appmod.run_migrations(conn)
+    assert '0007' not in conn.applied
+    assert conn.progress['0007'][1] == 2
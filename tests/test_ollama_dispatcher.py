@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import app as appmod
+
+MODEL = 'stub-model'
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json({'models': [{'name': f'{MODEL}:latest'}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send_json({'response': '[]', 'done': True})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubOllama:
+    def __init__(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubOllamaHandler)
+        self.port = self.server.server_address[1]
+        self.url = f'http://127.0.0.1:{self.port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch):
+    for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'http_proxy', 'https_proxy', 'all_proxy'):
+        monkeypatch.delenv(name, raising=False)
+
+
+def generate(dispatcher):
+    # Satu panggilan seperti generate_raw_ai_quiz_items: kegagalan koneksi dicatat oleh lease
+    try:
+        with dispatcher.lease() as backend:
+            requests.post(backend.generate_url, json={'model': MODEL}, timeout=2).raise_for_status()
+            return backend.base_url
+    except requests.exceptions.ConnectionError:
+        return None
+
+
+def test_dispatcher_fails_over_and_health_check_readmits_backend():
+    first, second = StubOllama(), StubOllama()
+    dispatcher = appmod.OllamaDispatcher(f'{first.url},{second.url}', MODEL, 1, queue_timeout=2,
+                                         health_check_seconds=0.2, eject_after_failures=2)
+    backend_first, backend_second = dispatcher.backends
+    try:
+        assert {generate(dispatcher) for _ in range(20)} == {first.url, second.url}
+
+        # Backend kedua mati: paling banyak eject_after_failures panggilan gagal, lalu semuanya ke backend pertama
+        port = second.port
+        second.stop()
+        results = [generate(dispatcher) for _ in range(20)]
+        assert results.count(None) <= 2
+        assert results[-10:] == [first.url] * 10
+        assert not backend_second.healthy
+        assert backend_first.healthy
+
+        # Health check berkala memasukkan kembali backend begitu /api/tags menjawab lagi
+        second = StubOllama(port)
+        deadline = time.monotonic() + 5
+        while not backend_second.healthy and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert backend_second.healthy
+        assert backend_second.consecutive_failures == 0
+        assert second.url in {generate(dispatcher) for _ in range(20)}
+    finally:
+        first.stop()
+        second.stop()